@@ -3,6 +3,8 @@
 
 import os
 import json
+import shutil
+import tempfile
 import subprocess
 
 from .exceptions import TMSError, XMLError
@@ -39,9 +41,30 @@ class Tiler:
 
         return json.loads(proc.communicate()[0].decode())
 
+    @classmethod
+    def __progress_line(self, progress, quiet):
+        """
+        Returns a callback for gdal_tiler.py output lines:
+        JSON progress events go to progress(event), other lines are printed
+        params:
+            progress: callable receiving event dicts
+        """
+        def callback(line):
+            if line.startswith('{'):
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    event = None
+                if event is not None:
+                    progress(event)
+                    return
+            Util._print(line, quiet)
+
+        return callback
+
     @classmethod
     def __convert_to_byte_scale(
-        self, input_image, output_folder="~/tms/", quiet=True
+        self, input_image, output_folder="~/tms/", quiet=True, vrt=False
     ):
         """
         Translates raster using gdal
@@ -49,11 +72,14 @@ class Tiler:
         params:
             input_image: Image instance
             output_folder: output folder for image
+            vrt: write a VRT scaling the source on the fly instead of a TIF
         returns:
             Image instance of output_image
         """
 
         command = 'gdal_translate {2} -ot Byte -scale {0} {1}'
+        if vrt:
+            command += ' -of VRT'
 
         if quiet:
             q_param = '-q'
@@ -61,7 +87,8 @@ class Tiler:
             print("Converting image with command:\t {}".format(command))
             q_param = ''
 
-        image_name = "{}.TIF".format(input_image.image_name)
+        image_name = "{}.{}".format(
+            input_image.image_name, 'vrt' if vrt else 'TIF')
         output_image_path = os.path.join(output_folder, image_name)
         output_image = Image(output_image_path)
         command = command.format(
@@ -81,7 +108,8 @@ class Tiler:
     @classmethod
     def _generate_tms(
         self, image_path, output_folder="~/tms/",
-        nodata=[0, 0, 0], zoom=[2, 15], quiet=True
+        nodata=[0, 0, 0], zoom=[2, 15], quiet=True, progress=None,
+        shard=None, finalize=False
     ):
         """
         Generate TMS Pyramid for input Image instance
@@ -91,9 +119,12 @@ class Tiler:
             output_folder: folder for output pyramid
             nodata: nodata info, must be same number as source bands
             zoom: list of zoom levels ([start, end])
+            progress: callable receiving progress event dicts
+            shard: "i/N", write only the i-th of N subtree sets
+            finalize: build the top levels of a sharded pyramid
         """
         command = "gdal_tiler.py {quiet} -p tms --src-nodata {nodata} " +\
-            "--zoom={min_z}:{max_z} -t {path} {image}"
+            "--zoom={min_z}:{max_z} {progress}{shard}-t {path} {image}"
         str_nodata = ",".join(map(str, nodata))
 
         Util._print('Validating image and bands with nodata info...', quiet)
@@ -115,9 +146,18 @@ class Tiler:
             quiet=q_param, nodata=str_nodata,
             path=output_folder, image=image_path,
             min_z=zoom[0], max_z=zoom[1],
+            progress='--progress-json - ' if progress else '',
+            shard='--finalize ' if finalize else (
+                '--shard {} '.format(shard) if shard else ''),
         )
 
-        if not Util._subprocess(command):
+        if progress:
+            ok = Util._subprocess_lines(
+                command, Tiler.__progress_line(progress, quiet))
+        else:
+            ok = Util._subprocess(command)
+
+        if not ok:
             Util._print('Tiler process error: check log for more details.\n', quiet)
             return False
 
@@ -129,10 +169,14 @@ class Tiler:
     @classmethod
     def _generate_xml(
         self, image_path, naming_image,
-        link_base, output_folder="~/tms/", quiet=True
+        link_base, output_folder="~/tms/", quiet=True, tile_server=None
     ):
         """
         Generates XML for image on same path of image
+        params:
+            tile_server: tiles_server.py url, e.g. http://localhost:8080,
+                tiles are requested from it instead of link_base, it has
+                to serve the tms profile
         """
 
         Util._print("Getting info from image using gdalinfo...", quiet)
@@ -155,9 +199,15 @@ class Tiler:
         </TargetWindow>".format(
             upper_left[0], upper_left[1], lower_right[0], lower_right[1])
 
+        if tile_server:
+            server_url = tile_server.rstrip('/')
+        else:
+            server_url = "{0}/{1}.tms".format(
+                link_base, naming_image.image_name)
+
         tms_xml = "<GDAL_WMS>\n\
             <Service name=\"TMS\">\n\
-                <ServerUrl>{0}/{1}.tms/${{z}}/${{x}}/${{y}}.png</ServerUrl>\n\
+                <ServerUrl>{0}/${{z}}/${{x}}/${{y}}.png</ServerUrl>\n\
                 <SRS>EPSG:3857</SRS>\n\
                 <ImageFormat>image/png</ImageFormat>\n\
             </Service>\n\
@@ -166,12 +216,12 @@ class Tiler:
                 <UpperLeftY>20037508.34</UpperLeftY>\n\
                 <LowerRightX>20037508.34</LowerRightX>\n\
                 <LowerRightY>-20037508.34</LowerRightY>\n\
-                <TileLevel>{2}</TileLevel>\n\
+                <TileLevel>{1}</TileLevel>\n\
                 <TileCountX>1</TileCountX>\n\
                 <TileCountY>1</TileCountY>\n\
                 <YOrigin>bottom</YOrigin>\n\
             </DataWindow>\n\
-            {3}\n\
+            {2}\n\
             <Projection>EPSG:3857</Projection>\n\
             <BlockSizeX>256</BlockSizeX>\n\
             <BlockSizeY>256</BlockSizeY>\n\
@@ -179,11 +229,10 @@ class Tiler:
             <ZeroBlockHttpCodes>204,303,400,404,500,501</ZeroBlockHttpCodes>\n\
             <ZeroBlockOnServerException>true</ZeroBlockOnServerException>\n\
             <Cache>\n\
-                <Path>/tmp/cache_{4}.tms</Path>\n\
+                <Path>/tmp/cache_{3}.tms</Path>\n\
             </Cache>\n\
         </GDAL_WMS>".format(
-            link_base, naming_image.image_name,
-            15, target_window, naming_image.image_name
+            server_url, 15, target_window, naming_image.image_name
         )
 
         xml_name = naming_image.image_name + ".xml"
@@ -201,7 +250,8 @@ class Tiler:
     @staticmethod
     def make_tiles(
         image_path, link_base, output_folder="~/tms/",
-        zoom=[2, 15], nodata=[0, 0, 0], convert=True, quiet=True
+        zoom=[2, 15], nodata=[0, 0, 0], convert=True, quiet=True,
+        progress=None, shard=None, finalize=False, tile_server=None
     ):
         """
         Creates tiles for image using tilers-tools
@@ -213,17 +263,36 @@ class Tiler:
             zoom: list of zoom levels ([start, end])
             nodata: nodata info, must be same number as source bands
             convert: convert image to byte scale? Default is True
+            progress: callable receiving gdal_tiler.py progress events
+                as dicts ('start', 'raster', 'zoom_start', 'tiles',
+                'zoom_end', 'finish'); each has 'event', 'source' and
+                'time' keys, see tiler_progress.py
+            shard: "i/N" to write only the i-th of N disjoint subtree sets
+                of the pyramid, e.g. one per node on a shared filesystem
+            finalize: after all shards are done, build the top levels
+                and tilemap.json of a sharded pyramid
+            tile_server: tiles_server.py url for the XML, e.g.
+                http://localhost:8080, to render zoom levels beyond
+                the pre-rendered ones on demand; the XML describes a
+                TMS (bottom origin) service, so the server has to run
+                with the tms profile, its default
         returns:
             pyramid data and xml data on output folder for zoom levels
         """
         output_folder = Util._check_creation_folder(output_folder)
         input_image = Image(image_path)
 
+        # shards share the output folder, converted images are private
+        convert_folder = output_folder
+        if shard or finalize:
+            convert_folder = tempfile.mkdtemp()
+
         if convert:
             converted_image = Tiler.__convert_to_byte_scale(
                 input_image=input_image,
-                output_folder=output_folder,
-                quiet=quiet
+                output_folder=convert_folder,
+                quiet=quiet,
+                vrt=finalize  # only the geometry is used
             )
         else:
             converted_image = input_image
@@ -234,7 +303,10 @@ class Tiler:
                 output_folder=output_folder,
                 nodata=nodata,
                 zoom=zoom,
-                quiet=quiet
+                quiet=quiet,
+                progress=progress,
+                shard=shard,
+                finalize=finalize
             )
         except TMSError as tms_error:
             raise tms_error
@@ -247,7 +319,8 @@ class Tiler:
                 naming_image=input_image,
                 link_base=os.path.join(link_base, ""),
                 output_folder=output_folder,
-                quiet=quiet
+                quiet=quiet,
+                tile_server=tile_server
             )
         except XMLError as xml_error:
             raise xml_error
@@ -257,6 +330,8 @@ class Tiler:
         # Removing converted image file on output path
         if convert:
             converted_image.remove_file()
+        if convert_folder != output_folder:
+            shutil.rmtree(convert_folder, ignore_errors=True)
 
         tms_path = os.path.join(tms, converted_image.image_name + '.tms')
         xml_path = os.path.join(output_folder, xml)
@@ -265,3 +340,58 @@ class Tiler:
             tms_path, xml), quiet)
 
         return (tms_path, xml_path)
+
+    @staticmethod
+    def plan_tiles(
+        image_path, output_folder="~/tms/",
+        zoom=[2, 15], nodata=[0, 0, 0], convert=True, samples=16
+    ):
+        """
+        Estimates tiles for image without writing them (gdal_tiler.py --plan)
+        params:
+            image_path: path for image
+            output_folder: folder the pyramid would be written to
+            zoom: list of zoom levels ([start, end])
+            nodata: nodata info, must be same number as source bands
+            convert: estimate for a byte scaled image? Default is True
+                the scaling is done by a temporary VRT
+            samples: number of base tiles to warp and encode
+        returns:
+            dict with per zoom tile counts ('zooms'), total 'tiles',
+            encoded 'bytes', 'disk' usage and single core 'seconds'
+        """
+        if not Util._validate_image_bands(image_path, nodata):
+            raise TMSError(1, 'Input image is not a valid datasource, ' +
+                            'nodata length must be same as datasource bands')
+
+        temp_dir = tempfile.mkdtemp()
+        try:
+            source = image_path
+            if convert:
+                source = os.path.join(
+                    temp_dir, Image(image_path).image_name + ".vrt")
+                command = 'gdal_translate -q -of VRT -ot Byte -scale {0} {1}'
+                if not Util._subprocess(command.format(image_path, source)):
+                    raise TMSError(2, 'Convert process error')
+
+            command = "gdal_tiler.py -q -p tms --src-nodata {nodata} " +\
+                "--zoom={min_z}:{max_z} --plan --plan-samples {samples} " +\
+                "-t {path} {image}"
+            command = command.format(
+                nodata=",".join(map(str, nodata)),
+                min_z=zoom[0], max_z=zoom[1], samples=samples,
+                path=output_folder, image=source,
+            )
+
+            plans = []
+
+            def callback(line):
+                if line.startswith('{'):
+                    plans.append(json.loads(line))
+
+            if not Util._subprocess_lines(command, callback) or not plans:
+                raise TMSError(3, 'Tiler plan error: check log for more details')
+        finally:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+        return plans[0]
@@ -32,13 +32,18 @@ import json
 import tempfile
 import StringIO
 import struct
-from multiprocessing import Pool
+import hashlib
+import mmap
+from multiprocessing import Pool, Queue
+from Queue import Empty
 import itertools
+import fnmatch
 
 from PIL import Image
 #~ from PIL import WebPImagePlugin
 
 from tiler_functions import *
+from tiler_encode import open_tile, quantize_png, encode_webp
 from gdal_tiler import Pyramid
 
 #############################
@@ -84,6 +89,8 @@ class FileTile(Tile):
         if link and os.name == 'posix':
             dst_dir = os.path.split(dst)[0]
             src = os.path.relpath(self.path, dst_dir)
+            if os.path.lexists(dst): # replaced by --sync or --append
+                os.remove(dst)
             os.symlink(src, dst)
         else:
             shutil.copy(self.path, dst)
@@ -131,6 +138,147 @@ class PixBufTile(Tile):
         os.close(f_handle)
         return self.path
 
+#############################
+
+class ArenaTile(PixBufTile):
+    'tile data in a shared memory slot, see TileArena'
+#############################
+    def __init__(self, coord, slot, length, ext):
+        super(ArenaTile, self).__init__(coord, None)
+        self.slot = slot
+        self.length = length
+        self.ext = ext
+
+    def data(self):
+        if self.pixbuf is None:
+            self.pixbuf = tile_arena.read(self.slot, self.length)
+        return self.pixbuf
+
+    def get_ext(self):
+        if self.ext is None:
+            raise KeyError('Cannot determing image MIME type')
+        return self.ext
+
+    def copy2file(self, dest_path, link=False):
+        self.data()
+        super(ArenaTile, self).copy2file(dest_path, link)
+
+    def get_file(self):
+        self.data()
+        return super(ArenaTile, self).get_file()
+
+    def close_file(self):
+        if self.slot is not None:
+            tile_arena.release(self.slot)
+            self.slot = None
+            self.pixbuf = None
+        super(ArenaTile, self).close_file()
+
+#############################
+
+class TileArena(object):
+    '''Shared memory slots for tiles converted by the pool workers, only slot numbers are pickled'''
+#############################
+    slot_size = 256*1024
+
+    def __init__(self, nslots):
+        self.mem = mmap.mmap(-1, nslots*self.slot_size) # anonymous, shared with the forked workers
+        self.free = Queue()
+        for slot in range(nslots):
+            self.free.put(slot)
+
+    def share(self, tile):
+        'in a worker: tile data moved into a free slot, the tile as it is if it does not fit or there is no free slot'
+        if not isinstance(tile, PixBufTile):
+            return tile
+        data = tile.data()
+        if len(data) > self.slot_size:
+            return tile
+        try:
+            slot = self.free.get_nowait()
+        except Empty:
+            return tile
+        try:
+            ext = tile.get_ext()
+        except KeyError:
+            ext = None
+        offset = slot*self.slot_size
+        self.mem[offset:offset+len(data)] = data
+        return ArenaTile(tile.coord(), slot, len(data), ext)
+
+    def read(self, slot, length):
+        'tile data in place, valid until the slot is released; mmap has no memoryview in Python 2, buffer() is not a copy'
+        return buffer(self.mem, slot*self.slot_size, length)
+
+    def release(self, slot):
+        self.free.put(slot)
+
+#############################
+
+class SyncManifest(object):
+    '''Size, mtime and content hash of the tiles synced into a destination'''
+#############################
+    batch_size = 1000
+
+    def __init__(self, path):
+        import sqlite3
+
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.text_factory = str
+        self.pending = []
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS tiles ('
+                'zoom INTEGER, x INTEGER, y INTEGER, '
+                'size INTEGER, mtime REAL, hash TEXT, ext TEXT, '
+                'PRIMARY KEY (zoom, x, y));'
+            )
+
+    def get(self, coord):
+        'recorded (size, mtime, hash, ext) of a tile, None if it is not synced yet'
+        return self.db.execute('SELECT size, mtime, hash, ext FROM tiles WHERE zoom=? AND x=? AND y=?',
+            coord).fetchone()
+
+    def put(self, coord, size, mtime, digest, ext):
+        self.pending.append(tuple(coord) + (size, mtime, digest, ext))
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        with self.db:
+            self.db.executemany('INSERT OR REPLACE INTO tiles (zoom, x, y, size, mtime, hash, ext) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?);', self.pending)
+        self.pending = []
+
+    def remove(self, coords):
+        self.flush()
+        with self.db:
+            self.db.executemany('DELETE FROM tiles WHERE zoom=? AND x=? AND y=?', coords)
+
+    def coords(self):
+        self.flush()
+        return [tuple(row) for row in self.db.execute('SELECT zoom, x, y FROM tiles')]
+
+    def zoom_levels(self):
+        'tile bounds per zoom, as in TileSet.zoom_levels'
+        self.flush()
+        return dict((z, [[z, xmin, ymin], [z, xmax, ymax]]) for z, xmin, ymin, xmax, ymax in
+            self.db.execute('SELECT zoom, min(x), min(y), max(x), max(y) FROM tiles GROUP BY zoom'))
+
+    def tile_ext(self):
+        row = self.db.execute('SELECT ext FROM tiles WHERE ext IS NOT NULL LIMIT 1').fetchone()
+        return row[0] if row else None
+
+    def close(self):
+        self.flush()
+        self.db.execute('PRAGMA journal_mode=DELETE')
+        self.db.close()
+# SyncManifest
+
 #----------------------------
 
 tile_converters = []
@@ -176,80 +324,43 @@ tile_converters.append(TileConverter)
 
 #############################
 
-class ShellConverter (TileConverter):
-
-#############################
-    prog_name = None
-
-    def __init__(self, options):
-        super(ShellConverter, self).__init__(options)
-        self.dst_dir = tempfile.gettempdir()
-
-        if self.prog_name:
-            try: # check if converter programme is available
-                prog_path = command(['which', self.prog_name]).strip()
-            except:
-                raise Exception('Can not find %s executable' % self.prog_name)
-
-    def convert_tile(self, src_tile):
-
-        src_path = src_tile.get_file()
-        #~ ld('convert_tile', src_path)
-        base_name = os.path.splitext(os.path.split(src_path)[1])[0]
-        dst_dir = tempfile.gettempdir()
-        coord = src_tile.coord()
-        suffix = ('-%d-%d-%d' % coord) + self.dst_ext
-        dst_path = os.path.join(dst_dir, base_name + suffix)
-
-        self.call_converter(src_path, dst_path, suffix)
-
-        src_tile.close_file()
-        dst_tile = FileTile(coord, dst_path, temp=True)
-        return dst_tile
-
-#############################
-
-class PngConverter (ShellConverter):
-    'optimize png using pngnq utility'
+class PngConverter (TileConverter):
+    'optimize png: quantize to a palette (as pngnq)'
 #############################
     profile_name = 'pngnq'
-    prog_name = 'pngnq'
-    dst_ext = '-nq8.png'
+    dst_ext = '.png'
     src_formats = ('.png',)
 
-    def call_converter(self, src, dst, suffix):
-
-        command(['pngnq', '-f', '-n', self.options.colors, '-e', suffix, '-d', self.dst_dir, src])
+    def convert_tile(self, tile):
+        data = quantize_png(open_tile(tile.data()), self.options.colors or 256)
+        return PixBufTile(tile.coord(), data, dataType='image/png')
 
 tile_converters.append(PngConverter)
 
 #############################
 
-class WebpConverter (ShellConverter):
+class WebpConverter (TileConverter):
     'convert to webp'
 #############################
     profile_name = 'webp'
     dst_ext = '.webp'
     src_formats = ('.png','.jpg','.jpeg','.gif')
+    noalpha = False
 
-    def call_converter(self, src, dst, suffix):
-
-        command(['cwebp', '-alpha_cleanup', '-q', str(self.options.quality), '-o', dst, src])
+    def convert_tile(self, tile):
+        data = encode_webp(open_tile(tile.data()), self.options.quality or 75,
+            alpha_cleanup=True, noalpha=self.noalpha)
+        return PixBufTile(tile.coord(), data, dataType='image/webp')
 
 tile_converters.append(WebpConverter)
 
 #############################
 
-class WebpNoAlphaConverter (ShellConverter):
+class WebpNoAlphaConverter (WebpConverter):
     'convert to webp; discard alpha channel'
 #############################
     profile_name = 'webp-noalpha'
-    dst_ext = '.webp'
-    src_formats = ('.png','.jpg','.jpeg','.gif')
-
-    def call_converter(self, src, dst, suffix):
-
-        command(['cwebp', '-preset', 'drawing', '-noalpha', '-q', str(self.options.quality), '-o', dst, src])
+    noalpha = True
 
 tile_converters.append(WebpNoAlphaConverter)
 
@@ -298,12 +409,23 @@ tile_converters.append(JpegConverter)
 tileset_profiles = []
 
 tile_converter = None
+tile_store = None # destination tile set, workers store tiles into it
+tile_arena = None # shared memory for tiles sent back from the workers
 
 def global_converter(tile):
     #~ log('tile', tile.coord())
     tile = tile_converter(tile)
+    if tile is not None and tile_arena:
+        tile = tile_arena.share(tile)
     return tile
 
+def global_store(tile):
+    if tile_converter:
+        tile = tile_converter(tile)
+    if tile is None:
+        return None
+    return tile_store.store(tile)
+
 #############################
 
 class TileSet(object):
@@ -312,6 +434,11 @@ class TileSet(object):
 
     #~ tile_converter = None
     pool = None
+    parallel_store = False # store_tile() can run in worker processes at once
+    store_batch = 64 # tiles sent to a worker at once
+    convert_batch = 10
+    can_sync = True # tiles can be replaced and removed in place, see remove_tile()
+    manifest = None
 
     def __init__(self, root=None, options=None, src=None):
         options = LooseDict(options)
@@ -326,6 +453,7 @@ class TileSet(object):
         self.options.tiles_srs = self.srs
 
         self.zoom_levels = {}
+        self.tile_ranges = {}
         self.pyramid = Pyramid.profile_class('generic')(options=options)
 
         if not self.options.isDest:
@@ -346,20 +474,27 @@ class TileSet(object):
                 suffix = self.ext if self.ext != src.ext else self.ext + '0'
                 self.root = os.path.join(options.dst_dir, self.name + suffix)
 
+            manifest_path = self.root + '.manifest.db'
             if os.path.exists(self.root):
                 if self.options.remove_dest:
                     if os.path.isdir(self.root):
                         shutil.rmtree(self.root, ignore_errors=True)
                     else:
                         os.remove(self.root)
+                    if os.path.exists(manifest_path):
+                        os.remove(manifest_path)
                 else:
-                    assert self.options.append, 'Destination already exists: %s' % root
+                    assert self.options.append or self.options.sync, 'Destination already exists: %s' % root
+
+            if self.options.sync:
+                assert self.can_sync, 'Incremental sync is not supported for %s' % self.format
+                self.manifest = SyncManifest(manifest_path)
+                self.sync_seen = set()
+                self.sync_pending = {}
 
             if self.options.convert_tile:
                 global tile_converter
                 tile_converter = TileConverter.get_class(self.options.convert_tile)(options)
-                if not (self.options.nothreads or self.options.debug):
-                    self.pool = Pool()
 
     @staticmethod
     def get_class(profile, isDest=False):
@@ -384,7 +519,28 @@ class TileSet(object):
             return False
         if not self.pyramid:
             return True
-        return self.pyramid.in_range(ul_coords, lr_coords)
+        if not lr_coords:
+            lr_coords = ul_coords
+        zoom, xmin, ymin = ul_coords
+        zoom, xmax, ymax = lr_coords
+        bounds = self.tile_range(zoom)
+        if bounds is None:
+            return False
+        zoom_xmin, zoom_xmax, zoom_ymin, zoom_ymax = bounds
+        return not (
+            xmin > zoom_xmax or xmax < zoom_xmin or
+            ymin > zoom_ymax or ymax < zoom_ymin
+            )
+
+    range_zooms = 32 # zoom levels with tile ranges if none are set
+
+    def tile_range(self, zoom):
+        'tile bounds (xmin, xmax, ymin, ymax) of a zoom, None if it is out of range; computed once for all zooms'
+        if not self.tile_ranges:
+            zooms = self.pyramid.zoom_range or range(self.range_zooms)
+            self.tile_ranges = dict((z, (xmin, xmax, ymin, ymax))
+                for z, ((z, xmin, ymin), (z, xmax, ymax)) in zip(zooms, self.pyramid.corner_tiles_lst(zooms)))
+        return self.tile_ranges.get(zoom)
 
     def __del__(self):
         log('self.count', self.count)
@@ -395,51 +551,138 @@ class TileSet(object):
     def convert(self):
         pf('%s -> %s ' % (self.src.root, self.root), end='')
 
-        if self.pool:
-            src = self.pool.imap_unordered(global_converter, self.src, chunksize=10)
-        elif self.options.convert_tile:
-            src = itertools.imap(global_converter, self.src)
-        else:
-            src = self.src
+        src_tiles = self.sync_tiles(self.src) if self.manifest else self.src
+        parallel = not (self.options.nothreads or self.options.debug)
+        if parallel and self.parallel_store: # convert and store in the workers
+            global tile_store
+            tile_store = self
+            self.pool = Pool()
+            stored = self.pool_imap(global_store, src_tiles, self.store_batch)
+        else: # store in this process
+            if parallel and self.options.convert_tile:
+                global tile_arena
+                try: # slots for the batches being converted and the ones waiting to be stored
+                    tile_arena = TileArena(cpu_count()*self.convert_batch*2)
+                except EnvironmentError: # converted tiles are pickled back
+                    tile_arena = None
+                self.pool = Pool()
+                src = self.pool_imap(global_converter, src_tiles, self.convert_batch)
+            elif self.options.convert_tile:
+                src = itertools.imap(global_converter, src_tiles)
+            else:
+                src = src_tiles
+            stored = (self.store(tile) for tile in src if tile is not None)
 
-        for tile in src:
-            if tile is not None:
-                self.process_tile(tile)
+        for res in stored:
+            if res is not None:
+                self.tile_stored(*res)
 
         if self.pool:
             self.pool.close()
             self.pool.join()
 
-        if self.count > 0:
+        removed = self.sync_removed() if self.manifest else 0
+
+        if (self.count > 0 or removed) and self.zoom_levels:
             self.finalize_pyramid()
             self.finalize_tileset()
         else:
             pf('No tiles converted', end='')
         pf('')
 
-    def process_tile(self, tile):
-        log('process_tile', tile)
-        self.store_tile(tile)
-        self.counter()
-
-        # collect min max values for tiles processed
-        zxy = list(tile.coord())
-        z = zxy[0]
-
-        min_max = self.zoom_levels.get(z, []) # min, max
-        zzz, xxx, yyy = zip(*(min_max+[zxy]))
-        self.zoom_levels[z] = [[z, min(xxx), min(yyy)], [z, max(xxx), max(yyy)]]
+    def pool_imap(self, func, tiles, chunksize):
+        '''pool.imap_unordered() over the tiles read in this thread (database sources are bound to it),
+        a window of chunks at a time while the previous one is being processed'''
+        tiles = iter(tiles)
+        window = chunksize*cpu_count()*2
+        running = None
+        while True:
+            batch = list(itertools.islice(tiles, window))
+            queued = self.pool.imap_unordered(func, batch, chunksize=chunksize) if batch else None
+            if running is not None:
+                for res in running:
+                    yield res
+            if queued is None:
+                break
+            running = queued
+
+    def store(self, tile):
+        'store a tile, runs in a worker process if parallel_store is set'
+        log('store', tile)
+        tile_ext = self.store_tile(tile)
         tile.close_file()
+        return tile.coord(), tile_ext
+
+    def tile_stored(self, coord, tile_ext=None):
+        self.counter()
+        if tile_ext:
+            self.tile_ext = tile_ext
+        if self.manifest:
+            self.manifest.put(coord, *self.sync_pending.pop(coord), ext=tile_ext)
+
+        # running min max values of tiles processed
+        z, x, y = coord
+        min_max = self.zoom_levels.get(z)
+        if min_max is None:
+            self.zoom_levels[z] = [[z, x, y], [z, x, y]]
+        else:
+            lo, hi = min_max
+            lo[1] = min(lo[1], x)
+            lo[2] = min(lo[2], y)
+            hi[1] = max(hi[1], x)
+            hi[2] = max(hi[2], y)
+
+    def sync_tiles(self, tiles):
+        'new and changed tiles only, compared by size and mtime first, then by content hash'
+        for tile in tiles:
+            coord = tile.coord()
+            self.sync_seen.add(coord)
+            known = self.manifest.get(coord)
+            if isinstance(tile, FileTile):
+                st = os.stat(tile.path)
+                size, mtime = st.st_size, st.st_mtime
+                if known and (size, mtime) == tuple(known[:2]):
+                    continue
+                data = tile.data()
+            else: # no mtime in the databases
+                data = tile.data()
+                size, mtime = len(data), None
+            digest = hashlib.md5(data).hexdigest()
+            if known and known[2] == digest: # touched only
+                if mtime != known[1]:
+                    self.manifest.put(coord, size, mtime, digest, known[3])
+                continue
+            self.sync_pending[coord] = (size, mtime, digest)
+            yield tile
+
+    def sync_removed(self):
+        'remove tiles gone from the source range, zoom levels taken from the whole synced set'
+        removed = [coord for coord in self.manifest.coords()
+            if coord not in self.sync_seen and self.src.in_range(coord)]
+        for coord in removed:
+            log('remove', coord)
+            self.remove_tile(coord)
+        self.manifest.remove(removed)
+        self.zoom_levels = self.manifest.zoom_levels()
+        self.tile_ext = getattr(self, 'tile_ext', None) or self.manifest.tile_ext()
+        self.manifest.close()
+        if removed:
+            pf(' %d removed' % len(removed), end='')
+        return len(removed)
+
+    def remove_tile(self, coord): # to be defined by a child
+        raise Exception('Not implemented!')
 
     def finalize_pyramid(self):
         log('self.zoom_levels', self.zoom_levels)
 
         # compute "effective" covered area
+        zooms = list(reversed(sorted(self.zoom_levels)))
+        bounds = self.pyramid.tile_bounds_lst(flatten(self.zoom_levels[z] for z in zooms))
         prev_sq = 0
-        for z in reversed(sorted(self.zoom_levels)):
-            ul_zxy, lr_zxy = self.zoom_levels[z]
-            ul_c = self.pyramid.tile_bounds(ul_zxy)[0]
-            lr_c = self.pyramid.tile_bounds(lr_zxy)[1]
+        for z, ul_box, lr_box in zip(zooms, bounds[0::2], bounds[1::2]):
+            ul_c = ul_box[0]
+            lr_c = lr_box[1]
             sq = (lr_c[0]-ul_c[0])*(ul_c[1]-lr_c[1])
             area_diff = round(prev_sq/sq, 5)
             log('ul_c, lr_c', z, ul_c, lr_c, sq, area_diff)
@@ -474,6 +717,7 @@ class TileDir(TileSet):
 
 #############################
     tile_class = FileTile
+    parallel_store = True # a file per tile
 
     def __init__(self, *args, **kw_args):
         super(TileDir, self).__init__(*args, **kw_args)
@@ -484,11 +728,42 @@ class TileDir(TileSet):
             except os.error: pass
 
     def __iter__(self):
-        for f in glob.iglob(os.path.join(self.root, self.dir_pattern)):
+        for f in self.scan_dir(self.root, [], self.dir_pattern.split('/')):
             coord = self.path2coord(f)
-            if not self.in_range(coord):
+            if self.in_range(coord):
+                yield self.tile_class(coord, f)
+
+    def scan_dir(self, dir_path, names, pattern):
+        'paths matching dir_pattern, directories out of range are not entered'
+        level = len(names)
+        for entry in scandir(dir_path):
+            if not fnmatch.fnmatch(entry.name, pattern[level]):
                 continue
-            yield self.tile_class(coord, f)
+            if level == len(pattern)-1: # tile files
+                yield entry.path
+            elif entry.is_dir() and self.dir_in_range(names+[entry.name], pattern):
+                for f in self.scan_dir(entry.path, names+[entry.name], pattern):
+                    yield f
+
+    def dir_in_range(self, names, pattern):
+        'check coordinates fixed by a directory path against the tile ranges'
+        try:
+            probes = [self.probe_coord(names, pattern, value) for value in ('0', '1')]
+        except (ValueError, IndexError):
+            return True
+        z, x, y = [a if a == b else None for a, b in zip(*probes)] # the same for any file below
+        if z is None:
+            return True
+        bounds = self.tile_range(z)
+        if bounds is None:
+            return False
+        xmin, xmax, ymin, ymax = bounds
+        return (x is None or xmin <= x <= xmax) and (y is None or ymin <= y <= ymax)
+
+    def probe_coord(self, names, pattern, value):
+        'path2coord() of a path under a directory, the rest of dir_pattern filled with a value'
+        rest = [p.replace('[0-9]*', value).replace('*', value) for p in pattern[len(names):]]
+        return self.path2coord(os.path.join(self.root, *(names+rest)))
 
     def path2coord(self, tile_path):
         raise Exception('Unimplemented!')
@@ -509,8 +784,13 @@ class TileDir(TileSet):
         log('%s -> %s' % (tile.path, dest_path))
         try:
             os.makedirs(os.path.split(dest_path)[0])
-        except os.error: pass
+        except os.error: pass # may be made by another worker
         tile.copy2file(dest_path, self.options.link)
+        return tile_ext
+
+    def remove_tile(self, coord):
+        for f in glob.glob(os.path.join(self.root, self.coord2path(*coord)) + '.*'): # whatever type was stored
+            os.remove(f)
 # TileDir
 
 #############################
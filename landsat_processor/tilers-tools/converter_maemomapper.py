@@ -32,15 +32,21 @@ class MapperSQLite(TileSet):
 #############################
     format, ext, input, output = 'mapper', '.db', True, True
     max_zoom = 20
+    batch_size = 1000 # tiles written in a transaction
+    buffer_size = 32*1024*1024 # pending tile data limit, bytes
 
-    def __init__(self, root, options=None):
-        super(MapperSQLite, self).__init__(root, options)
+    def __init__(self, root=None, options=None, src=None):
+        super(MapperSQLite, self).__init__(root, options, src)
 
         import sqlite3
 
         self.db = sqlite3.connect(self.root)
         self.dbc = self.db.cursor()
+        self.pending = []
+        self.pending_size = 0
         if self.options.isDest:
+            self.dbc.execute('PRAGMA journal_mode=%s' % (self.options.sqlite_journal or 'WAL'))
+            self.dbc.execute('PRAGMA synchronous=%s' % (self.options.sqlite_sync or 'NORMAL'))
             try:
                 self.dbc.execute (
                     'CREATE TABLE maps ('
@@ -54,24 +60,50 @@ class MapperSQLite(TileSet):
                 pass
 
     def finalize_tileset(self):
-        self.db.commit()
+        self.flush()
+        self.db.commit() # removed tiles
+        self.dbc.execute('PRAGMA journal_mode=DELETE') # leave a single self-contained file
         self.db.close()
 
     def __iter__(self):
-        self.dbc.execute('SELECT * FROM maps')
-        for z, x, y, pixbuf in self.dbc:
-            coord = self.max_zoom+1-z, x, y
-            if not self.in_range(coord):
+        zooms = [z for (z,) in self.db.execute('SELECT DISTINCT zoom FROM maps')]
+        for z in sorted(zooms, reverse=True): # from the lowest tile zoom
+            coord_z = self.max_zoom+1-z
+            bounds = self.tile_range(coord_z)
+            if bounds is None:
                 continue
-            yield PixBufTile(coord, str(pixbuf), (z, x, y))
+            xmin, xmax, ymin, ymax = bounds
+            self.dbc.execute('SELECT tilex, tiley, pixbuf FROM maps '
+                'WHERE zoom=? AND tilex BETWEEN ? AND ? AND tiley BETWEEN ? AND ? ORDER BY tilex, tiley',
+                (z, xmin, xmax, ymin, ymax))
+            for x, y, pixbuf in self.dbc:
+                yield PixBufTile((coord_z, x, y), str(pixbuf), (z, x, y))
 
     def store_tile(self, tile):
         z, x, y = tile.coord()
         # convert to maemo-mapper coords
         z = self.max_zoom+1-z
         log('%s -> SQLite %d, %d, %d' % (tile.path, z, x, y))
-        self.dbc.execute('INSERT OR REPLACE INTO maps (zoom, tilex, tiley, pixbuf) VALUES (?, ?, ?, ?);',
-            (z, x, y, buffer(tile.data())))
+        data = bytes(tile.data()) # kept past close_file(), a converted tile's slot is reused then
+        self.pending.append((z, x, y, buffer(data)))
+        self.pending_size += len(data)
+        if len(self.pending) >= self.batch_size or self.pending_size >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        'write pending tiles in a transaction'
+        if not self.pending:
+            return
+        with self.db:
+            self.db.executemany('INSERT OR REPLACE INTO maps (zoom, tilex, tiley, pixbuf) VALUES (?, ?, ?, ?);',
+                self.pending)
+        self.pending = []
+        self.pending_size = 0
+
+    def remove_tile(self, coord):
+        z, x, y = coord
+        self.flush()
+        self.dbc.execute('DELETE FROM maps WHERE zoom=? AND tilex=? AND tiley=?', (self.max_zoom+1-z, x, y))
 
 tileset_profiles.append(MapperSQLite)
 
@@ -85,16 +117,16 @@ class MapperGDBM(TileSet): # due to GDBM weirdness on ARM this only works if run
     format, ext, input, output = 'gdbm', '.gdbm', True, True
     max_zoom = 20
 
-    def __init__(self, root, options=None):
+    def __init__(self, root=None, options=None, src=None):
 
-        super(MapperGDBM, self).__init__(root, options)
+        super(MapperGDBM, self).__init__(root, options, src)
         #print self.root
 
         import platform
         assert platform.machine().startswith('arm'), 'This convertion works only on a Nokia tablet'
 
         import gdbm
-        self.db = gdbm.open(self.root, 'cf' if write else 'r')
+        self.db = gdbm.open(self.root, 'cf' if self.options.isDest else 'r')
 
         self.key = struct.Struct('>III')
 
@@ -107,9 +139,8 @@ class MapperGDBM(TileSet): # due to GDBM weirdness on ARM this only works if run
         while key:
             z, x, y = self.key.unpack(key)
             coord = self.max_zoom+1-z, x, y
-            if not self.in_range(coord):
-                continue
-            yield PixBufTile(coord, self.db[key], (z, x, y))
+            if self.in_range(coord):
+                yield PixBufTile(coord, self.db[key], (z, x, y))
             key = self.db.nextkey(key)
 
     def store_tile(self, tile):
@@ -120,5 +151,12 @@ class MapperGDBM(TileSet): # due to GDBM weirdness on ARM this only works if run
         key = self.key.pack(z, x, y)
         self.db[key] = tile.data()
 
+    def remove_tile(self, coord):
+        z, x, y = coord
+        try:
+            del self.db[self.key.pack(self.max_zoom+1-z, x, y)]
+        except KeyError:
+            pass
+
 tileset_profiles.append(MapperGDBM)
 # MapperGDBM
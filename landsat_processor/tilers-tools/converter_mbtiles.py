@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+###############################################################################
+# Copyright (c) 2011-2013 Vadim Shlyakhov
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a
+#  copy of this software and associated documentation files (the "Software"),
+#  to deal in the Software without restriction, including without limitation
+#  the rights to use, copy, modify, merge, publish, distribute, sublicense,
+#  and/or sell copies of the Software, and to permit persons to whom the
+#  Software is furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included
+#  in all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+#  OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+#  THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#  DEALINGS IN THE SOFTWARE.
+###############################################################################
+
+from converter_backend import *
+from tiler_store import MBTiles
+
+#############################
+
+class MBTilesSet(TileSet): # https://github.com/mapbox/mbtiles-spec
+    'MBTiles SQLite file'
+#############################
+    format, ext, input, output = 'mbtiles', '.mbtiles', True, True
+    tile_ext = None
+
+    def __init__(self, root=None, options=None, src=None):
+        super(MBTilesSet, self).__init__(root, options, src)
+        self.db = self.open_db()
+
+    def open_db(self):
+        db = MBTiles(self.root, write=self.options.isDest,
+            journal_mode=self.options.sqlite_journal or 'WAL',
+            synchronous=self.options.sqlite_sync or 'NORMAL')
+        db.prune = bool(self.options.sync) # replaced images are left unreferenced
+        return db
+
+    def finalize_tileset(self):
+        prm = self.pyramid
+        (west, north), (east, south) = prm.bounds_lst2longlat([prm.bounds])[0]
+        zooms = sorted(self.zoom_levels)
+        ext = self.tile_ext[1:] if self.tile_ext else 'png'
+        self.db.set_metadata({
+            'name':         self.name,
+            'description':  self.options.description or '',
+            'type':         'overlay' if self.options.overlay else 'baselayer',
+            'version':      '1.1',
+            'format':       'jpg' if ext == 'jpeg' else ext,
+            'bounds':       '%.9f,%.9f,%.9f,%.9f' % (west, south, east, north),
+            'center':       '%.9f,%.9f,%d' % ((west+east)/2, (north+south)/2, zooms[0]),
+            'minzoom':      zooms[0],
+            'maxzoom':      zooms[-1],
+            })
+        self.db.close()
+
+    def __iter__(self):
+        for z in self.db.zoom_levels():
+            bounds = self.tile_range(z)
+            if bounds is None:
+                continue
+            xmin, xmax, ymin, ymax = bounds
+            top = 2**z-1 # MBTiles rows go upwards
+            for x, row, data in self.db.get_tiles(z, (xmin, xmax), (top-ymax, top-ymin)):
+                yield PixBufTile((z, x, top-row), str(data))
+
+    def store_tile(self, tile):
+        z, x, y = tile.coord()
+        log('%s -> %s %d, %d, %d' % (tile.path, self.format, z, x, y))
+        self.db.put_tile(self.db_tile(z, x, y), tile.data())
+        try:
+            return tile.get_ext()
+        except KeyError:
+            return None
+
+    def remove_tile(self, coord):
+        self.db.delete_tile(self.db_tile(*coord))
+
+    def db_tile(self, z, x, y):
+        return (z, x, 2**z-1-y)
+
+tileset_profiles.append(MBTilesSet)
+# MBTilesSet
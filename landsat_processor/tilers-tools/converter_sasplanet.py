@@ -76,26 +76,35 @@ class SASBerkeley(TileDir):
                 yield PixBufTile(coord, tile, path)
 
     def iter_tiles(self, db_path):
-        zoom = self.get_zoom(db_path) # also checks data in range
-        if not zoom:
+        block = self.get_block(db_path) # also checks data in range
+        if not block:
             return
+        zoom, x_min, y_min = block
+        xmin, xmax, ymin, ymax = self.tile_range(zoom)
+        ranges = morton_ranges( # keys of the tiles in range
+            max(xmin, x_min), min(xmax, x_min | 0xFF),
+            max(ymin, y_min), min(ymax, y_min | 0xFF),
+            x_min, y_min, 0x100)
         d = self.db.DB()
         d.open(db_path, '', self.db.DB_BTREE, self.db.DB_RDONLY)
         c = d.cursor()
-        item = c.first(dlen=0, doff=0)
-        while item:
-            key = item[0]
-            coord = self.get_coord(zoom, key)
-            if self.in_range(coord):
+        for k_min, k_max in ranges: # keys are big endian, so the B-tree goes in the key order
+            item = c.set_range(self.key.pack(k_min), dlen=0, doff=0)
+            while item:
+                key = item[0]
+                coord = self.get_coord(zoom, key)
+                if coord is None or self.key.unpack(key)[0] > k_max:
+                    break
                 data = c.current()[1]
                 tile = self.get_image(data)
                 if tile:
                     log('tile', coord)
                     yield coord, tile, [db_path, key]
-            item = c.next(dlen=0, doff=0)
+                item = c.next(dlen=0, doff=0)
         d.close()
 
-    def get_zoom(self, db_path): # u_TileFileNameBerkeleyDB
+    def get_block(self, db_path): # u_TileFileNameBerkeleyDB
+        'zoom and the upper left tile of 256x256 tiles in a file, None if out of range'
         z, x10, y10, xy8 = path2list(db_path)[-5:-1]
         zoom = int(z[1:]) - 1
         x_min, y_min = [int(d) << 8 for d in xy8.split('.')]
@@ -103,21 +112,15 @@ class SASBerkeley(TileDir):
 
         if not self.in_range((zoom, x_min, y_min), (zoom, x_max, y_max)):
             return None
-            pass
-        log('get_zoom', zoom, x_min, x_max, y_min, y_max,db_path)
-        return zoom
+        log('get_block', zoom, x_min, x_max, y_min, y_max,db_path)
+        return zoom, x_min, y_min
 
     def get_coord(self, zoom, key): # u_BerkeleyDBKey.pas TBerkeleyDBKey.PointToKey
         if key == '\xff\xff\xff\xff\xff\xff\xff\xff':
             return None
         kxy = self.key.unpack(key)[0] # swaps bytes
-        xy = [0, 0]
-        for bit_n in range(64): # bits for x and y are interleaved in the key
-            x0y1 = bit_n % 2 # x, y
-            xy[x0y1] += (kxy >> bit_n & 1) << (bit_n - x0y1) / 2
-
-        coord = [zoom] + xy
-        #~ log('get_coord', coord, zoom, key, hex(kxy), hex(xy[0]), hex(xy[1]))
+        coord = [zoom] + morton_decode(kxy)
+        #~ log('get_coord', coord, zoom, key, hex(kxy))
         return coord
 
     def get_image(self, data): # u_BerkeleyDBValue
@@ -146,3 +149,51 @@ class SASBerkeley(TileDir):
 tileset_profiles.append(SASBerkeley)
 
 # SASBerkeley
+
+# bits for x and y are interleaved in the keys: x in the even bits, y in the odd ones
+
+def spread_bits(byte):
+    'bits of a byte to the even bits of a 16 bit word'
+    return sum(((byte >> i) & 1) << (2*i) for i in range(8))
+
+def gather_bits(word):
+    'even bits of a word, packed'
+    return sum(((word >> (2*i)) & 1) << i for i in range(8))
+
+morton_spread = [spread_bits(i) for i in range(0x100)]
+morton_gather = [(gather_bits(i) & 0xF, gather_bits(i >> 1) & 0xF) for i in range(0x100)] # key byte: x, y nibbles
+
+def morton_encode(x, y):
+    key = 0
+    for shift in (24, 16, 8, 0):
+        key = (key << 16) | morton_spread[(x >> shift) & 0xFF] | (morton_spread[(y >> shift) & 0xFF] << 1)
+    return key
+
+def morton_decode(key):
+    'key to [x, y]'
+    x = y = 0
+    for shift in (56, 48, 40, 32, 24, 16, 8, 0):
+        kx, ky = morton_gather[(key >> shift) & 0xFF]
+        x = (x << 4) | kx
+        y = (y << 4) | ky
+    return [x, y]
+
+def morton_ranges(xmin, xmax, ymin, ymax, x0, y0, size):
+    'merged (min, max) key ranges of the tiles in a rectangle, within an aligned square of size tiles'
+    ranges = []
+    def cover(x0, y0, size):
+        if x0 > xmax or x0+size-1 < xmin or y0 > ymax or y0+size-1 < ymin:
+            return
+        if xmin <= x0 and x0+size-1 <= xmax and ymin <= y0 and y0+size-1 <= ymax: # the whole square
+            k_min = morton_encode(x0, y0)
+            k_max = k_min + size*size - 1
+            if ranges and ranges[-1][1]+1 == k_min:
+                ranges[-1][1] = k_max
+            else:
+                ranges.append([k_min, k_max])
+            return
+        half = size // 2
+        for dx, dy in ((0, 0), (half, 0), (0, half), (half, half)): # in the key order
+            cover(x0+dx, y0+dy, half)
+    cover(x0, y0, size)
+    return ranges
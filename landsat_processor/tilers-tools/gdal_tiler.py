@@ -27,6 +27,8 @@ from optparse import OptionParser
 
 from tiler_functions import *
 from tiler_backend import Pyramid, resampling_lst, base_resampling_lst
+from tiler_footprint import footprint_methods
+from tiler_store import TileStore
 import tiler_global_mercator
 import tiler_plate_carree
 import tiler_misc
@@ -48,27 +50,45 @@ def preprocess_src(src):
 
 #----------------------------
 
-def process_src(src_def):
-
+def tiling_options(options):
+    'pyramid options from the command line ones'
 #----------------------------
-    global options
     opt = LooseDict(options)
     opt.tile_format = opt.tile_format.lower()
     opt.tile_ext = '.' + opt.tile_format
+    if opt.opaque_format:
+        opt.opaque_format = opt.opaque_format.lower()
+        opt.opaque_ext = '.' + opt.opaque_format
+    return opt
+
+#----------------------------
+
+def process_src(src_def):
+
+#----------------------------
+    global options
+    opt = tiling_options(options)
     src, delete_src = src_def
     opt.delete_src = delete_src
 
     profile = Pyramid.profile_class(opt.profile)
-    ext = profile.defaul_ext if opt.strip_dest_ext is None else ''
+    ext = TileStore.get_class(opt.tile_store).dest_ext(profile.defaul_ext)
+    if opt.strip_dest_ext is not None and TileStore.get_class(opt.tile_store).files:
+        ext = ''
     dest = dest_path(src, opt.dest_dir, ext)
 
     prm = profile(src, dest, opt)
+    if opt.plan:
+        plan = prm.plan_pyramid()
+        if plan:
+            pf(json.dumps(plan, sort_keys=True)) # a line per source
+        return
     prm.walk_pyramid()
 
 #----------------------------
 
-def parse_args(arg_lst):
-
+def option_parser():
+    'command line options, shared with tiles_server.py'
 #----------------------------
     parser = OptionParser(
         usage = "usage: %prog <options>... source...",
@@ -107,24 +127,68 @@ def parse_args(arg_lst):
         help='match OGR feature field "Name" against source name')
     parser.add_option("--cutline-blend", dest="blend_dist", default=None, metavar="N",
         help='CUTLINE_BLEND_DIST in pixels')
+    parser.add_option("--footprint", default=None, metavar="METHOD",
+        choices=footprint_methods,
+        help='skip tiles outside of a valid data footprint: %s (default: none)' % ', '.join(footprint_methods))
+    parser.add_option("--mtl", default=None, metavar="MTL_FILE",
+        help='Landsat MTL metadata for a footprint (default: <scene>_MTL.txt next to the source)')
     parser.add_option("--src-nodata", dest="src_nodata", metavar='N[,N]...',
         help='Nodata values for input bands')
     parser.add_option("--dst-nodata", dest="dst_nodata", metavar='N',
         help='Assign nodata value for output paletted band')
+    parser.add_option("--warp-threads", type="int", default=None, metavar="N",
+        help='warper threads (default: cores divided by parallel jobs)')
+    parser.add_option("--warp-memory", type="float", default=None, metavar="MB",
+        help='warper memory limit (default: derived from the memory budget)')
+    parser.add_option("--warp-error", type="float", default=None, metavar="PIXELS",
+        help='warper approximation error threshold (default: 0.125)')
+    parser.add_option("--gdal-cache", type="float", default=None, metavar="MB",
+        help='GDAL block cache size (default: derived from the memory budget and the source block size)')
+    parser.add_option("--warp-cache", default='auto', metavar="MODE",
+        choices=['auto', 'yes', 'no'],
+        help='warp the base raster once into a temporary tiled GeoTIFF: auto, yes, no (default: auto, when re-warping the base tiles is estimated to cost more)')
+    parser.add_option("--metatile", default='auto', metavar="N",
+        help='warp blocks of NxN base tiles at once and slice them into tiles (default: auto, as many as fit the memory limits, 1 to disable)')
+    parser.add_option("--memory-budget", type="float", default=None, metavar="MB",
+        help='memory available to all jobs (default: half of the physical memory)')
     parser.add_option("--tiles-prefix", default='', metavar="URL",
         help='prefix for tile URLs at googlemaps.hml')
     parser.add_option("--tile-format", default='png', metavar="FMT",
         help='tile image format (default: png)')
+    parser.add_option("--opaque-format", default=None, metavar="FMT",
+        choices=['jpeg', 'webp', 'png'],
+        help='mixed-format mode: image format for fully opaque tiles, others are written as --tile-format (default: none)')
+    parser.add_option("--opaque-quality", type="int", default=85, metavar="N",
+        help='JPEG/WEBP quality for opaque tiles in a mixed-format mode (default: 85)')
     parser.add_option("--paletted", action="store_true",
         help='convert tiles to paletted format (8 bit/pixel)')
+    parser.add_option("--global-palette", action="store_true",
+        help='with --paletted: map all tiles to one palette quantized from a sample of base tiles')
+    parser.add_option("--palette-samples", type="int", default=16, metavar="N",
+        help='base tiles sampled for --global-palette (default: 16)')
+    parser.add_option("--layouts", default=None, metavar="LAYOUT[,LAYOUT]...",
+        help='also write tiles in these layouts: tms, xyz, zyx; tiles are encoded once and hard-linked (default: none)')
+    parser.add_option("--tile-store", default='dir', metavar="STORE",
+        choices=TileStore.store_lst(),
+        help='tiles destination: %s (default: dir)' % ', '.join(TileStore.store_lst()))
     parser.add_option("-t", "--dest-dir", dest="dest_dir", default=None,
         help='destination directory (default: source)')
+    parser.add_option("--plan", action="store_true",
+        help='do not write tiles: print per zoom tile counts, size and time estimates as JSON, a line per source')
+    parser.add_option("--plan-samples", type="int", default=16, metavar="N",
+        help='number of base tiles to warp and encode for --plan estimates (default: 16)')
+    parser.add_option("--shard", default=None, metavar="I/N",
+        help='write only the I-th of N disjoint sets of subtrees into a shared destination, see --finalize')
+    parser.add_option("--finalize", action="store_true",
+        help='build the top levels and a tilemap from the subtrees written by all --shard jobs')
     parser.add_option("--noclobber", action="store_true",
         help='skip processing if the target pyramid already exists')
     parser.add_option("-s", "--strip-dest-ext", action="store_true",
         help='do not add a default extension suffix from a destination directory')
 #    parser.add_option("--viewer-copy", action="store_true",
 #        help='on POSIX systems copy html viewer instead of hardlinking to the original location')
+    parser.add_option("--progress-json", default=None, metavar="FILE",
+        help='append progress events as JSON lines to a file, "-" for stdout instead of the progress dots')
     parser.add_option("-q", "--quiet", action="store_const",
         const=0, default=1, dest="verbose")
     parser.add_option("-d", "--debug", action="store_const",
@@ -137,7 +201,14 @@ def parse_args(arg_lst):
         help='give an output file name  after name of a map file, otherwise after a name of an image file')
     parser.add_option("--skip-invalid", action="store_true",
         help='skip invalid/unrecognized source')
+    return parser
 
+#----------------------------
+
+def parse_args(arg_lst):
+
+#----------------------------
+    parser = option_parser()
     (options, args) = parser.parse_args(arg_lst)
 
     return (options, args)
@@ -172,7 +243,9 @@ def main(argv):
         options.overview_resampling, options.base_resampling = ('antialias', 'cubic')
 
     res = parallel_map(preprocess_src, args)
-    parallel_map(process_src, flatten(res))
+    src_lst = flatten(res)
+    options.parallel_jobs = min(len(src_lst), cpu_count()) if multiprocessing_enabled() else 1
+    parallel_map(process_src, src_lst)
 
 # main()
 
@@ -28,7 +28,12 @@ import os
 import os.path
 import shutil
 import math
+import glob
 import cgi
+import time
+import tempfile
+import StringIO
+import weakref
 from PIL import Image
 
 try:
@@ -44,6 +49,9 @@ except ImportError:
     from gdalconst import *
 
 from tiler_functions import *
+from tiler_footprint import Footprint
+from tiler_store import TileStore
+from tiler_progress import ProgressMonitor, json_progress_hook
 import map2gdal
 
 profile_map = []
@@ -58,6 +66,15 @@ resampling_map = {
 def resampling_lst():
     return resampling_map.keys()
 
+# resampling kernel radius, source pixels
+kernel_radius = {
+    'NearestNeighbour': 1,
+    'Bilinear':         1,
+    'Cubic':            2,
+    'CubicSpline':      2,
+    'Lanczos':          3,
+    }
+
 base_resampling_map = {
     'near':         'NearestNeighbour',
     'nearest':      'NearestNeighbour',
@@ -74,13 +91,23 @@ def base_resampling_lst():
 class TilingScheme(object):
 
 #############################
+    tile_formats = {} # tiles written in a format other than the default one
+
     #----------------------------
 
     def tile_path(self, tile):
         'relative path to a tile'
     #----------------------------
         z, x, y = tile
-        return '%i/%i/%i%s' % (z, x, y, self.tile_ext)
+        return self.layout_path(z, x, y, self.tile_ext_of(tile))
+
+    @staticmethod
+    def layout_path(z, x, y, ext):
+        return '%i/%i/%i%s' % (z, x, y, ext)
+
+    def tile_ext_of(self, tile):
+        'tile extension, may differ from the default one in a mixed-format mode'
+        return self.tile_formats.get(tuple(tile), self.tile_ext)
 
 class TMStiling(TilingScheme):
     tile_geo_origin = (-180, -90)
@@ -91,13 +118,52 @@ class XYZtiling(TilingScheme):
     tile_dim = (256, -256) # tile size in pixels
 
 class ZYXtiling(XYZtiling):
-    #----------------------------
 
-    def tile_path(self, tile):
-        'relative path to a tile'
-    #----------------------------
+    @staticmethod
+    def layout_path(z, x, y, ext):
+        return 'z%i/%i/%i%s' % (z, y, x, ext)
+
+layout_map = (
+    ('tms', TMStiling),
+    ('xyz', XYZtiling),
+    ('zyx', ZYXtiling),
+    )
+
+#############################
+
+class TileLayout(object):
+    '''Extra tile tree in another tiling scheme, tiles are linked to the pyramid's ones'''
+#############################
+
+    def __init__(self, pyramid, name, scheme, dest):
+        self.pyramid = weakref.proxy(pyramid)
+        self.name = name
+        self.scheme = scheme
+        self.dest = dest
+        self.flip_y = (scheme.tile_dim[1] > 0) != (pyramid.tile_dim[1] > 0)
+
+    def tile(self, tile):
+        'pyramid tile numbers to the layout ones'
         z, x, y = tile
-        return 'z%i/%i/%i%s' % (z, y, x, self.tile_ext)
+        if self.flip_y:
+            y = self.pyramid.tiles_xy(z)[1]-1-y
+        return (z, x, y)
+
+    def tile_path(self, tile):
+        return self.scheme.layout_path(*(self.tile(tile) + (self.pyramid.tile_ext_of(tile),)))
+
+    def tilemap(self, tilemap):
+        'adjust pyramid tilemap to the layout'
+        tilemap = json.loads(json.dumps(tilemap)) # deep copy
+        tiles = tilemap['tiles']
+        tiles['inversion'] = [i < 0 for i in self.scheme.tile_dim]
+        if self.flip_y:
+            tiles['origin'] = [tiles['origin'][0], -tiles['origin'][1]]
+        if 'formats' in tiles:
+            tiles['formats'] = dict([
+                ('%i/%i/%i' % self.tile(map(int, key.split('/'))), ext) for key, ext in tiles['formats'].items()])
+        return tilemap
+# TileLayout
 
 #############################
 
@@ -105,53 +171,211 @@ class BaseImg(object):
     '''Tile feeder for a base zoom level'''
 #############################
 
-    def __init__(self, dataset, world_ul, transparency=None):
+    def __init__(self, dataset, world_ul, transparency=None, block=None):
         self.ds = dataset
         self.world_ul = world_ul
         self.transparency = transparency
+        self.block = block # metatile size in pixels, read and warped at once
+        self.metatile = None # (ul, band images) of the last metatile read
 
         self.size = self.ds.RasterXSize, self.ds.RasterYSize
         self.bands = [self.ds.GetRasterBand(i+1) for i in range(self.ds.RasterCount)]
 
     def __del__(self):
+        self.metatile = None
         del self.bands
         del self.ds
 
+    def read_bands(self, ul, sz):
+        return [Image.frombuffer('L', sz,
+                    bnd.ReadRaster(ul[0], ul[1], sz[0], sz[1], sz[0], sz[1], GDT_Byte),
+                    'raw', 'L', 0, 1)
+                for bnd in self.bands]
+
+    def tile_bands(self, ul, sz):
+        '''band images of a tile, cropped from the metatile around it'''
+        if not self.block:
+            return self.read_bands(ul, sz)
+
+        # metatiles are aligned to the world pixel grid, so a quadtree walk reads each of them once;
+        # warp_raster() aligns the warped blocks to it too
+        m_ul = [(ul[i]+self.world_ul[i])//self.block[i]*self.block[i]-self.world_ul[i] for i in (0, 1)]
+        m_ul = [max(0, m_ul[i]) for i in (0, 1)]
+        if self.metatile is None or self.metatile[0] != m_ul:
+            m_lr = [min(self.size[i], (ul[i]+self.world_ul[i])//self.block[i]*self.block[i]+self.block[i]-self.world_ul[i])
+                    for i in (0, 1)]
+            self.metatile = None # release the previous one first
+            self.metatile = (m_ul, self.read_bands(m_ul, [m_lr[i]-m_ul[i] for i in (0, 1)]))
+        box = (ul[0]-m_ul[0], ul[1]-m_ul[1], ul[0]-m_ul[0]+sz[0], ul[1]-m_ul[1]+sz[1])
+        return [bnd.crop(box) for bnd in self.metatile[1]]
+
     def get_tile(self, corners):
         '''crop raster as per pair of world pixel coordinates'''
 
         ul = [corners[0][i]-self.world_ul[i] for i in (0, 1)]
         sz = [corners[1][i]-corners[0][i] for i in (0, 1)]
 
-        tile_bands = [bnd.ReadRaster(ul[0], ul[1], sz[0], sz[1], sz[0], sz[1], GDT_Byte)
-                    for bnd in self.bands]
+        tile_bands = self.tile_bands(ul, sz)
         n_bands = len(self.bands)
         if n_bands == 1:
             opacity = 1
-            mode = 'L'
             if self.transparency is not None:
-                if chr(self.transparency) in tile_bands[0]:
-                    colorset = set(tile_bands[0])
-                    if len(colorset) == 1:  # fully transparent
+                if tile_bands[0].histogram()[self.transparency]:
+                    lo, hi = tile_bands[0].getextrema()
+                    if lo == hi:                    # fully transparent
                         return None, 0
-                    else:                   # semi-transparent
+                    else:                           # semi-transparent
                         opacity = -1
-            img = Image.frombuffer('L', sz, tile_bands[0], 'raw', 'L', 0, 1)
+            img = tile_bands[0]
         else:
-            aplpha = tile_bands[-1]
-            if min(aplpha) == '\xFF':       # fully opaque
+            lo, hi = tile_bands[-1].getextrema()    # alpha
+            if lo == 255:                           # fully opaque
                 opacity = 1
                 tile_bands = tile_bands[:-1]
                 mode = 'RGB' if n_bands > 2 else 'L'
-            elif max(aplpha) == '\x00':     # fully transparent
+            elif hi == 0:                           # fully transparent
                 return None, 0
-            else:                           # semi-transparent
+            else:                                   # semi-transparent
                 opacity = -1
                 mode = 'RGBA' if n_bands > 2 else 'LA'
-            img = Image.merge(mode, [Image.frombuffer('L', sz, bnd, 'raw', 'L', 0, 1) for bnd in tile_bands])
+            img = Image.merge(mode, tile_bands) if len(tile_bands) > 1 else tile_bands[0]
         return img, opacity
 # BaseImg
 
+#############################
+
+class SourceGeometry(object):
+    '''Transformers and auto-warped raster extents of a source dataset, built once per target SRS'''
+#############################
+
+    def __init__(self, src_ds):
+        self.src_ds = src_ds
+        self.cache = {}
+
+    def cached(self, key, build):
+        try:
+            return self.cache[key]
+        except KeyError:
+            value = self.cache[key] = build()
+            return value
+
+    def transformer(self, dst_srs):
+        'source pixels to dst_srs'
+        return self.cached(('transformer', dst_srs),
+            lambda: GdalTransformer(self.src_ds, DST_SRS=dst_srs))
+
+    def corners(self, dst_srs):
+        'source raster corners (ul, lr) at dst_srs'
+        return self.cached(('corners', dst_srs), lambda: self.transformer(dst_srs).transform([
+            (0, 0),
+            (self.src_ds.RasterXSize, self.src_ds.RasterYSize)]))
+
+    def warped(self, dst_srs):
+        'geotransform and size of the source auto-warped to dst_srs'
+        def build():
+            ds = gdal.AutoCreateWarpedVRT(self.src_ds, None, txt2wkt(dst_srs))
+            return ds.GetGeoTransform(), (ds.RasterXSize, ds.RasterYSize)
+        return self.cached(('warped', dst_srs), build)
+
+    def warped_bounds(self, dst_srs):
+        'corners (ul, lr) of the source auto-warped to dst_srs'
+        geotr, size = self.warped(dst_srs)
+        return [(geotr[0], geotr[3]), gdal.ApplyGeoTransform(geotr, size[0], size[1])]
+# SourceGeometry
+
+#############################
+
+class TileIndex(object):
+    '''Range-based index of "logical" tiles, answers arithmetically from per zoom bounds'''
+#############################
+
+    def __init__(self):
+        self.zooms = {}
+
+    def add_zoom(self, zoom, tile_ul, tile_lr, ntiles_x, coverage=None):
+        'set "physical" tile bounds for a zoom level'
+        xmin, xmax = sorted((tile_ul[1], tile_lr[1]))
+        ymin, ymax = sorted((tile_ul[2], tile_lr[2]))
+        xmin = max(xmin, xmax-ntiles_x+1) # a map spanning over 360 degrees: the last tile wins
+        self.zooms[zoom] = (xmin, xmax, ymin, ymax, ntiles_x, coverage)
+
+    def physical(self, tile):
+        '"logical" tile to a "physical" one (not wrapped at longitude 180) or None if not indexed'
+        z, x, y = tile
+        try:
+            xmin, xmax, ymin, ymax, ntiles_x, coverage = self.zooms[z]
+        except KeyError:
+            return None
+        if not (0 <= x < ntiles_x and ymin <= y <= ymax):
+            return None
+        phys_x = xmax - (xmax - x) % ntiles_x
+        if phys_x < xmin:
+            return None
+        phys_tile = (z, phys_x, y)
+        if coverage is not None and phys_tile not in coverage:
+            return None
+        return phys_tile
+
+    def __contains__(self, tile):
+        return self.physical(tile) is not None
+
+    def tiles(self, zoom):
+        '"logical" tiles of a zoom level'
+        xmin, xmax, ymin, ymax, ntiles_x, coverage = self.zooms[zoom]
+        for y in range(ymin, ymax+1):
+            for x in range(xmin, xmax+1):
+                if coverage is None or (zoom, x, y) in coverage:
+                    yield (zoom, x % ntiles_x, y)
+
+    def children(self, tile, ch_zoom):
+        'indexed children of a tile at a higher zoom, with their offsets in the parent tile grid'
+        z, x, y = tile
+        dz = int(2**(ch_zoom-z))
+        return [((ch_zoom, x*dz+dx, y*dz+dy), (dx, dy))
+                for dy in range(dz)
+                for dx in range(dz)
+                if (ch_zoom, x*dz+dx, y*dz+dy) in self]
+
+    def count(self, zoom):
+        'number of tiles at a zoom level'
+        xmin, xmax, ymin, ymax, ntiles_x, coverage = self.zooms[zoom]
+        if coverage is not None:
+            return coverage.count()
+        return (xmax-xmin+1)*(ymax-ymin+1)
+
+    def count_under(self, tile, zoom):
+        'number of indexed descendants of a "logical" tile at a higher zoom level'
+        z, x, y = tile
+        dz = int(2**(zoom-z))
+        x0, x1 = x*dz, x*dz+dz-1 # "logical" range
+        xmin, xmax, ymin, ymax, ntiles_x, coverage = self.zooms[zoom]
+        y0, y1 = max(y*dz, ymin), min(y*dz+dz-1, ymax)
+        if y0 > y1:
+            return 0
+        n = 0
+        for k in range(xmin//ntiles_x, xmax//ntiles_x+1): # "physical" range pieces, one per wrap around
+            shift = k*ntiles_x
+            px0 = max(x0+shift, xmin, shift)
+            px1 = min(x1+shift, xmax, shift+ntiles_x-1)
+            if px0 > px1:
+                continue
+            if coverage is not None:
+                n += coverage.count_in(px0, px1, y0, y1)
+            else:
+                n += (px1-px0+1)*(y1-y0+1)
+        return n
+# TileIndex
+
+
+def parse_shard(shard):
+    '"i/N" to (i, N), shards are numbered from 1'
+    try:
+        i, n = map(int, shard.split('/'))
+    except ValueError:
+        raise ValueError('Invalid shard "%s", expected i/N' % shard)
+    if not 1 <= i <= n:
+        raise ValueError('Invalid shard "%s", expected 1 <= i <= N' % shard)
+    return i, n
 
 #############################
 
@@ -167,6 +391,18 @@ class Pyramid(object):
     zoom0_res = None
     max_extent = None
     max_resolution = None
+    footprint = None
+    src_res = None
+    metatile = 1 # base tiles per side warped at once
+    base_reads = None # base tiles to be read, the warp cache is estimated by it
+    global_palette = None # 'P' image with a palette shared by all paletted tiles
+    progress_hook = None # callable(event, data), see ProgressMonitor
+    monitor = None
+    dry_run = False # planning only, nothing is written to the destination
+    shard = None # (i, N): i-th of N disjoint subtree sets of a shared pyramid
+    shard_leaves = None # finalize: {split zoom tile: opacity} written by the shards
+    shard_zoom = None
+    _geometry = None
 
     #----------------------------
 
@@ -184,7 +420,22 @@ class Pyramid(object):
             self.temp_files.append(self.src)
         self.name = self.options.name
         self.tile_ext = self.options.tile_ext
+        self.tile_formats = {}
+        self.metrics = {}
+        self.layouts = []
         self.description = ''
+        self.store = TileStore.get_class(self.options.tile_store or 'dir')(self)
+        if self.options.progress_json:
+            self.progress_hook = json_progress_hook(self.options.progress_json)
+        if self.options.shard:
+            self.shard = parse_shard(self.options.shard)
+        self.work_dir = None # auxiliary files
+        if dest:
+            self.work_dir = self.store.work_dir()
+            if self.shard: # the destination is shared by the nodes, auxiliary files are not
+                self.work_dir = os.path.join(self.work_dir, 'shard.%d-%d.work' % self.shard)
+            elif self.options.finalize:
+                self.work_dir = os.path.join(self.work_dir, 'finalize.work')
 
         self.init_tile_grid()
 
@@ -197,6 +448,8 @@ class Pyramid(object):
             if self.options.verbose < 2:
                 for f in self.temp_files:
                     os.remove(f)
+                if self.work_dir != self.dest:
+                    shutil.rmtree(self.work_dir, ignore_errors=True)
         except: pass
 
     #----------------------------
@@ -209,7 +462,7 @@ class Pyramid(object):
         self.geog_srs = proj_cs2geog_cs(self.proj_srs)
         ld('proj, longlat', self.proj_srs, self.geog_srs)
 
-        self.proj2geog = GdalTransformer(SRC_SRS=self.proj_srs, DST_SRS=self.geog_srs)
+        self.proj2geog = srs_transformer(self.proj_srs, self.geog_srs)
         max_x = self.proj2geog.transform_point((180, 0), inv=True)[0] # Equator's half length
         ld('max_x', max_x)
 
@@ -259,12 +512,17 @@ class Pyramid(object):
             #~ print('\n%s -> %s '%(self.src, self.dest), end='')
         logging.info(' %s -> %s '%(self.src, self.dest))
 
-        if os.path.isdir(self.dest):
-            if self.options.noclobber and os.path.exists(self.dest):
+        shared_dest = self.dry_run or self.shard or self.options.finalize # other jobs write there too
+        if os.path.exists(self.dest) and not shared_dest:
+            if self.options.noclobber:
                 logging.error('Target already exists: skipping')
                 return False
             else:
-                shutil.rmtree(self.dest, ignore_errors=True)
+                self.store.remove()
+
+        # extra output layouts
+        if self.options.layouts and not self.dry_run:
+            self.init_layouts(self.options.layouts.split(','), clean=not shared_dest)
 
         # connect to src dataset
         try:
@@ -282,19 +540,16 @@ class Pyramid(object):
 
         # shift target SRS to avoid crossing 180 meridian
         shifted_srs = self.shift_srs(self.max_zoom)
-        shift_x = GdalTransformer(SRC_SRS=shifted_srs, DST_SRS=self.proj_srs).transform_point((0, 0))[0]
+        shift_x = srs_transformer(shifted_srs, self.proj_srs).transform_point((0, 0))[0]
         if shift_x != 0:
             self.proj_srs = shifted_srs
-            self.proj2geog = GdalTransformer(SRC_SRS=self.proj_srs, DST_SRS=self.geog_srs)
+            self.proj2geog = srs_transformer(self.proj_srs, self.geog_srs)
             self.pix_origin = (self.pix_origin[0]-shift_x, self.pix_origin[1])
             self.tile_origin = (self.tile_origin[0]-shift_x, self.tile_origin[1])
             ld('new_srs', shifted_srs, 'shift_x', shift_x, 'pix_origin', self.pix_origin)
 
         # get corners at the target SRS
-        target_ds = gdal.AutoCreateWarpedVRT(self.src_ds, None, txt2wkt(shifted_srs))
-        target_bounds = GdalTransformer(target_ds).transform([
-            (0, 0),
-            (target_ds.RasterXSize, target_ds.RasterYSize)])
+        target_bounds = self.geometry.warped_bounds(shifted_srs)
 
         # self.bounds are set to a world raster, now clip to the max tileset area
         self.bounds = ((target_bounds[0][0],
@@ -312,6 +567,25 @@ class Pyramid(object):
 
     #----------------------------
 
+    def init_layouts(self, layout_names, clean=True):
+        'tile trees to be written along with the pyramid, one encode per tile'
+    #----------------------------
+        assert self.store.files, 'Extra layouts require a directory tile store'
+        base = self.dest
+        if base.endswith(self.defaul_ext):
+            base = base[:-len(self.defaul_ext)]
+        for name, scheme in layout_map:
+            if name not in layout_names or type(self).layout_path == scheme.layout_path and \
+                    (scheme.tile_dim[1] > 0) == (self.tile_dim[1] > 0):
+                continue # the pyramid itself
+            layout = TileLayout(self, name, scheme, '%s.%s' % (base, name))
+            if clean:
+                shutil.rmtree(layout.dest, ignore_errors=True)
+            self.layouts.append(layout)
+        ld('layouts', [l.dest for l in self.layouts])
+
+    #----------------------------
+
     def get_src_ds(self):
         'get src dataset, convert to RGB(A) if required'
     #----------------------------
@@ -328,7 +602,9 @@ class Pyramid(object):
         self.description = self.src_ds.GetMetadataItem('DESCRIPTION')
 
         # source is successfully opened, then create destination dir
-        os.makedirs(self.dest)
+        try:
+            os.makedirs(self.work_dir)
+        except os.error: pass
 
         src_geotr = src_ds.GetGeoTransform()
         src_proj = txt2proj4(src_ds.GetProjection())
@@ -416,7 +692,7 @@ class Pyramid(object):
                     'band_list':band_lst,
                     }
 
-                src_vrt = os.path.abspath(os.path.join(self.dest, self.base+'.src.vrt')) # auxilary VRT file
+                src_vrt = os.path.abspath(os.path.join(self.work_dir, self.base+'.src.vrt')) # auxilary VRT file
                 self.temp_files.append(src_vrt)
                 self.src_path = src_vrt
                 with open(src_vrt, 'w') as f:
@@ -427,7 +703,7 @@ class Pyramid(object):
             # finished with a paletted raster
 
         if override_srs is not None: # src SRS needs to be relpaced
-            src_vrt = os.path.join(self.dest, self.base+'.src.vrt') # auxilary VRT file
+            src_vrt = os.path.join(self.work_dir, self.base+'.src.vrt') # auxilary VRT file
             self.temp_files.append(src_vrt)
             self.src_path = src_vrt
 
@@ -450,12 +726,19 @@ class Pyramid(object):
 
     #----------------------------
 
+    @property
+    def geometry(self):
+        'source geometry cache, follows src_ds replacements'
+        if self._geometry is None or self._geometry.src_ds is not self.src_ds:
+            self._geometry = SourceGeometry(self.src_ds)
+        return self._geometry
+
+    #----------------------------
+
     def shift_srs(self, zoom=None):
         'change prime meridian to allow charts crossing 180 meridian'
     #----------------------------
-        ul, lr = GdalTransformer(self.src_ds, DST_SRS=self.geog_srs).transform([
-            (0, 0),
-            (self.src_ds.RasterXSize, self.src_ds.RasterYSize)])
+        ul, lr = self.geometry.corners(self.geog_srs)
         ld('shift_srs ul', ul, 'lr', lr)
         if lr[0] <= 180 and ul[0] >= -180 and ul[0] < lr[0]:
             return self.proj_srs
@@ -484,14 +767,13 @@ class Pyramid(object):
         # modify target srs to allow charts crossing meridian 180
         shifted_srs = self.shift_srs()
 
-        t_ds = gdal.AutoCreateWarpedVRT(self.src_ds, None, txt2wkt(shifted_srs))
-        geotr = t_ds.GetGeoTransform()
+        geotr, size = self.geometry.warped(shifted_srs)
         res = (geotr[1], geotr[5])
+        self.src_res = res
         max_zoom = max(self.res2zoom_xy(res))
 
         # calculate min_zoom
-        ul_c = (geotr[0], geotr[3])
-        lr_c = gdal.ApplyGeoTransform(geotr, t_ds.RasterXSize, t_ds.RasterYSize)
+        ul_c, lr_c = self.geometry.warped_bounds(shifted_srs)
         wh = (lr_c[0]-ul_c[0], ul_c[1]-lr_c[1])
         ld('ul_c, lr_c, wh', ul_c, lr_c, wh)
         min_zoom = min(self.res2zoom_xy([wh[i]/abs(self.tile_dim[i]) for i in (0, 1)]))
@@ -502,6 +784,20 @@ class Pyramid(object):
 
     def make_raster(self, zoom):
 
+    #----------------------------
+        base_ds, ul_pix = self.warp_raster(zoom)
+
+        # close datasets in a proper order
+        self._geometry = None
+        del self.src_ds
+
+        # create base_image raster
+        self.base_img = BaseImg(base_ds, ul_pix, self.transparency, self.metatile_block())
+
+    #----------------------------
+
+    def warp_raster(self, zoom):
+        'warped raster of a zoom level and its upper left corner in world pixels, src_ds is kept open'
     #----------------------------
 
         # adjust raster extents to tile boundaries
@@ -545,14 +841,6 @@ class Pyramid(object):
             #src_transform = warp_src_gcp_transformer % (0, gcp_txt)
             src_transform = warp_src_tps_transformer % gcp_txt
 
-        res = self.zoom2res(zoom)
-        #ul_ll, lr_ll = self.coords2longlat([ul_c, lr_c])
-        ld('max_zoom', zoom, 'size', dst_xsize, dst_ysize, '-tr', res[0], res[1], '-te', ul_c[0], lr_c[1], lr_c[0], ul_c[1], '-t_srs', self.proj_srs)
-        dst_geotr = ( ul_c[0], res[0], 0.0,
-                    ul_c[1], 0.0, res[1] )
-        dst_igeotr = gdal.InvGeoTransform(dst_geotr)
-        dst_transform = '%s\n%s' % (warp_dst_geotr % dst_geotr, warp_dst_igeotr % dst_igeotr)
-
         # generate warp options
         warp_options = []
         def w_option(name, value): # warp options template
@@ -560,6 +848,9 @@ class Pyramid(object):
 
         warp_options.append(w_option('INIT_DEST', 'NO_DATA'))
 
+        warp = self.tune_warp(zoom)
+        warp_options.append(w_option('NUM_THREADS', warp['threads']))
+
         # generate cut line
         if self.options.cut or self.options.cutline:
             cut_wkt = self.get_cutline()
@@ -601,15 +892,45 @@ class Pyramid(object):
         if src_bands < 4 and self.palette is None:
             vrt_bands.append(warp_band % (src_bands+1, warp_band_color % 'Alpha'))
 
+        # warp blocks of metatiles, with a source margin for the resampling kernel
+        self.metatile = self.metatile_size(zoom, warp, dst_xsize, dst_ysize, len(vrt_bands))
+        warp_tiles = self.metatile
+        warp_cache = self.use_warp_cache(zoom, warp, dst_xsize, dst_ysize, len(vrt_bands))
+        if warp_cache: # warped in blocks as large as fit the memory limits, read tile by tile
+            warp_tiles = self.fit_metatile(zoom, warp, dst_xsize, dst_ysize, len(vrt_bands))
+            self.metatile = 1
+        if warp_tiles > 1:
+            warp_options.append(w_option('SOURCE_EXTRA', warp['source_extra']))
+
+        block = self.metatile_block()
+        if block:
+            # extend the raster to the metatile grid of BaseImg, so a metatile is a single warped block
+            ul_pix = [ul_pix[i]//block[i]*block[i] for i in (0, 1)]
+            lr_pix = [-(-lr_pix[i]//block[i])*block[i] for i in (0, 1)]
+            ul_c = self.pix2coord(zoom, ul_pix)
+            lr_c = self.pix2coord(zoom, lr_pix)
+            dst_xsize = lr_pix[0]-ul_pix[0]
+            dst_ysize = lr_pix[1]-ul_pix[1]
+
+        res = self.zoom2res(zoom)
+        #ul_ll, lr_ll = self.coords2longlat([ul_c, lr_c])
+        ld('max_zoom', zoom, 'size', dst_xsize, dst_ysize, '-tr', res[0], res[1], '-te', ul_c[0], lr_c[1], lr_c[0], ul_c[1], '-t_srs', self.proj_srs)
+        dst_geotr = ( ul_c[0], res[0], 0.0,
+                    ul_c[1], 0.0, res[1] )
+        dst_igeotr = gdal.InvGeoTransform(dst_geotr)
+        dst_transform = '%s\n%s' % (warp_dst_geotr % dst_geotr, warp_dst_igeotr % dst_igeotr)
+
         vrt_text = warp_vrt % {
             'xsize':            dst_xsize,
             'ysize':            dst_ysize,
             'srs':              self.proj_srs,
             'geotr':            geotr_templ % dst_geotr,
             'band_list':        '\n'.join(vrt_bands),
-            'blxsize':          abs(self.tile_dim[0]),
-            'blysize':          abs(self.tile_dim[1]),
+            'blxsize':          abs(self.tile_dim[0])*warp_tiles,
+            'blysize':          abs(self.tile_dim[1])*warp_tiles,
             'wo_ResampleAlg':   self.base_resampling,
+            'wo_WarpMemoryLimit': warp['warp_memory'],
+            'wo_MaxError':      warp['max_error'],
             'wo_src_path':      cgi.escape(self.src_path, quote=True),
             'warp_options':     '\n'.join(warp_options),
             'wo_src_srs':       gcp_proj if gcp_proj else src_proj,
@@ -621,8 +942,9 @@ class Pyramid(object):
             'wo_Cutline':       (warp_cutline % cut_wkt) if cut_wkt else '',
             }
 
-        temp_vrt = os.path.join(self.dest, self.base+'.tmp.vrt') # auxilary VRT file
-        self.temp_files.append(temp_vrt)
+        temp_vrt = os.path.join(self.work_dir, self.base+'.tmp.vrt') # auxilary VRT file
+        if temp_vrt not in self.temp_files:
+            self.temp_files.append(temp_vrt)
         with open(temp_vrt, 'w') as f:
             f.write(vrt_text.encode('utf-8'))
 
@@ -630,11 +952,177 @@ class Pyramid(object):
         base_ds = gdal.Open(vrt_text, GA_ReadOnly)
         self.progress()
 
-        # close datasets in a proper order
-        del self.src_ds
+        # warp the whole base raster once into a tiled GeoTIFF
+        if warp_cache:
+            cache_tif = os.path.join(self.work_dir, self.base+'.warp.tif')
+            self.temp_files.append(cache_tif)
+            base_ds = self.materialize_warp(base_ds, cache_tif, abs(self.tile_dim[0])*warp_tiles, abs(self.tile_dim[1])*warp_tiles)
+            self.progress()
 
-        # create base_image raster
-        self.base_img = BaseImg(base_ds, ul_pix, self.transparency)
+        return base_ds, ul_pix
+
+    #----------------------------
+
+    def materialize_warp(self, warped_ds, path, blxsize, blysize):
+        'copy a warped raster into a tiled GeoTIFF, one warped block at a time'
+    #----------------------------
+        xsize, ysize = warped_ds.RasterXSize, warped_ds.RasterYSize
+        nbands = warped_ds.RasterCount
+        cache_ds = gdal.GetDriverByName('GTiff').Create(path, xsize, ysize, nbands, GDT_Byte, [
+            'TILED=YES',
+            'BLOCKXSIZE=%d' % abs(self.tile_dim[0]),
+            'BLOCKYSIZE=%d' % abs(self.tile_dim[1]),
+            'BIGTIFF=IF_SAFER',
+            ])
+        cache_ds.SetGeoTransform(warped_ds.GetGeoTransform())
+        cache_ds.SetProjection(warped_ds.GetProjection())
+        for i in range(nbands):
+            cache_ds.GetRasterBand(i+1).SetColorInterpretation(warped_ds.GetRasterBand(i+1).GetColorInterpretation())
+        for yoff in range(0, ysize, blysize):
+            for xoff in range(0, xsize, blxsize):
+                w, h = min(blxsize, xsize-xoff), min(blysize, ysize-yoff)
+                cache_ds.WriteRaster(xoff, yoff, w, h, warped_ds.ReadRaster(xoff, yoff, w, h, w, h, GDT_Byte))
+        cache_ds.FlushCache()
+        return cache_ds
+
+    #----------------------------
+
+    def use_warp_cache(self, zoom, warp, xsize, ysize, nbands):
+        'materialize the warp if asked to or if re-warping the base tiles costs more, and there is disk space for it'
+    #----------------------------
+        mode = 'no' if self.dry_run else (self.options.warp_cache or 'auto')
+        if mode != 'auto':
+            use = mode == 'yes'
+        else:
+            estimate = self.warp_cache_estimate(zoom, warp, xsize, ysize, nbands)
+            self.metrics['warp_cache_estimate'] = estimate
+            use = estimate['lazy'] > estimate['cached']
+        if use:
+            try:
+                st = os.statvfs(self.work_dir)
+                use = st.f_bavail*st.f_frsize > 1.2*xsize*ysize*nbands
+            except (AttributeError, OSError):
+                pass
+            if not use:
+                logging.warning('No disk space for the warp cache, zoom %d' % zoom)
+        ld('use_warp_cache', mode, use)
+        self.metrics['warp_cache'] = use
+        return use
+
+    # costs of the warp cache, in warps of a tile without margins
+    warp_call_cost = 0.3 # setting up a warp of a block: transformer, source window, kernel
+    warp_cache_io = 0.25 # writing a warped tile into the cache and reading it back
+
+    def warp_cache_estimate(self, zoom, warp, xsize, ysize, nbands):
+        'costs of warping the base tiles as they are read and of warping the whole raster once'
+    #----------------------------
+        tsz = [abs(self.tile_dim[i]) for i in (0, 1)]
+        ntiles = (xsize//tsz[0])*(ysize//tsz[1])
+        reads = self.base_reads if self.base_reads is not None else ntiles
+
+        # a warped block re-transforms a source margin for the resampling kernel, in target pixels
+        dst_res = self.zoom2res(zoom)
+        src_res = self.src_res or dst_res
+        margin = kernel_radius[self.base_resampling]*max(1., abs(src_res[0]/dst_res[0]))
+
+        def tile_cost(block_tiles): # a tile's share of its block warp
+            overlap = ((tsz[0]*block_tiles+2*margin)/(tsz[0]*block_tiles))*((tsz[1]*block_tiles+2*margin)/(tsz[1]*block_tiles))
+            return overlap + self.warp_call_cost/block_tiles**2
+
+        cache_tiles = self.fit_metatile(zoom, warp, xsize, ysize, nbands)
+        return {
+            'tiles':    ntiles,
+            'reads':    reads,
+            'margin':   margin,
+            'lazy':     reads*tile_cost(self.metatile),
+            'cached':   ntiles*(tile_cost(cache_tiles)+self.warp_cache_io),
+            }
+
+    #----------------------------
+
+    def metatile_size(self, zoom, warp, xsize, ysize, nbands):
+        'tiles per metatile side, options take precedence'
+    #----------------------------
+        opt = self.options.metatile or 'auto'
+        if opt != 'auto':
+            size = max(1, int(opt))
+        else:
+            size = self.fit_metatile(zoom, warp, xsize, ysize, nbands)
+        self.metrics['metatile'] = size
+        ld('metatile_size', size)
+        return size
+
+    def fit_metatile(self, zoom, warp, xsize, ysize, nbands):
+        'tiles per block side: the largest power of 2 whose warp fits the memory limits'
+        tsz = [abs(self.tile_dim[i]) for i in (0, 1)]
+        dst_res = self.zoom2res(zoom)
+        src_res = self.src_res or dst_res
+        scale = abs(dst_res[0]/src_res[0])*abs(dst_res[1]/src_res[1]) # source pixels per target one
+        src_bands = self.src_ds.RasterCount
+        span = max(xsize//tsz[0], ysize//tsz[1]) # no use beyond the raster
+        size = 1
+        while size < 16 and size < span:
+            n = size*2
+            block = n*tsz[0]*n*tsz[1]
+            warp_bytes = block*nbands + block*src_bands*max(1., scale)
+            if warp_bytes > warp['warp_memory'] or block*nbands*2 > warp['gdal_cache']:
+                break
+            size = n
+        return size
+
+    def metatile_block(self):
+        'metatile size in pixels, None if tiles are read one by one'
+        if self.metatile > 1:
+            return [abs(self.tile_dim[i])*self.metatile for i in (0, 1)]
+        return None
+
+    #----------------------------
+
+    def tune_warp(self, zoom):
+        'pick warper threads, memory limits and block cache size, options take precedence'
+    #----------------------------
+        opt = self.options
+        mb = 2**20
+        jobs = max(1, opt.parallel_jobs or 1) # sources processed in parallel
+        budget = float(opt.memory_budget)*mb if opt.memory_budget else memory_size()/2.
+        budget /= jobs
+        threads = int(opt.warp_threads or max(1, cpu_count()//jobs))
+
+        # source window of a base tile, in whole source blocks
+        src_band = self.src_ds.GetRasterBand(1)
+        blxsize, blysize = src_band.GetBlockSize()
+        dst_res = self.zoom2res(zoom)
+        src_res = self.src_res or dst_res
+        scale = [max(1., abs(dst_res[i]/src_res[i])) for i in (0, 1)]
+        win = [abs(self.tile_dim[i])*scale[i] for i in (0, 1)]
+        win_cols = min(self.src_ds.RasterXSize, blxsize*(int(math.ceil(win[0]/blxsize))+1))
+        win_rows = min(self.src_ds.RasterYSize, blysize*(int(math.ceil(win[1]/blysize))+1))
+        window = win_cols*win_rows*self.src_ds.RasterCount
+
+        if opt.gdal_cache:
+            cache = float(opt.gdal_cache)*mb
+        else: # keep a couple of windows per thread, within the budget
+            cache = min(max(2*window*threads, budget*0.25), budget*0.5)
+        if opt.warp_memory:
+            warp_memory = float(opt.warp_memory)*mb
+        else:
+            warp_memory = max(16*mb, min(budget*0.25, 4*window*threads))
+        max_error = float(opt.warp_error) if opt.warp_error is not None else 0.125
+
+        gdal.SetCacheMax(int(cache))
+
+        warp = {
+            'threads':      threads,
+            'warp_memory':  int(warp_memory),
+            'gdal_cache':   int(cache),
+            'max_error':    max_error,
+            'source_extra': int(math.ceil(kernel_radius[self.base_resampling]*max(scale)))+1,
+            'src_block':    [blxsize, blysize],
+            'memory_budget':int(budget),
+            }
+        ld('tune_warp', warp)
+        self.metrics['warp'] = warp
+        return warp
 
     #----------------------------
 
@@ -669,51 +1157,314 @@ class Pyramid(object):
         if not self.init_map(self.options.zoom):
             return
 
+        ld('walk')
+        self.index_tiles()
+
+        if self.options.finalize:
+            return self.finalize_shards()
+        if self.shard:
+            return self.walk_shard()
+
+        self.monitor = ProgressMonitor(self.progress_hook, self.src,
+            dict((z, self.tile_index.count(z)) for z in self.zoom_range))
+        self.monitor.start()
+
         # create a raster source for a base zoom
+        self.base_reads = self.tile_index.count(self.max_zoom)
+        started = time.time()
         self.make_raster(self.max_zoom)
+        self.make_global_palette(self.base_img)
+        self.monitor.raster(time.time() - started)
 
         if not self.name:
             self.name = os.path.basename(self.dest)
+            if not self.store.files:
+                self.name = os.path.splitext(self.name)[0]
 
-        # map 'logical' tiles to 'physical' tiles
-        ld('walk')
-        self.tile_map = {}
-        for zoom in self.zoom_range:
-            tile_ul, tile_lr = self.corner_tiles(zoom)
-            xx = (tile_ul[1], tile_lr[1])
-            yy = (tile_ul[2], tile_lr[2])
-            zoom_tiles = flatten([[
-                        (zoom, x, y)
-                    for x in range(min(xx), max(xx)+1)]
-                for y in range(min(yy), max(yy)+1)])
-            #ld('zoom_tiles', zoom_tiles, tile_ul, tile_lr)
-
-            ntiles_x, ntiles_y = self.tiles_xy(zoom)
-            zoom_tiles_map = dict([((z, x % ntiles_x, y), (z, x, y)) for z, x, y in zoom_tiles])
-            self.tile_map.update(zoom_tiles_map)
-
-        self.all_tiles = frozenset(self.tile_map) # store all tiles into a set
-        ld('min_zoom', zoom, 'tile_ul', tile_ul, 'tile_lr', tile_lr, 'tiles', zoom_tiles_map)
-
-        # top level tiles are in zoom_tiles_map now
-        top_results = filter(None, map(self.proc_tile, zoom_tiles_map.keys()))
+        # top level tiles
+        top_results = filter(None, map(self.proc_tile, self.tile_index.tiles(self.zoom_range[-1])))
 
         # write top-level metadata (html/kml)
         self.write_metadata(None, [ch for img, ch, opacities in top_results])
 
         # cache back tiles transparency
-        transparency = dict((
-            (self.tile_path(tile), opc)
-            for tile, opc in flatten((
-                opacities for img, ch, opacities in top_results
-                ))
-            ))
-        write_transparency(self.dest, transparency)
+        transparency = flatten((opacities for img, ch, opacities in top_results))
+        self.store.write_transparency(transparency)
+        self.metrics['progress'] = self.monitor.totals()
+        self.store.write_metrics(self.metrics)
+        self.store.close()
+
+        self.monitor.finish()
+        self.progress(finished=True)
+
+    #----------------------------
+
+    def index_tiles(self):
+        'map "logical" tiles to "physical" tiles, within a valid data footprint if requested'
+    #----------------------------
+        # valid data footprint, tiles outside it are never read
+        self.footprint = None
+        if self.options.footprint:
+            self.footprint = Footprint.from_pyramid(self, self.options.footprint)
+
+        self.tile_index = TileIndex()
+        for zoom, (tile_ul, tile_lr) in zip(self.zoom_range, self.corner_tiles_lst(self.zoom_range)):
+            coverage = self.footprint.tile_coverage(self, zoom) if self.footprint else None
+            self.tile_index.add_zoom(zoom, tile_ul, tile_lr, self.tiles_xy(zoom)[0], coverage)
+        ld('min_zoom', zoom, 'tile_ul', tile_ul, 'tile_lr', tile_lr)
 
+    #----------------------------
+
+    def split_zoom(self, nshards):
+        'lowest zoom with enough subtrees to balance shards'
+    #----------------------------
+        for zoom in reversed(self.zoom_range):
+            if self.tile_index.count(zoom) >= 4*nshards:
+                return zoom
+        return self.max_zoom
+
+    #----------------------------
+
+    def shard_roots(self, shard, nshards):
+        'subtree roots of a shard: a contiguous run of split zoom tiles, balanced by base tiles under them'
+    #----------------------------
+        split = self.split_zoom(nshards)
+        roots = list(self.tile_index.tiles(split))
+        weights = [self.tile_index.count_under(t, self.max_zoom) for t in roots]
+        total = float(sum(weights)) or 1.
+        own = []
+        done = 0
+        for root, weight in zip(roots, weights):
+            if int((done + weight/2.) * nshards / total) == shard-1:
+                own.append(root)
+            done += weight
+        return split, own
+
+    #----------------------------
+
+    def shard_file(self, ext):
+        return os.path.join(self.dest, 'shard.%d-%d%s' % (self.shard[0], self.shard[1], ext))
+
+    #----------------------------
+
+    def walk_shard(self):
+        'generate subtrees of a shard, top levels and a tilemap are left to finalize_shards'
+    #----------------------------
+        assert self.store.files, 'Sharding requires a directory tile store'
+        shard, nshards = self.shard
+        split, roots = self.shard_roots(shard, nshards)
+        ld('shard', shard, nshards, 'split zoom', split, 'roots', len(roots))
+
+        expected = dict((z, sum(self.tile_index.count_under(r, z) for r in roots))
+            for z in self.zoom_range if z >= split)
+        self.monitor = ProgressMonitor(self.progress_hook, self.src, expected)
+        self.monitor.start()
+
+        self.base_reads = expected[self.max_zoom] # the subtrees of this shard only
+        started = time.time()
+        self.make_raster(self.max_zoom)
+        self.make_global_palette(self.base_img)
+        self.monitor.raster(time.time() - started)
+
+        results = filter(None, map(self.proc_tile, roots))
+
+        TransparencyIndex.write(self.shard_file('.idx'),
+            flatten((opacities for img, ch, opacities in results)))
+        self.metrics['progress'] = self.monitor.totals()
+        manifest = {
+            'shard':        shard,
+            'shards':       nshards,
+            'split_zoom':   split,
+            'roots':        [list(tile) + [opacities[0][1]] for img, tile, opacities in results],
+            'formats':      dict(('%i/%i/%i' % t, ext) for t, ext in self.tile_formats.items()),
+            'palette':      self.global_palette.getpalette() if self.global_palette else None,
+            'metrics':      self.metrics,
+            }
+        # the manifest is the last one written: a shard is complete when it exists
+        temp_manifest = self.shard_file('.json.tmp')
+        with open(temp_manifest, 'w') as f:
+            json.dump(manifest, f)
+        os.rename(temp_manifest, self.shard_file('.json'))
+
+        self.monitor.finish()
         self.progress(finished=True)
 
     #----------------------------
 
+    def finalize_shards(self):
+        'build the top levels from the tiles written by all shards, write a tilemap'
+    #----------------------------
+        assert self.store.files, 'Sharding requires a directory tile store'
+        manifest_files = glob.glob(os.path.join(self.dest, 'shard.*-*.json'))
+        manifests = []
+        for path in manifest_files:
+            with open(path) as f:
+                manifests.append(json.load(f))
+        nshards = set(m['shards'] for m in manifests)
+        shards = set(m['shard'] for m in manifests)
+        if len(nshards) != 1 or shards != set(range(1, list(nshards)[0]+1)):
+            logging.error('%s: incomplete shards %s of %s' % (self.dest, sorted(shards), sorted(nshards)))
+            return
+        split = manifests[0]['split_zoom']
+        nshards = list(nshards)[0]
+        ld('finalize', nshards, 'split zoom', split)
+
+        self.shard_zoom = split
+        self.shard_leaves = {}
+        transparency = []
+        for m in manifests:
+            for z, x, y, opacity in m['roots']:
+                self.shard_leaves[(z, x, y)] = opacity
+            for key, ext in m['formats'].items():
+                self.tile_formats[tuple(map(int, key.split('/')))] = ext
+            self.shard = (m['shard'], nshards)
+            if os.path.exists(self.shard_file('.idx')):
+                idx = TransparencyIndex(self.shard_file('.idx'))
+                transparency.extend(idx.items())
+                idx.close()
+        self.metrics['shards'] = [m['metrics'] for m in manifests]
+        if manifests[0].get('palette'): # the same for all the shards
+            self.set_global_palette(manifests[0]['palette'])
+
+        upper_zooms = [z for z in self.zoom_range if z <= split]
+        self.monitor = ProgressMonitor(self.progress_hook, self.src,
+            dict((z, self.tile_index.count(z)) for z in upper_zooms))
+        self.monitor.start()
+
+        if not self.name:
+            self.name = os.path.basename(self.dest)
+
+        top_results = filter(None, map(self.proc_tile, self.tile_index.tiles(self.zoom_range[-1])))
+        self.write_metadata(None, [ch for img, ch, opacities in top_results])
+
+        # split zoom opacities are in the shard indexes already
+        transparency.extend(flatten(([o for o in opacities if o[0][0] < split]
+            for img, ch, opacities in top_results)))
+        self.store.write_transparency(transparency)
+        self.store.write_metrics(self.metrics)
+        self.store.close()
+
+        for m in manifests:
+            self.shard = (m['shard'], nshards)
+            for ext in ('.json', '.idx'):
+                try:
+                    os.remove(self.shard_file(ext))
+                except os.error: pass
+
+        self.monitor.finish()
+        self.progress(finished=True)
+
+    #----------------------------
+
+    def read_shard_tile(self, tile):
+        'split zoom tile written by a shard'
+    #----------------------------
+        opacity = self.shard_leaves.get(tile)
+        if opacity is None:
+            return None, 0
+        tile_img = Image.open(os.path.join(self.dest, self.tile_path(tile)))
+        tile_img.load()
+        if tile_img.mode == 'P' and self.palette is None: # paletted tile format
+            tile_img = tile_img.convert('RGBA')
+        return tile_img, opacity
+
+    #----------------------------
+
+    def plan_pyramid(self):
+        'estimate tile counts, size and run time from a sample of base tiles, nothing is written'
+    #----------------------------
+        self.dry_run = True
+        self.work_dir = tempfile.mkdtemp(prefix='gdal_tiler.') # auxiliary VRTs only, removed with the pyramid
+
+        if not self.init_map(self.options.zoom):
+            return None
+        self.index_tiles()
+
+        started = time.time()
+        self.make_raster(self.max_zoom)
+        self.make_global_palette(self.base_img)
+        raster_seconds = time.time() - started
+
+        # warp and encode evenly spaced base tiles
+        nsamples = self.options.plan_samples or 16
+        base_count = self.tile_index.count(self.max_zoom)
+        step = max(1, base_count // nsamples)
+        sample = list(itertools.islice(self.tile_index.tiles(self.max_zoom), 0, None, step))[:nsamples]
+        sample_pixbounds = self.tile_pixbounds_lst([self.tile_index.physical(t) for t in sample])
+        warp_seconds = encode_seconds = merge_seconds = 0.
+        sizes = []
+        for pixbounds in sample_pixbounds:
+            started = time.time()
+            tile_img, opacity = self.base_img.get_tile(pixbounds)
+            warp_seconds += time.time() - started
+            if tile_img is None or opacity == 0:
+                continue
+            if self.palette:
+                tile_img.putpalette(self.palette)
+
+            started = time.time()
+            tile_format, img, save_opt = self.tile_encoding(tile_img, opacity)
+            buf = StringIO.StringIO()
+            img.save(buf, tile_format, **save_opt)
+            sizes.append(len(buf.getvalue()))
+            encode_seconds += time.time() - started
+
+            started = time.time() # child's share of an overview tile
+            tile_img.resize([i//2 for i in tile_img.size], self.resampling)
+            merge_seconds += time.time() - started
+
+        nsampled = len(sample)
+        nfilled = len(sizes)
+        filled = float(nfilled) / nsampled if nsampled else 0.
+        warp_tile = warp_seconds / nsampled if nsampled else 0.
+        warp_tile /= self.metatile**2 # each sample warps a metatile of its own
+        encode_tile = encode_seconds / nfilled if nfilled else 0.
+        merge_tile = merge_seconds / nfilled if nfilled else 0.
+        tile_bytes = float(sum(sizes)) / nfilled if nfilled else 0.
+        block = 4096 if self.store.files else 1 # file system allocation unit
+        tile_disk = float(sum(((b + block - 1) // block) * block for b in sizes)) / nfilled if nfilled else 0.
+
+        zooms = {}
+        seconds = raster_seconds
+        for zoom in self.zoom_range:
+            count = self.tile_index.count(zoom)
+            tiles = int(round(count * filled))
+            if zoom == self.max_zoom:
+                seconds += count * warp_tile + tiles * encode_tile
+            else:
+                seconds += tiles * (4 * merge_tile + encode_tile)
+            zooms[str(zoom)] = {
+                'indexed':  count,
+                'tiles':    tiles,
+                'bytes':    int(tiles * tile_bytes),
+                'disk':     int(tiles * tile_disk),
+                }
+
+        plan = {
+            'source':       self.src,
+            'dest':         self.dest,
+            'zoom_range':   [self.zoom_range[-1], self.max_zoom],
+            'zooms':        zooms,
+            'tiles':        sum(z['tiles'] for z in zooms.values()),
+            'bytes':        sum(z['bytes'] for z in zooms.values()),
+            'disk':         sum(z['disk'] for z in zooms.values()),
+            'seconds':      seconds,
+            'warp':         self.metrics.get('warp'),
+            'sample': {
+                'tiles':            nsampled,
+                'filled':           nfilled,
+                'tile_bytes':       tile_bytes,
+                'raster_seconds':   raster_seconds,
+                'warp_seconds':     warp_tile,
+                'encode_seconds':   encode_tile,
+                'merge_seconds':    merge_tile,
+                },
+            }
+        ld('plan', plan)
+        return plan
+
+    #----------------------------
+
     def proc_tile(self, tile):
 
     #----------------------------
@@ -721,9 +1472,17 @@ class Pyramid(object):
         ch_opacities = []
         ch_results = []
         zoom, x, y = tile
-        if zoom == self.max_zoom: # get from the base image
-            src_tile = self.tile_map[tile]
+        if self.shard_leaves is not None and zoom == self.shard_zoom: # written by a shard
+            tile_img, opacity = self.read_shard_tile(tile)
+            self.monitor.done(zoom, tile_img is not None)
+            if tile_img is not None:
+                return tile_img, tile, [(tile, opacity)]
+            return None
+        elif zoom == self.max_zoom: # get from the base image
+            src_tile = self.tile_index.physical(tile)
+            started = time.time() # the warp is done on demand by the base image reads
             tile_img, opacity = self.base_img.get_tile(self.tile_pixbounds(src_tile))
+            self.monitor.warped(zoom, time.time() - started)
             if tile_img and self.palette:
                 tile_img.putpalette(self.palette)
         else: # merge children
@@ -737,14 +1496,12 @@ class Pyramid(object):
             ofs = [0 if tsz[i] > 0 else -tsz[i]+ch_sz[i] for i in (0, 1)]   # if negative -- needs to go in descending order
             #~ ld('tsz, ch_sz, ofs', tsz, ch_sz, ofs)
 
-            ch_mozaic = dict(flatten(  # child tile: offsets to inside a parent tile
-                [[((ch_zoom, x*dz+dx, y*dz+dy),
-                        (ofs[0]+dx*ch_sz[0], ofs[1]+dy*ch_sz[1]))
-                    for dx in range(dz)]
-                for dy in range(dz)]))
+            ch_mozaic = dict([  # child tile: offsets to inside a parent tile
+                (ch, (ofs[0]+dx*ch_sz[0], ofs[1]+dy*ch_sz[1]))
+                for ch, (dx, dy) in self.tile_index.children(tile, ch_zoom)]) # only real children
             #ld(tile, ch_mozaic)
 
-            children = self.all_tiles & frozenset(ch_mozaic) # get only real children
+            children = ch_mozaic.keys()
             ch_results = filter(None, map(self.proc_tile, children))
             #~ ld('tile', tile, 'children', children, 'ch_results', ch_results)
 
@@ -781,31 +1538,53 @@ class Pyramid(object):
                 ch_opacities.extend(opacity_lst)
 
         #~ ld('proc_tile', tile, tile_img, opacity)
-        if tile_img is not None and opacity != 0:
-            self.write_tile(tile, tile_img)
+        rendered = tile_img is not None and opacity != 0
+        if rendered:
+            self.write_tile(tile, tile_img, opacity)
 
             # write tile-level metadata (html/kml)
             self.write_metadata(tile, [ch for img, ch, opacities in ch_results])
+        self.monitor.done(zoom, rendered)
+        if rendered:
             return tile_img, tile, [(tile, opacity)]+ch_opacities
 
     #----------------------------
 
-    def write_tile(self, tile, tile_img):
+    def write_tile(self, tile, tile_img, opacity=-1):
 
     #----------------------------
-        rel_path = self.tile_path(tile)
-        full_path = os.path.join(self.dest, rel_path)
-        try:
-            os.makedirs(os.path.dirname(full_path))
-        except: pass
+        tile_format, tile_img, save_opt = self.tile_encoding(tile_img, opacity)
+        if tile_format != self.options.tile_format and self.options.opaque_ext != self.tile_ext:
+            self.tile_formats[tile] = self.options.opaque_ext # mixed-format mode
+
+        started = time.time()
+        nbytes = self.store.write_tile(tile, tile_img, tile_format, save_opt)
+        self.monitor.written(tile[0], nbytes, time.time() - started)
+
+        self.progress()
 
+    #----------------------------
+
+    def tile_encoding(self, tile_img, opacity=-1):
+        'image format, converted image and save options for a tile'
+    #----------------------------
         tile_format = self.options.tile_format
+        save_opt = {}
+        if opacity == 1 and self.options.opaque_format: # mixed-format mode
+            tile_format = self.options.opaque_format
+            save_opt['quality'] = self.options.opaque_quality
+
         if self.options.paletted and tile_format == 'png':
-            try:
-                tile_img = tile_img.convert('P', palette=Image.ADAPTIVE, colors=255)
-            except ValueError:
-                #ld('tile_img.mode', tile_img.mode)
-                pass
+            if self.global_palette is not None and tile_img.mode != 'P':
+                if 'A' in tile_img.mode:
+                    save_opt['transparency'] = 255
+                tile_img = self.to_global_palette(tile_img)
+            else:
+                try:
+                    tile_img = tile_img.convert('P', palette=Image.ADAPTIVE, colors=255)
+                except ValueError:
+                    #ld('tile_img.mode', tile_img.mode)
+                    pass
         elif tile_img.mode == 'P' and tile_format in ('jpeg', 'webp'):
             mode = 'RGB' # + 'A' if self.transparency else ''
             try:
@@ -814,12 +1593,54 @@ class Pyramid(object):
                 #ld('tile_img.mode', tile_img.mode)
                 pass
 
-        if self.transparency is not None:
-            tile_img.save(full_path, transparency=self.transparency)
-        else:
-            tile_img.save(full_path)
+        if self.transparency is not None and tile_img.mode == 'P':
+            save_opt['transparency'] = self.transparency
+        return tile_format, tile_img, save_opt
 
-        self.progress()
+    #----------------------------
+
+    def make_global_palette(self, base_img):
+        'one palette for all the paletted tiles, quantized from a sample of base tiles'
+    #----------------------------
+        if not (self.options.paletted and self.options.global_palette) or self.palette is not None:
+            return
+        nsamples = self.options.palette_samples or 16
+        base_count = self.tile_index.count(self.max_zoom)
+        step = max(1, base_count // nsamples)
+        pixels = []
+        for tile in itertools.islice(self.tile_index.tiles(self.max_zoom), 0, None, step):
+            tile_img, opacity = base_img.get_tile(self.tile_pixbounds(self.tile_index.physical(tile)))
+            if tile_img is None or opacity == 0:
+                continue
+            thumb = tile_img.resize([max(1, i//4) for i in tile_img.size], Image.NEAREST)
+            rgb = thumb.convert('RGB').getdata()
+            if 'A' in thumb.mode: # visible pixels only
+                pixels.extend(p for p, a in itertools.izip(rgb, thumb.split()[-1].getdata()) if a)
+            else:
+                pixels.extend(rgb)
+            nsamples -= 1
+            if nsamples == 0:
+                break
+        if not pixels:
+            return
+        sample_img = Image.new('RGB', (len(pixels), 1))
+        sample_img.putdata(pixels)
+        self.set_global_palette(sample_img.quantize(colors=255).getpalette())
+        ld('global palette', len(pixels))
+
+    def set_global_palette(self, palette):
+        'index 255 is kept for transparency'
+        palette = list(palette[:255*3])
+        palette += palette[:3]*(256-len(palette)//3) # duplicates of a lower index are never picked
+        self.global_palette = Image.new('P', (1, 1))
+        self.global_palette.putpalette(palette)
+
+    def to_global_palette(self, tile_img):
+        'tile mapped to the global palette'
+        p_img = tile_img.convert('RGB').quantize(palette=self.global_palette)
+        if 'A' in tile_img.mode:
+            p_img.paste(255, None, tile_img.split()[-1].point(lambda a: 255 if a < 128 else 0))
+        return p_img
 
     #----------------------------
 
@@ -827,7 +1648,7 @@ class Pyramid(object):
         'translate "logical" tiles to latlong boxes'
     #----------------------------
         # via 'logical' to 'physical' tile mapping
-        return self.bounds_lst2longlat([self.tile_bounds(self.tile_map[t]) for t in tiles])
+        return self.bounds_lst2longlat(self.tile_bounds_lst([self.tile_index.physical(t) for t in tiles]))
 
     #----------------------------
 
@@ -844,9 +1665,9 @@ class Pyramid(object):
     #----------------------------
 
         # reproject extents back to the unshifted SRS
-        bbox = GdalTransformer(SRC_SRS=self.proj_srs, DST_SRS=self.srs).transform(self.bounds)
+        bbox = srs_transformer(self.proj_srs, self.srs).transform(self.bounds)
         # get back unshifted tile origin
-        un_tile_origin = GdalTransformer(SRC_SRS=self.geog_srs, DST_SRS=self.srs).transform_point(self.tile_geo_origin)
+        un_tile_origin = srs_transformer(self.geog_srs, self.srs).transform_point(self.tile_geo_origin)
         ld('un_tile_origin', un_tile_origin, self.tile_geo_origin, self.geog_srs, self.srs)
 
         tile_mime = mime_from_ext(self.tile_ext)
@@ -882,8 +1703,11 @@ class Pyramid(object):
                 for zoom in reversed(self.zoom_range)]),
             }
 
+        if self.tile_formats: # mixed-format mode: record tiles in a non-default format
+            tilemap['tiles']['formats'] = dict([
+                ('%i/%i/%i' % tile, ext[1:]) for tile, ext in self.tile_formats.items()])
 
-        write_tilemap(self.dest, tilemap)
+        self.store.write_tilemap(tilemap)
         ld(tilemap)
 
     #----------------------------
@@ -953,6 +1777,69 @@ class Pyramid(object):
         res = self.zoom2res(zoom)
         return [pix_coord[i]*res[i]+self.pix_origin[i] for i in (0, 1)]
 
+    # batch versions of the tile grid math above: numpy arrays in and out, a row per tile or point
+
+    def zoom2res_batch(self, zooms):
+        'resolutions, (n, 2) array'
+        zooms = numpy.asarray(zooms, dtype=numpy.int64)
+        return numpy.asarray(self.zoom0_res, dtype=float) / (2.**zooms)[..., None]
+
+    def coord2pix_batch(self, zooms, coords):
+        'cartesian coordinates to pixel coordinates, zooms: a zoom or an array of them'
+        coords = numpy.asarray(coords, dtype=float).reshape(-1, 2)
+        res = self.zoom2res_batch(numpy.zeros(len(coords), numpy.int64) + zooms)
+        return round_int((coords - self.pix_origin) / res)
+
+    def pix2tile_batch(self, zooms, pix_coords):
+        'pixel coordinates to (z, x, y) tiles, (n, 3) array'
+        pix_coords = numpy.asarray(pix_coords, dtype=float).reshape(-1, 2)
+        zooms = numpy.zeros(len(pix_coords), numpy.int64) + zooms
+        res = self.zoom2res_batch(zooms)
+        tile_xy = round_int(
+            (pix_coords * res + self.pix_origin - self.tile_origin) / numpy.abs(res)
+            ) // self.tile_dim # NB tile_dim can be negative!
+        return numpy.column_stack((zooms, tile_xy))
+
+    def tile_bounds_batch(self, tiles):
+        "cartesian coordinates of tiles' corners, (n, 2, 2) array of (ul, lr)"
+        tiles = numpy.asarray(tiles, dtype=numpy.int64).reshape(-1, 3)
+        res = numpy.abs(self.zoom2res_batch(tiles[:, 0]))
+        xy1 = tiles[:, 1:] * self.tile_dim * res + self.tile_origin
+        xy2 = (1 + tiles[:, 1:]) * self.tile_dim * res + self.tile_origin
+        ul = numpy.column_stack((numpy.minimum(xy1[:, 0], xy2[:, 0]), numpy.maximum(xy1[:, 1], xy2[:, 1])))
+        lr = numpy.column_stack((numpy.maximum(xy1[:, 0], xy2[:, 0]), numpy.minimum(xy1[:, 1], xy2[:, 1])))
+        return numpy.stack((ul, lr), axis=1)
+
+    def tile_pixbounds_batch(self, tiles):
+        'pixel coordinates of tiles, (n, 2, 2) array'
+        tiles = numpy.asarray(tiles, dtype=numpy.int64).reshape(-1, 3)
+        corners = self.tile_bounds_batch(tiles).reshape(-1, 2)
+        return self.coord2pix_batch(numpy.repeat(tiles[:, 0], 2), corners).reshape(-1, 2, 2)
+
+    def corner_tiles_batch(self, zooms):
+        'corner tiles of the region, (n, 2, 3) array of (ul, lr)'
+        zooms = numpy.asarray(zooms, dtype=numpy.int64).reshape(-1)
+        zz = numpy.repeat(zooms, 2)
+        corners = numpy.tile(numpy.asarray(self.bounds, dtype=float), (len(zooms), 1))
+        return self.pix2tile_batch(zz, self.coord2pix_batch(zz, corners)).reshape(-1, 2, 3)
+
+    # lists of tiles: by the batch methods if numpy is available
+
+    def tile_bounds_lst(self, tiles):
+        if numpy is None:
+            return [self.tile_bounds(t) for t in tiles]
+        return self.tile_bounds_batch(tiles).tolist()
+
+    def tile_pixbounds_lst(self, tiles):
+        if numpy is None:
+            return [self.tile_pixbounds(t) for t in tiles]
+        return self.tile_pixbounds_batch(tiles).tolist()
+
+    def corner_tiles_lst(self, zooms):
+        if numpy is None:
+            return [self.corner_tiles(z) for z in zooms]
+        return self.corner_tiles_batch(zooms).tolist()
+
     def tiles_xy(self, zoom):
         'number of tiles along X and Y axes'
         return map(lambda v: v*2**zoom, self.zoom0_tiles)
@@ -1045,7 +1932,7 @@ class Pyramid(object):
 
     def set_region(self, point_lst, source_srs=None):
         if source_srs and source_srs != self.proj_srs:
-            point_lst = GdalTransformer(SRC_SRS=source_srs, DST_SRS=self.proj_srs).transform(point_lst)
+            point_lst = srs_transformer(source_srs, self.proj_srs).transform(point_lst)
 
         x_coords, y_coords = zip(*point_lst)[0:2]
         upper_left = min(x_coords), max(y_coords)
@@ -1063,7 +1950,7 @@ class Pyramid(object):
     tick_rate = 50
     count = 0
     def progress(self, finished=False):
-        if self.options.verbose == 0:
+        if self.options.verbose == 0 or self.dry_run or self.options.progress_json == '-': # keep stdout clean
             pass
         elif finished:
             pf('')
@@ -1090,14 +1977,14 @@ warp_vrt = '''<VRTDataset rasterXSize="%(xsize)d" rasterYSize="%(ysize)d" subCla
   <BlockXSize>%(blxsize)d</BlockXSize>
   <BlockYSize>%(blysize)d</BlockYSize>
   <GDALWarpOptions>
-    <!-- <WarpMemoryLimit>6.71089e+07</WarpMemoryLimit> -->
+    <WarpMemoryLimit>%(wo_WarpMemoryLimit)d</WarpMemoryLimit>
     <ResampleAlg>%(wo_ResampleAlg)s</ResampleAlg>
     <WorkingDataType>Byte</WorkingDataType>
     <SourceDataset relativeToVRT="0">%(wo_src_path)s</SourceDataset>
 %(warp_options)s
     <Transformer>
       <ApproxTransformer>
-        <MaxError>0.125</MaxError>
+        <MaxError>%(wo_MaxError)r</MaxError>
         <BaseTransformer>
           <GenImgProjTransformer>
 %(wo_src_transform)s
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+###############################################################################
+# Copyright (c) 2011-2013 Vadim Shlyakhov
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a
+#  copy of this software and associated documentation files (the "Software"),
+#  to deal in the Software without restriction, including without limitation
+#  the rights to use, copy, modify, merge, publish, distribute, sublicense,
+#  and/or sell copies of the Software, and to permit persons to whom the
+#  Software is furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included
+#  in all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+#  OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+#  THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#  DEALINGS IN THE SOFTWARE.
+###############################################################################
+
+from __future__ import print_function
+import StringIO
+
+from PIL import Image
+
+# in-process tile encoders in place of pngnq and cwebp runs
+
+def open_tile(data):
+    'image of an encoded tile'
+    img = Image.open(StringIO.StringIO(data))
+    img.load()
+    return img
+
+def save_tile(img, tile_format, **save_opt):
+    buf = StringIO.StringIO()
+    img.save(buf, tile_format, **save_opt)
+    return buf.getvalue()
+
+def is_opaque(img):
+    if img.mode == 'P':
+        return 'transparency' not in img.info
+    return 'A' not in img.mode or img.split()[-1].getextrema()[0] == 255
+
+def quantize_png(img, colors=256):
+    'paletted PNG of up to colors colors, transparency is kept (like pngnq)'
+    colors = min(256, int(colors))
+    if is_opaque(img):
+        p_img = img.convert('RGB').quantize(colors)
+    else:
+        p_img = img.convert('RGBA').quantize(colors, method=2) # fast octree, the one with alpha
+    return save_tile(p_img, 'png', optimize=True)
+
+def encode_webp(img, quality=75, alpha_cleanup=False, noalpha=False):
+    'WEBP; alpha_cleanup blanks invisible pixels, noalpha drops the alpha channel (like cwebp)'
+    if noalpha or is_opaque(img):
+        img = img.convert('RGB')
+    else:
+        img = img.convert('RGBA')
+        if alpha_cleanup: # constant color under the transparent pixels compresses better
+            alpha = img.split()[-1]
+            rgb = Image.new('RGB', img.size)
+            rgb.paste(img.convert('RGB'), None, alpha.point(lambda a: 255 if a else 0))
+            img = Image.merge('RGBA', rgb.split() + (alpha,))
+    return save_tile(img, 'webp', quality=int(quality))
@@ -0,0 +1,282 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+###############################################################################
+# Copyright (c) 2011-2013 Vadim Shlyakhov
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a
+#  copy of this software and associated documentation files (the "Software"),
+#  to deal in the Software without restriction, including without limitation
+#  the rights to use, copy, modify, merge, publish, distribute, sublicense,
+#  and/or sell copies of the Software, and to permit persons to whom the
+#  Software is furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included
+#  in all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+#  OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+#  THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#  DEALINGS IN THE SOFTWARE.
+###############################################################################
+
+from __future__ import print_function
+import os
+import os.path
+import re
+import math
+import glob
+from PIL import Image
+from PIL import ImageChops
+
+try:
+    from osgeo import gdal
+    from osgeo import ogr
+    from osgeo.gdalconst import *
+except ImportError:
+    import gdal
+    import ogr
+    from gdalconst import *
+
+from tiler_functions import *
+
+footprint_methods = ('auto', 'cutline', 'nodata', 'mtl')
+
+#############################
+
+class TileCoverage(object):
+    '''Tile coverage bitmap of a single zoom level'''
+#############################
+
+    def __init__(self, zoom, xmin, ymin, nx, ny, bitmap, flip_y=False):
+        self.zoom = zoom
+        self.xmin, self.ymin = xmin, ymin
+        self.nx, self.ny = nx, ny
+        self.bitmap = bitmap # one byte per tile, rows go from the top
+        self.flip_y = flip_y # tile 'y' goes upwards (TMS)
+
+    def __contains__(self, tile):
+        'is a "physical" tile within the footprint?'
+        z, x, y = tile
+        col = x - self.xmin
+        row = (self.ny - 1 - (y - self.ymin)) if self.flip_y else (y - self.ymin)
+        if z != self.zoom or not (0 <= col < self.nx and 0 <= row < self.ny):
+            return False
+        return self.bitmap[row*self.nx + col] != '\x00'
+
+    def count(self):
+        'number of tiles covered'
+        return len(self.bitmap) - self.bitmap.count('\x00')
+
+    def count_in(self, x0, x1, y0, y1):
+        'number of tiles covered within a "physical" tile range'
+        c0, c1 = max(x0 - self.xmin, 0), min(x1 - self.xmin, self.nx - 1)
+        r0, r1 = y0 - self.ymin, y1 - self.ymin
+        if self.flip_y:
+            r0, r1 = self.ny - 1 - r1, self.ny - 1 - r0
+        r0, r1 = max(r0, 0), min(r1, self.ny - 1)
+        n = 0
+        for row in range(r0, r1 + 1):
+            run = self.bitmap[row*self.nx + c0:row*self.nx + c1 + 1]
+            n += len(run) - run.count('\x00')
+        return n
+# TileCoverage
+
+#############################
+
+class Footprint(object):
+    '''Valid-data footprint of a source raster, rasterized into per zoom tile coverage bitmaps'''
+#############################
+
+    def __init__(self, rings, method=None):
+        self.rings = rings # outer rings in the pyramid's SRS, holes are not considered
+        self.method = method
+        self.coverage = {}
+
+        self.geometry = ogr.Geometry(ogr.wkbMultiPolygon)
+        for points in rings:
+            ring = ogr.Geometry(ogr.wkbLinearRing)
+            for p in points:
+                ring.AddPoint(p[0], p[1])
+            ring.CloseRings()
+            polygon = ogr.Geometry(ogr.wkbPolygon)
+            polygon.AddGeometry(ring)
+            self.geometry.AddGeometry(polygon)
+
+    #----------------------------
+
+    @classmethod
+    def from_pyramid(cls, pyramid, method='auto'):
+        'find a footprint of the pyramid source; must be called before the source dataset is closed'
+    #----------------------------
+        if method == 'auto':
+            lst = ['nodata', 'mtl']
+            if pyramid.options.cut or pyramid.options.cutline:
+                lst.insert(0, 'cutline')
+        else:
+            lst = [method]
+
+        for m in lst:
+            rings = getattr(cls, '%s_rings' % m)(pyramid)
+            if rings:
+                ld('footprint', m, len(rings))
+                return cls(rings, m)
+        logging.warning('No footprint found: %s' % ', '.join(lst))
+        return None
+
+    @staticmethod
+    def cutline_rings(pyramid):
+        'cutline from the source metadata or from an OGR datasource'
+        cut_wkt = pyramid.get_cutline()
+        if not cut_wkt:
+            return None
+        geom = ogr.CreateGeometryFromWkt(cut_wkt) # in source pixels
+        geom.Segmentize(max(pyramid.src_ds.RasterXSize, pyramid.src_ds.RasterYSize)/64.)
+        return pix_rings2srs(geom_rings(geom), pyramid)
+
+    @staticmethod
+    def nodata_rings(pyramid, max_size=1024):
+        'polygonize a reduced nodata mask of the source'
+        src_ds = pyramid.src_ds
+        xsize, ysize = src_ds.RasterXSize, src_ds.RasterYSize
+        scale = max(1., float(max(xsize, ysize))/max_size)
+        bx, by = int(math.ceil(xsize/scale)), int(math.ceil(ysize/scale))
+        bands = [src_ds.GetRasterBand(i+1) for i in range(src_ds.RasterCount)]
+
+        if pyramid.options.src_nodata:
+            nodata = map(int, pyramid.options.src_nodata.split(','))
+        else:
+            nodata = [b.GetNoDataValue() for b in bands]
+            if None in nodata:
+                nodata = None
+
+        if nodata is not None: # valid if any band is not nodata
+            mask = None
+            for band, nd in zip(bands, nodata):
+                data = band.ReadRaster(0, 0, xsize, ysize, bx, by, GDT_Byte)
+                band_mask = Image.frombuffer('L', (bx, by), data, 'raw', 'L', 0, 1).point(
+                    lambda v, nd=int(nd): 0 if v == nd else 255)
+                mask = band_mask if mask is None else ImageChops.lighter(mask, band_mask)
+        else:
+            mask_band = bands[0].GetMaskBand()
+            if bands[0].GetMaskFlags() & GMF_ALL_VALID:
+                return None
+            data = mask_band.ReadRaster(0, 0, xsize, ysize, bx, by, GDT_Byte)
+            mask = Image.frombuffer('L', (bx, by), data, 'raw', 'L', 0, 1)
+
+        mask_ds = gdal.GetDriverByName('MEM').Create('', bx, by, 1, GDT_Byte)
+        mask_ds.GetRasterBand(1).WriteRaster(0, 0, bx, by, mask.tobytes())
+
+        ogr_ds = ogr.GetDriverByName('Memory').CreateDataSource('wrk')
+        layer = ogr_ds.CreateLayer('footprint')
+        layer.CreateField(ogr.FieldDefn('value', ogr.OFTInteger))
+        mask_band = mask_ds.GetRasterBand(1)
+        gdal.Polygonize(mask_band, mask_band, layer, 0)
+
+        geom = ogr.Geometry(ogr.wkbMultiPolygon)
+        for feature in layer:
+            geom.AddGeometry(feature.GetGeometryRef())
+        if geom.GetGeometryCount() == 0:
+            return None
+        # the mask is sampled, so grow it by a sample to keep thin slivers
+        geom = geom.Buffer(1.5, 1).SimplifyPreserveTopology(0.5)
+        geom.Segmentize(max_size/64.)
+        rings = [[(p[0]*scale, p[1]*scale) for p in r] for r in geom_rings(geom)]
+        return pix_rings2srs(rings, pyramid)
+
+    @staticmethod
+    def mtl_rings(pyramid):
+        '''scene corners from Landsat MTL metadata
+        NB: these are the corners of the product image, the data footprint is within'''
+        mtl_path = pyramid.options.mtl or find_mtl(pyramid.src)
+        if not mtl_path:
+            return None
+        corners = read_mtl_corners(mtl_path)
+        if not corners:
+            return None
+        geom = ogr.Geometry(ogr.wkbLinearRing)
+        for c in ('UL', 'UR', 'LR', 'LL', 'UL'):
+            geom.AddPoint(*corners[c])
+        geom.Segmentize(0.05) # degrees
+        ring = [geom.GetPoint(i)[:2] for i in range(geom.GetPointCount())]
+        return [srs_transformer(pyramid.geog_srs, pyramid.proj_srs).transform(ring)]
+
+    #----------------------------
+
+    def tile_coverage(self, pyramid, zoom):
+        'rasterize the footprint into a bitmap of tiles at the zoom level'
+    #----------------------------
+        if zoom in self.coverage:
+            return self.coverage[zoom]
+
+        tile_ul, tile_lr = pyramid.corner_tiles(zoom)
+        xmin, xmax = sorted((tile_ul[1], tile_lr[1]))
+        ymin, ymax = sorted((tile_ul[2], tile_lr[2]))
+        nx, ny = xmax-xmin+1, ymax-ymin+1
+
+        res = pyramid.zoom2res(zoom)
+        dx, dy = [pyramid.tile_dim[i]*abs(res[i]) for i in (0, 1)]
+        flip_y = dy > 0
+        top = pyramid.tile_origin[1] + (ymax+1 if flip_y else ymin)*dy
+        # north-up raster with a pixel per tile
+        geotr = (pyramid.tile_origin[0] + xmin*dx, dx, 0.0, top, 0.0, -abs(dy))
+
+        cov_ds = gdal.GetDriverByName('MEM').Create('', nx, ny, 1, GDT_Byte)
+        cov_ds.SetGeoTransform(geotr)
+
+        ogr_ds = ogr.GetDriverByName('Memory').CreateDataSource('wrk')
+        layer = ogr_ds.CreateLayer('footprint')
+        feature = ogr.Feature(layer.GetLayerDefn())
+        feature.SetGeometry(self.geometry.Buffer(abs(res[0]))) # a pixel to spare
+        layer.CreateFeature(feature)
+
+        gdal.RasterizeLayer(cov_ds, [1], layer, burn_values=[1], options=['ALL_TOUCHED=TRUE'])
+        bitmap = cov_ds.GetRasterBand(1).ReadRaster(0, 0, nx, ny)
+
+        coverage = TileCoverage(zoom, xmin, ymin, nx, ny, bitmap, flip_y)
+        ld('tile_coverage', zoom, nx, ny, coverage.count())
+        self.coverage[zoom] = coverage
+        return coverage
+# Footprint
+
+def geom_rings(geom):
+    'outer rings of a (multi)polygon as point lists'
+    name = geom.GetGeometryName()
+    if name == 'MULTIPOLYGON':
+        return flatten([geom_rings(geom.GetGeometryRef(i)) for i in range(geom.GetGeometryCount())])
+    if name == 'POLYGON' and geom.GetGeometryCount() > 0:
+        ring = geom.GetGeometryRef(0)
+        return [[ring.GetPoint(i)[:2] for i in range(ring.GetPointCount())]]
+    return []
+
+def pix_rings2srs(rings, pyramid):
+    'source pixel coordinates to the pyramid SRS'
+    pix_tr = pyramid.geometry.transformer(pyramid.proj_srs)
+    return [pix_tr.transform(r) for r in rings]
+
+def find_mtl(src):
+    'Landsat MTL file next to a scene band'
+    src_dir, src_f = os.path.split(os.path.abspath(src))
+    scene = re.sub(r'_(B[0-9]+|BQA)$', '', os.path.splitext(src_f)[0], flags=re.I)
+    mtl_path = os.path.join(src_dir, scene + '_MTL.txt')
+    if os.path.exists(mtl_path):
+        return mtl_path
+    mtl_lst = glob.glob(os.path.join(src_dir, '*_MTL.txt'))
+    return mtl_lst[0] if len(mtl_lst) == 1 else None
+
+def read_mtl_corners(mtl_path):
+    'read CORNER_XX_LAT/LON_PRODUCT values as {corner: (lon, lat)}'
+    values = {}
+    with open(mtl_path, 'rU') as f:
+        for l in f:
+            m = re.match(r'\s*CORNER_(UL|UR|LR|LL)_(LAT|LON)_PRODUCT\s*=\s*([-+0-9.eE]+)', l)
+            if m:
+                values[m.group(1), m.group(2)] = float(m.group(3))
+    try:
+        return dict([(c, (values[c, 'LON'], values[c, 'LAT'])) for c in ('UL', 'UR', 'LR', 'LL')])
+    except KeyError:
+        ld('read_mtl_corners: no corners', mtl_path)
+        return None
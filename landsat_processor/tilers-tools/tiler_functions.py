@@ -41,6 +41,8 @@ import locale
 import csv
 import htmlentitydefs
 import json
+import struct
+import mmap
 
 try:
     from osgeo import gdal
@@ -62,6 +64,11 @@ try:
 except:
     multiprocessing = None
 
+try:
+    import numpy # batch tile grid math
+except ImportError:
+    numpy = None
+
 def data_dir():
     return sys.path[0]
 
@@ -90,6 +97,9 @@ def set_nothreads():
     global multiprocessing
     multiprocessing = None
 
+def multiprocessing_enabled():
+    return multiprocessing is not None
+
 def parallel_map(func, iterable):
     ld('parallel_map', multiprocessing)
     #~ return map(func, iterable)
@@ -105,9 +115,29 @@ def parallel_map(func, iterable):
         mp_pool.join()
     return res
 
+def cpu_count():
+    try:
+        return multiprocessing.cpu_count()
+    except (AttributeError, NotImplementedError): # multiprocessing is disabled or unavailable
+        try:
+            return os.sysconf('SC_NPROCESSORS_ONLN')
+        except (AttributeError, ValueError, OSError):
+            return 1
+
+def memory_size():
+    'physical memory size in bytes'
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (AttributeError, ValueError, OSError):
+        return 1 << 30
+
 def flatten(two_level_list):
     return list(itertools.chain(*two_level_list))
 
+def round_int(values):
+    'numpy array rounded half away from zero like round(), as integers'
+    return numpy.where(values >= 0, numpy.floor(values + 0.5), numpy.ceil(values - 0.5)).astype(numpy.int64)
+
 htmlentitydefs.name2codepoint['apos'] = ord(u"'")
 
 def strip_html(text):
@@ -150,6 +180,24 @@ def path2list(path):
     split.reverse()
     return split
 
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir # python 2 backport
+    except ImportError:
+        class DirEntry(object):
+            'os.DirEntry subset, files are not stat()-ed'
+            def __init__(self, dir_path, name):
+                self.name = name
+                self.path = os.path.join(dir_path, name)
+
+            def is_dir(self):
+                return os.path.isdir(self.path)
+
+        def scandir(path):
+            return (DirEntry(path, name) for name in os.listdir(path))
+
 try:
     import win32pipe
 except:
@@ -302,6 +350,16 @@ class GdalTransformer(gdal.Transformer):
         return self.transform([point], inv=inv)[0]
 # GdalTransformer
 
+srs_transformers = {}
+
+def srs_transformer(src_srs, dst_srs):
+    'SRS to SRS transformer, built once per process'
+    key = (src_srs, dst_srs)
+    tr = srs_transformers.get(key)
+    if tr is None:
+        tr = srs_transformers[key] = GdalTransformer(SRC_SRS=src_srs, DST_SRS=dst_srs)
+    return tr
+
 def sasplanet_hlg2ogr(fname):
     with open(fname) as f:
         lines = f.readlines(4096)
@@ -456,6 +514,13 @@ def write_tilemap(dst_dir, tilemap):
     with open(f, 'w') as f:
          json.dump(tilemap, f, indent=2)
 
+def write_metrics(dst_dir, metrics):
+    try:
+        with open(os.path.join(dst_dir, 'metrics.json'), 'w') as f:
+            json.dump(metrics, f, indent=2)
+    except:
+        logging.warning("metrics save failure")
+
 def link_or_copy(src, dst):
         try:
             if os.path.exists(dst):
@@ -474,6 +539,19 @@ def copy_viewer(dest):
         link_or_copy(src, dst) # hard links as FF dereferences softlinks
 
 def read_transparency(src_dir):
+    'open a transparency index, None if there is none'
+    path = os.path.join(src_dir, TransparencyIndex.file_name)
+    if not os.path.exists(path):
+        ld("no transparency index", path)
+        return None
+    try:
+        return TransparencyIndex(path)
+    except (IOError, ValueError, struct.error):
+        ld("transparency index load failure")
+        return None
+
+def read_transparency_json(src_dir):
+    'legacy transparency cache keyed by tile paths'
     try:
         with open(os.path.join(src_dir, 'transparency.json'), 'r') as f:
             transparency = json.load(f)
@@ -483,12 +561,108 @@ def read_transparency(src_dir):
     return transparency
 
 def write_transparency(dst_dir, transparency):
+    'write ((z, x, y), opacity) pairs into a transparency index'
     try:
-        with open(os.path.join(dst_dir, 'transparency.json'), 'w') as f:
-            json.dump(transparency, f, indent=0)
+        TransparencyIndex.write(os.path.join(dst_dir, TransparencyIndex.file_name), transparency)
     except:
         logging.warning("transparency cache save failure")
 
+class TransparencyIndex(object):
+    '''Tile opacities packed 2 bits per tile into per zoom bitmaps, memory mapped for O(1) lookups
+
+    header:   4s magic, H version, H number of zooms
+    zooms:    i zoom, i xmin, i ymin, i nx, i ny, Q bitmap offset
+    bitmaps:  tile (x, y) is at (y-ymin)*nx + (x-xmin), 4 tiles per byte starting from the lowest bits
+    '''
+    file_name = 'transparency.idx'
+    magic = 'TRIX'
+    version = 1
+    header = struct.Struct('<4sHH')
+    zoom_entry = struct.Struct('<iiiiiQ')
+
+    # opacity: 1 - opaque, 0 - transparent, -1 - partially transparent
+    opacity2code = {0: 1, 1: 2, -1: 3}
+    code2opacity = (None, 0, 1, -1) # code 0 - unknown tile
+
+    def __init__(self, path):
+        self.path = path
+        self.open()
+
+    def open(self):
+        with open(self.path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, nzooms = self.header.unpack_from(self.map, 0)
+        if magic != self.magic or version != self.version:
+            raise ValueError('Invalid transparency index: %s' % self.path)
+        self.zooms = {}
+        for i in range(nzooms):
+            entry = self.zoom_entry.unpack_from(self.map, self.header.size + i*self.zoom_entry.size)
+            self.zooms[entry[0]] = entry[1:]
+
+    def __getstate__(self): # mmap can not be pickled, re-open in a child process
+        return {'path': self.path}
+
+    def __setstate__(self, state):
+        self.path = state['path']
+        self.open()
+
+    def get(self, tile, default=None):
+        'opacity of a tile'
+        z, x, y = tile
+        try:
+            xmin, ymin, nx, ny, offset = self.zooms[z]
+        except KeyError:
+            return default
+        col, row = x-xmin, y-ymin
+        if not (0 <= col < nx and 0 <= row < ny):
+            return default
+        i = row*nx + col
+        code = (ord(self.map[offset + i//4]) >> (i % 4)*2) & 3
+        return self.code2opacity[code] if code else default
+
+    def items(self):
+        'all ((z, x, y), opacity) pairs'
+        for z, (xmin, ymin, nx, ny, offset) in self.zooms.items():
+            for i in range(nx*ny):
+                code = (ord(self.map[offset + i//4]) >> (i % 4)*2) & 3
+                if code:
+                    yield (z, xmin + i % nx, ymin + i // nx), self.code2opacity[code]
+
+    def close(self):
+        self.map.close()
+
+    @classmethod
+    def write(cls, path, transparency):
+        zoom_tiles = {}
+        for (z, x, y), opacity in transparency:
+            zoom_tiles.setdefault(z, []).append((x, y, cls.opacity2code[opacity]))
+
+        entries = []
+        bitmaps = []
+        offset = cls.header.size + len(zoom_tiles)*cls.zoom_entry.size
+        for z in sorted(zoom_tiles):
+            tiles = zoom_tiles[z]
+            xx, yy, codes = zip(*tiles)
+            xmin, ymin = min(xx), min(yy)
+            nx, ny = max(xx)-xmin+1, max(yy)-ymin+1
+            bitmap = bytearray((nx*ny+3)//4)
+            for x, y, code in tiles:
+                i = (y-ymin)*nx + x-xmin
+                bitmap[i//4] |= code << (i % 4)*2
+            entries.append(cls.zoom_entry.pack(z, xmin, ymin, nx, ny, offset))
+            bitmaps.append(bitmap)
+            offset += len(bitmap)
+
+        if os.path.exists(path):
+            os.remove(path) # it might be mapped by a reader
+        with open(path, 'wb') as f:
+            f.write(cls.header.pack(cls.magic, cls.version, len(entries)))
+            for e in entries:
+                f.write(e)
+            for b in bitmaps:
+                f.write(b)
+# TransparencyIndex
+
 type_map = (
     ('image/png', '.png', '\x89PNG\x0D\x0A\x1A\x0A'),
     ('image/jpeg', '.jpg', '\xFF\xD8\xFF\xE0'),
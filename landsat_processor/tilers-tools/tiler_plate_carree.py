@@ -82,6 +82,8 @@ class PlateCarree(Pyramid):
 
     def write_metadata(self, tile=None, children=[]):
         super(PlateCarree, self).write_metadata(tile, children)
+        if not self.store.files:
+            return
 
         if tile is None: # create top level kml
             self.write_kml(os.path.basename(self.base), os.path.basename(self.base), self.kml_child_links(children))
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+###############################################################################
+# Copyright (c) 2011-2013 Vadim Shlyakhov
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a
+#  copy of this software and associated documentation files (the "Software"),
+#  to deal in the Software without restriction, including without limitation
+#  the rights to use, copy, modify, merge, publish, distribute, sublicense,
+#  and/or sell copies of the Software, and to permit persons to whom the
+#  Software is furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included
+#  in all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+#  OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+#  THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#  DEALINGS IN THE SOFTWARE.
+###############################################################################
+
+from __future__ import print_function
+import sys
+import time
+import json
+
+from tiler_functions import *
+
+#############################
+
+class ProgressMonitor(object):
+    '''Per zoom tile counters and timings, reported to a hook as events
+
+    The hook is called as hook(event, data) where data is a dict. Events:
+      start       -- zoom levels with expected tile counts
+      raster      -- base raster set up (seconds)
+      zoom_start  -- first tile of a zoom level
+      tiles       -- periodic counters of a zoom level, throughput and ETA
+      zoom_end    -- all expected tiles of a zoom level are done
+      finish      -- totals
+    Every event carries 'source' and 'time' to tell parallel jobs apart and to detect stalls.
+    '''
+#############################
+    tick_rate = 50 # tiles between 'tiles' events
+
+    def __init__(self, hook, source, expected):
+        self.hook = hook
+        self.source = source
+        self.expected = expected # {zoom: tile count}
+        self.zooms = {}
+        self.started = time.time()
+
+    def emit(self, event, **data):
+        if self.hook is None:
+            return
+        data['source'] = self.source
+        data['time'] = time.time()
+        try:
+            self.hook(event, data)
+        except Exception as exc:
+            logging.warning('progress hook failure: %s' % exc)
+
+    def start(self):
+        self.emit('start', zooms=dict((str(z), n) for z, n in self.expected.items()),
+            expected=sum(self.expected.values()))
+
+    def raster(self, seconds):
+        self.emit('raster', seconds=seconds)
+
+    def stats(self, zoom):
+        st = self.zooms.get(zoom)
+        if st is None:
+            st = self.zooms[zoom] = dict(
+                zoom=zoom, expected=self.expected.get(zoom, 0), done=0,
+                rendered=0, skipped=0, written=0, bytes=0,
+                warp_seconds=0., encode_seconds=0., started=time.time())
+            self.emit('zoom_start', zoom=zoom, expected=st['expected'])
+        return st
+
+    def zoom_report(self, st):
+        rep = dict(st)
+        elapsed = time.time() - st['started']
+        rep['elapsed'] = elapsed
+        rep['rate'] = st['done'] / elapsed if elapsed > 0 else 0.
+        left = st['expected'] - st['done']
+        rep['eta'] = left / rep['rate'] if rep['rate'] > 0 else None
+        del rep['started']
+        return rep
+
+    def warped(self, zoom, seconds):
+        'base tile read from the warped raster'
+        self.stats(zoom)['warp_seconds'] += seconds
+
+    def written(self, zoom, nbytes, seconds):
+        'tile encoded and stored'
+        st = self.stats(zoom)
+        st['written'] += 1
+        st['bytes'] += nbytes or 0
+        st['encode_seconds'] += seconds
+
+    def done(self, zoom, rendered):
+        'tile processed, either rendered or skipped as transparent'
+        st = self.stats(zoom)
+        st['done'] += 1
+        st['rendered' if rendered else 'skipped'] += 1
+        if st['done'] == st['expected']:
+            self.emit('zoom_end', **self.zoom_report(st))
+        elif st['done'] % self.tick_rate == 0:
+            self.emit('tiles', **self.zoom_report(st))
+
+    def totals(self):
+        tot = dict(rendered=0, skipped=0, written=0, bytes=0, warp_seconds=0., encode_seconds=0.)
+        for st in self.zooms.values():
+            for key in tot:
+                tot[key] += st[key]
+        tot['elapsed'] = time.time() - self.started
+        return tot
+
+    def finish(self):
+        self.emit('finish', **self.totals())
+# ProgressMonitor
+
+def json_progress_hook(path):
+    'hook writing events as JSON lines to a file, "-" for stdout'
+    f = sys.stdout if path == '-' else open(path, 'a')
+    def hook(event, data):
+        data = dict(data, event=event)
+        f.write(json.dumps(data, sort_keys=True) + '\n') # one write per line: atomic for parallel jobs
+        f.flush()
+    return hook
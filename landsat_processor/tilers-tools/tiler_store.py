@@ -0,0 +1,476 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+###############################################################################
+# Copyright (c) 2011-2013 Vadim Shlyakhov
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a
+#  copy of this software and associated documentation files (the "Software"),
+#  to deal in the Software without restriction, including without limitation
+#  the rights to use, copy, modify, merge, publish, distribute, sublicense,
+#  and/or sell copies of the Software, and to permit persons to whom the
+#  Software is furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included
+#  in all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+#  OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+#  THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#  DEALINGS IN THE SOFTWARE.
+###############################################################################
+
+from __future__ import print_function
+import os
+import os.path
+import shutil
+import hashlib
+import StringIO
+import struct
+import zlib
+import weakref
+
+from tiler_functions import *
+
+store_map = []
+
+#############################
+
+class TileStore(object):
+    '''Destination of the pyramid tiles: a directory tree by default'''
+#############################
+    store = 'dir'
+    files = True # tiles and metadata are written as files into a destination directory
+
+    def __init__(self, pyramid):
+        self.pyramid = weakref.proxy(pyramid) # the pyramid removes its temporary files when it is deleted
+
+    @staticmethod
+    def get_class(store_name):
+        for cls in store_map:
+            if cls.store == store_name:
+                return cls
+        else:
+            raise Exception("Invalid tile store: %s" % store_name)
+
+    @staticmethod
+    def store_lst():
+        return [c.store for c in store_map]
+
+    @staticmethod
+    def dest_ext(profile_ext):
+        'destination suffix for a pyramid profile'
+        return profile_ext
+
+    def work_dir(self):
+        'directory for auxiliary files'
+        return self.pyramid.dest
+
+    def remove(self):
+        'remove an existing destination'
+        shutil.rmtree(self.pyramid.dest, ignore_errors=True)
+
+    def tms_tile(self, tile):
+        'pyramid tile to TMS tile numbering (y goes upwards)'
+        z, x, y = tile
+        if self.pyramid.tile_dim[1] > 0:
+            return (z, x, y)
+        return (z, x, self.pyramid.tiles_xy(z)[1]-1-y)
+
+    def write_tile(self, tile, tile_img, tile_format, save_opt):
+        full_path = os.path.join(self.pyramid.dest, self.pyramid.tile_path(tile))
+        make_dirs(full_path)
+        tile_img.save(full_path, **save_opt)
+        nbytes = os.path.getsize(full_path)
+
+        for layout in self.pyramid.layouts: # encoded once, linked into the other layouts
+            layout_path = os.path.join(layout.dest, layout.tile_path(tile))
+            make_dirs(layout_path)
+            link_or_copy(full_path, layout_path)
+        return nbytes
+
+    def write_tilemap(self, tilemap):
+        write_tilemap(self.pyramid.dest, tilemap)
+        for layout in self.pyramid.layouts:
+            write_tilemap(layout.dest, layout.tilemap(tilemap))
+            if layout.name == 'zyx':
+                copy_viewer(layout.dest)
+
+    def write_transparency(self, transparency):
+        write_transparency(self.pyramid.dest, transparency)
+        for layout in self.pyramid.layouts:
+            write_transparency(layout.dest, [(layout.tile(tile), opc) for tile, opc in transparency])
+
+    def write_metrics(self, metrics):
+        write_metrics(self.pyramid.dest, metrics)
+
+    def close(self):
+        pass
+
+store_map.append(TileStore)
+# TileStore
+
+def make_dirs(file_path):
+    'create parent directories of a file'
+    try:
+        os.makedirs(os.path.dirname(file_path))
+    except os.error: pass
+
+#############################
+
+class MBTilesStore(TileStore):
+    '''Single MBTiles file, identical tiles are stored once'''
+#############################
+    store = 'mbtiles'
+    files = False
+    db = None
+
+    @staticmethod
+    def dest_ext(profile_ext):
+        return '.mbtiles'
+
+    def work_dir(self):
+        return self.pyramid.dest + '.tmp'
+
+    def remove(self):
+        if os.path.exists(self.pyramid.dest):
+            os.remove(self.pyramid.dest)
+        shutil.rmtree(self.work_dir(), ignore_errors=True)
+
+    def open_db(self):
+        if self.db is None:
+            options = self.pyramid.options
+            self.db = MBTiles(self.pyramid.dest, write=True,
+                journal_mode=options.sqlite_journal or 'WAL',
+                synchronous=options.sqlite_sync or 'NORMAL')
+        return self.db
+
+    def write_tile(self, tile, tile_img, tile_format, save_opt):
+        buf = StringIO.StringIO()
+        tile_img.save(buf, tile_format, **save_opt)
+        data = buf.getvalue()
+        buf.close()
+        self.open_db().put_tile(self.db_tile(tile), data)
+        return len(data)
+
+    def db_tile(self, tile):
+        return self.tms_tile(tile)
+
+    def write_tilemap(self, tilemap):
+        'fill MBTiles metadata from the tilemap'
+        prm = self.pyramid
+        (west, north), (east, south) = prm.bounds_lst2longlat([prm.bounds])[0]
+        zooms = sorted(tilemap['tilesets'])
+        ext = tilemap['tiles']['ext']
+        self.open_db().set_metadata({
+            'name':         tilemap['properties']['title'],
+            'description':  tilemap['properties']['description'] or '',
+            'type':         'overlay',
+            'version':      '1.1',
+            'format':       'jpg' if ext == 'jpeg' else ext,
+            'bounds':       '%.9f,%.9f,%.9f,%.9f' % (west, south, east, north),
+            'center':       '%.9f,%.9f,%d' % ((west+east)/2, (north+south)/2, zooms[0]),
+            'minzoom':      zooms[0],
+            'maxzoom':      zooms[-1],
+            'tilemap':      json.dumps(tilemap),
+            })
+
+    def write_transparency(self, transparency):
+        pass
+
+    def write_metrics(self, metrics):
+        self.open_db().set_metadata({'metrics': json.dumps(metrics)})
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+store_map.append(MBTilesStore)
+# MBTilesStore
+
+#############################
+
+class PMTilesStore(MBTilesStore):
+    '''Single PMTiles archive for static hosting, tiles are clustered and deduplicated'''
+#############################
+    store = 'pmtiles'
+
+    @staticmethod
+    def dest_ext(profile_ext):
+        return '.pmtiles'
+
+    def open_db(self):
+        if self.db is None:
+            self.db = PMTiles(self.pyramid.dest)
+        return self.db
+
+    def db_tile(self, tile):
+        'XYZ numbering (y goes downwards)'
+        z, x, y = self.tms_tile(tile)
+        return (z, x, self.pyramid.tiles_xy(z)[1]-1-y)
+
+store_map.append(PMTilesStore)
+# PMTilesStore
+
+#############################
+
+class MBTiles(object):
+    '''MBTiles SQLite database with a map/images split (see https://github.com/mapbox/mbtiles-spec)'''
+#############################
+    batch_size = 1000
+    prune = False # drop unreferenced images on close
+
+    def __init__(self, path, write=False, journal_mode='WAL', synchronous='NORMAL', batch_size=None):
+        import sqlite3
+
+        self.path = path
+        self.write = write
+        if batch_size:
+            self.batch_size = batch_size
+        self.db = sqlite3.connect(path)
+        self.db.text_factory = str
+        self.pending = []
+
+        if write:
+            self.db.execute('PRAGMA journal_mode=%s' % journal_mode)
+            self.db.execute('PRAGMA synchronous=%s' % synchronous)
+            self.db.executescript(mbtiles_schema)
+
+    def put_tile(self, tms_tile, data):
+        'queue a tile, written in a batched transaction'
+        tile_id = hashlib.md5(data).hexdigest() # identical tiles share an image
+        self.pending.append((tms_tile, tile_id, bytes(data))) # data may be a buffer over a reused slot
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        with self.db: # a transaction per batch
+            self.db.executemany('INSERT OR IGNORE INTO images (tile_id, tile_data) VALUES (?, ?);',
+                [(tile_id, buffer(data)) for tile, tile_id, data in self.pending])
+            self.db.executemany('INSERT OR REPLACE INTO map (zoom_level, tile_column, tile_row, tile_id) VALUES (?, ?, ?, ?);',
+                [(z, x, y, tile_id) for (z, x, y), tile_id, data in self.pending])
+        self.pending = []
+
+    def delete_tile(self, tms_tile):
+        self.flush()
+        with self.db:
+            self.db.execute('DELETE FROM map WHERE zoom_level=? AND tile_column=? AND tile_row=?', tms_tile)
+        self.prune = True
+
+    def zoom_levels(self):
+        return [z for (z,) in self.db.execute('SELECT DISTINCT zoom_level FROM tiles ORDER BY zoom_level')]
+
+    def get_tiles(self, zoom, columns=None, rows=None):
+        'tiles of a zoom as (column, row, data), optionally in (min, max) column and row ranges, in key order'
+        where = ['zoom_level = ?']
+        params = [zoom]
+        for name, bounds in (('tile_column', columns), ('tile_row', rows)):
+            if bounds is not None:
+                where.append('%s BETWEEN ? AND ?' % name)
+                params.extend(bounds)
+        return self.db.execute(
+            'SELECT tile_column, tile_row, tile_data FROM tiles WHERE %s '
+            'ORDER BY zoom_level, tile_column, tile_row' % ' AND '.join(where), params)
+
+    def set_metadata(self, metadata):
+        with self.db:
+            self.db.executemany('INSERT OR REPLACE INTO metadata (name, value) VALUES (?, ?);',
+                [(key, str(value)) for key, value in metadata.items()])
+
+    def get_metadata(self):
+        return dict(self.db.execute('SELECT name, value FROM metadata'))
+
+    def close(self):
+        if self.write:
+            self.flush()
+            if self.prune:
+                with self.db:
+                    self.db.execute('DELETE FROM images WHERE tile_id NOT IN (SELECT tile_id FROM map)')
+            self.db.execute('PRAGMA journal_mode=DELETE') # leave a single self-contained file
+        self.db.close()
+# MBTiles
+
+mbtiles_schema = '''
+CREATE TABLE IF NOT EXISTS metadata (name TEXT, value TEXT, PRIMARY KEY (name));
+CREATE TABLE IF NOT EXISTS images (tile_id TEXT, tile_data BLOB, PRIMARY KEY (tile_id));
+CREATE TABLE IF NOT EXISTS map (
+    zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_id TEXT,
+    PRIMARY KEY (zoom_level, tile_column, tile_row));
+CREATE VIEW IF NOT EXISTS tiles AS
+    SELECT map.zoom_level AS zoom_level, map.tile_column AS tile_column, map.tile_row AS tile_row,
+        images.tile_data AS tile_data
+    FROM map JOIN images ON images.tile_id = map.tile_id;
+'''
+
+#############################
+
+class PMTiles(object):
+    '''PMTiles v3 archive writer (see https://github.com/protomaps/PMTiles/blob/main/spec/v3/spec.md)
+
+    Tiles may come in any order: payloads are appended to a temporary file as they come,
+    only their offsets are kept, the archive is written clustered in tile id order on close.'''
+#############################
+    header = struct.Struct('<7sBQQQQQQQQQQQBBBBBBiiiiBii')
+    max_root = 16384 # header and the root directory are fetched at once
+    leaf_size = 4096 # initial entries per leaf directory
+    tile_types = {'png': 2, 'jpg': 3, 'jpeg': 3, 'webp': 4, 'avif': 5}
+
+    def __init__(self, path, write=True):
+        assert write, 'Reading PMTiles is not supported'
+        self.path = path
+        self.temp_path = path + '.data.tmp'
+        self.data = open(self.temp_path, 'w+b')
+        self.data_size = 0
+        self.contents = {} # payload digest: (offset, length) in the temporary file
+        self.tiles = {} # tile id: (offset, length)
+        self.zooms = set()
+        self.metadata = {}
+
+    def put_tile(self, xyz_tile, data):
+        'XYZ numbering (y goes downwards), identical payloads are stored once'
+        digest = hashlib.md5(data).digest()
+        content = self.contents.get(digest)
+        if content is None:
+            content = self.contents[digest] = (self.data_size, len(data))
+            self.data.write(data)
+            self.data_size += len(data)
+        self.tiles[zxy_to_tileid(*xyz_tile)] = content
+        self.zooms.add(xyz_tile[0])
+
+    def set_metadata(self, metadata):
+        self.metadata.update(metadata)
+
+    def close(self):
+        # clustered: contents in the order of the first tile they are addressed by
+        entries = [] # [tile id, offset, length, run length]
+        layout = {} # temporary offset: archive offset
+        order = []
+        tile_data_size = 0
+        for tile_id, (tmp_offset, length) in sorted(self.tiles.items()):
+            offset = layout.get(tmp_offset)
+            if offset is None:
+                offset = layout[tmp_offset] = tile_data_size
+                order.append((tmp_offset, length))
+                tile_data_size += length
+            last = entries[-1] if entries else None
+            if last and last[1] == offset and last[0]+last[3] == tile_id: # a run of the same tile
+                last[3] += 1
+            else:
+                entries.append([tile_id, offset, length, 1])
+
+        root, leaves = self.directories(entries)
+        metadata = gzip_compress(json.dumps(self.metadata))
+
+        # header, root directory, metadata, leaf directories, tile data
+        meta_offset = self.header.size + len(root)
+        leaf_offset = meta_offset + len(metadata)
+        data_offset = leaf_offset + len(leaves)
+        west, south, east, north = [float(c) for c in self.metadata.get('bounds', '-180,-85,180,85').split(',')]
+        zooms = sorted(self.zooms) or [0]
+        center = self.metadata.get('center')
+        if center:
+            c_lon, c_lat, c_zoom = [float(c) for c in center.split(',')]
+        else:
+            c_lon, c_lat, c_zoom = (west+east)/2, (south+north)/2, zooms[0]
+        fmt = str(self.metadata.get('format', '')).lower()
+
+        with open(self.path, 'wb') as f:
+            f.write(self.header.pack(
+                b'PMTiles', 3,
+                self.header.size, len(root),
+                meta_offset, len(metadata),
+                leaf_offset, len(leaves),
+                data_offset, tile_data_size,
+                len(self.tiles), len(entries), len(order),
+                1,                          # clustered
+                2, 1,                       # gzip-ed directories and metadata, tiles as they are
+                self.tile_types.get(fmt, 0),
+                zooms[0], zooms[-1],
+                e7(west), e7(south), e7(east), e7(north),
+                int(c_zoom), e7(c_lon), e7(c_lat),
+                ))
+            f.write(root)
+            f.write(metadata)
+            f.write(leaves)
+            for tmp_offset, length in order:
+                self.data.seek(tmp_offset)
+                f.write(self.data.read(length))
+
+        self.data.close()
+        os.remove(self.temp_path)
+
+    def directories(self, entries):
+        'root directory and leaf directories, the latter are used if the root does not fit max_root'
+        root = serialize_directory(entries)
+        leaf_size = self.leaf_size
+        while self.header.size + len(root) > self.max_root:
+            root_entries = []
+            leaves = []
+            leaves_size = 0
+            for i in range(0, len(entries), leaf_size):
+                leaf = serialize_directory(entries[i:i+leaf_size])
+                root_entries.append([entries[i][0], leaves_size, len(leaf), 0]) # run length 0: a leaf
+                leaves.append(leaf)
+                leaves_size += len(leaf)
+            root = serialize_directory(root_entries)
+            leaf_size *= 2
+            if self.header.size + len(root) <= self.max_root:
+                return root, b''.join(leaves)
+        return root, b''
+# PMTiles
+
+def e7(degrees):
+    return int(round(degrees * 10000000))
+
+def zxy_to_tileid(z, x, y):
+    'position along the Hilbert curves of zoom levels 0, 1, ... z'
+    tile_id = ((1 << (z*2)) - 1) // 3 # tiles at the lower zooms
+    n = 1 << z
+    s = n >> 1
+    while s > 0:
+        rx = 1 if x & s else 0
+        ry = 1 if y & s else 0
+        tile_id += s * s * ((3 * rx) ^ ry)
+        if ry == 0: # rotate
+            if rx == 1:
+                x = n-1 - x
+                y = n-1 - y
+            x, y = y, x
+        s >>= 1
+    return tile_id
+
+def write_varint(buf, value):
+    while value >= 0x80:
+        buf.append((value & 0x7F) | 0x80)
+        value >>= 7
+    buf.append(value)
+
+def serialize_directory(entries):
+    'gzip-ed directory of [tile id, offset, length, run length] entries sorted by tile id'
+    buf = bytearray()
+    write_varint(buf, len(entries))
+    last_id = 0
+    for tile_id, offset, length, run_length in entries:
+        write_varint(buf, tile_id - last_id)
+        last_id = tile_id
+    for tile_id, offset, length, run_length in entries:
+        write_varint(buf, run_length)
+    for tile_id, offset, length, run_length in entries:
+        write_varint(buf, length)
+    for i, (tile_id, offset, length, run_length) in enumerate(entries):
+        prev = entries[i-1] if i > 0 else None
+        if prev and offset == prev[1] + prev[2]: # contiguous
+            write_varint(buf, 0)
+        else:
+            write_varint(buf, offset + 1)
+    return gzip_compress(bytes(buf))
+
+def gzip_compress(data):
+    compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS) # gzip header
+    return compressor.compress(data) + compressor.flush()
@@ -33,10 +33,12 @@ from converter_backend import TileSet, TileConverter
 import converter_xyz
 import converter_maemomapper
 import converter_sasplanet
+import converter_mbtiles
+import converter_pmtiles
 try:
     import converter_mmaps
 except ImportError:
-    pass
+    converter_mmaps = None
 
 #~ import rpdb2; rpdb2.start_embedded_debugger('nRAmgJHm')
 
@@ -82,6 +84,9 @@ def main(argv):
         help='JPEG/WEBP quality (default: 75)')
     parser.add_option('-a', '--append', action='store_true', dest='append',
         help='append tiles to an existing destination')
+    parser.add_option('--sync', action='store_true',
+        help='incremental update: transfer only new and changed tiles, remove the ones gone from the source; '
+            'size, mtime and hash of the tiles are kept in <destination>.manifest.db')
     parser.add_option('-r', '--remove-dest', action='store_true',dest='remove_dest',
         help='delete destination directory before merging')
     parser.add_option('-t', '--dest-dir', default='.', dest='dst_dir',
@@ -106,6 +111,10 @@ def main(argv):
         help='region to process (OGR shape or Sasplanet .hlg)')
     parser.add_option('--region-zoom', metavar='N', type="int", default=None,
         help='apply region for zooms only higher than this one (default: None)')
+    parser.add_option("--sqlite-journal", default='WAL', metavar="MODE",
+        help='SQLite journal mode while writing a database (default: WAL)')
+    parser.add_option("--sqlite-sync", default='NORMAL', metavar="MODE",
+        help='SQLite synchronous mode while writing a database (default: NORMAL)')
     parser.add_option("--nothreads", action="store_true",
         help="do not use multiprocessing")
 
@@ -48,6 +48,13 @@ def transparency(img):
     return 1 if a_min == 255 else 0 if a_max == 0 else -1
 
 
+def path2tile(tile_path):
+    'zyx tile path to tile numbers'
+    (s, ext) = os.path.splitext(tile_path)
+    (s, x) = os.path.split(s)
+    (z, y) = os.path.split(s)
+    return tuple(map(int, (z[1:], x, y)))
+
 class MergeSet:
     def __init__(self, src_dir, dst_dir):
 
@@ -72,12 +79,13 @@ class MergeSet:
         self.dst = read_tilemap(dst_dir)
         self.tile_size = self.src['tiles']['size']
 
-        # get a list of source tiles
+        # get a list of source tiles, mixed-format tilesets have more than one extension
+        tile_exts = set([self.src['tiles']['ext']] + self.src['tiles'].get('formats', {}).values())
         try:
             cwd = os.getcwd()
             os.chdir(src_dir)
             self.sources = dict.fromkeys(
-                glob.iglob('z[0-9]*/*/*.%s' % self.src['tiles']['ext']),
+                flatten([glob.iglob('z[0-9]*/*/*.%s' % ext) for ext in tile_exts]),
                 None
                 )
         finally:
@@ -85,7 +93,9 @@ class MergeSet:
         #ld(self.sources)
 
         # load cached tile transparency data if any
-        self.sources.update(read_transparency(src_dir))
+        self.transparency = read_transparency(src_dir)
+        if self.transparency is None:
+            self.sources.update(read_transparency_json(src_dir))
         #ld(repr(self.src_transp))
 
         # define crop map for underlay function
@@ -117,6 +127,8 @@ class MergeSet:
             dst["bbox"][i] = min_max(src["bbox"][i], dst["bbox"][i])
 
         dst["tilesets"].update(src["tilesets"])
+        if 'formats' in src['tiles']:
+            dst['tiles'].setdefault('formats', {}).update(src['tiles']['formats'])
 
         write_tilemap(self.dst_dir, dst)
 
@@ -179,6 +191,8 @@ class MergeSet:
 
             src_raster = None
             transp = self.sources[tile]
+            if transp is None and self.transparency is not None:
+                transp = self.transparency.get(path2tile(tile))
             if transp is None: # transparency value not cached yet
                 #~ pf('!', end='')
                 src_raster = Image.open(src_file).convert("RGBA")
@@ -229,7 +243,9 @@ class MergeSet:
         self.merge_metadata()
 
         # save transparency data
-        write_transparency(self.src_dir, self.sources)
+        if self.transparency is not None:
+            self.transparency.close()
+        write_transparency(self.src_dir, [(path2tile(tile), transp) for tile, transp in self.sources.items()])
         pf('')
 
 # MergeSet end
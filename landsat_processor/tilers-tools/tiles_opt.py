@@ -34,6 +34,7 @@ from PIL import Image
 #~ from PIL import WebPImagePlugin
 
 from tiler_functions import *
+from tiler_encode import quantize_png, encode_webp
 
 class KeyboardInterruptError(Exception): pass
 
@@ -44,17 +45,10 @@ converters = []
 class Converter (object):
 
 #############################
-    prog_name = None
     dst_ext = None
     src_formats = ('.png',)
 
     def __init__(self, src_dir, options):
-        if self.prog_name:
-            try: # check if converter programme is available
-                prog_path = command(['which', self.prog_name]).strip()
-            except:
-                raise Exception('Can not find %s executable' % self.prog_name)
-
         self.options = options
         self.src_dir = src_dir
         self.dst_dir = src_dir + self.dst_ext
@@ -140,12 +134,13 @@ class PngConverter (Converter):
 
 #############################
     profile_name = 'pngnq'
-    prog_name = 'pngnq'
     dst_ext = '.png'
 
     def convert_tile(self, src, dst, dpath):
-        'optimize png using pngnq utility'
-        command(['pngnq', '-n', self.options.colors, '-e', self.dst_ext, '-d', dpath, src])
+        'optimize png: quantize to a palette (as pngnq)'
+        data = quantize_png(Image.open(src), self.options.colors)
+        with open(dst, 'wb') as f:
+            f.write(data)
 
 converters.append(PngConverter)
 
@@ -159,7 +154,9 @@ class WebpConverter (Converter):
     src_formats = ('.png','.jpg','.jpeg','.gif')
 
     def convert_tile(self, src, dst, dpath):
-        command(['cwebp', src, '-o', dst, '-q', str(self.options.quality)])
+        data = encode_webp(Image.open(src), self.options.quality)
+        with open(dst, 'wb') as f:
+            f.write(data)
 
 converters.append(WebpConverter)
 
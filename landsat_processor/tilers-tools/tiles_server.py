@@ -0,0 +1,296 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+###############################################################################
+# Copyright (c) 2011-2013 Vadim Shlyakhov
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a
+#  copy of this software and associated documentation files (the "Software"),
+#  to deal in the Software without restriction, including without limitation
+#  the rights to use, copy, modify, merge, publish, distribute, sublicense,
+#  and/or sell copies of the Software, and to permit persons to whom the
+#  Software is furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included
+#  in all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+#  OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+#  THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#  DEALINGS IN THE SOFTWARE.
+###############################################################################
+
+from __future__ import print_function
+import os
+import os.path
+import re
+import tempfile
+import threading
+import collections
+import StringIO
+import urlparse
+import BaseHTTPServer
+import SocketServer
+
+from tiler_functions import *
+from tiler_backend import Pyramid, BaseImg
+from tiler_store import make_dirs
+import gdal_tiler
+
+#############################
+
+class TileCache(object):
+    '''Size-bounded LRU disk cache of encoded tiles, file modification times keep the order over restarts'''
+#############################
+
+    def __init__(self, root, max_bytes):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict() # path: size, least recently used first
+        self.size = 0
+        self.scan()
+
+    def scan(self):
+        files = []
+        for dir_path, dir_names, file_names in os.walk(self.root):
+            for f in file_names:
+                path = os.path.join(dir_path, f)
+                st = os.stat(path)
+                files.append((st.st_mtime, path, st.st_size))
+        for mtime, path, size in sorted(files):
+            self.entries[path] = size
+            self.size += size
+        self.evict()
+        ld('cache', self.root, len(self.entries), self.size)
+
+    def get(self, rel_path):
+        path = os.path.join(self.root, rel_path)
+        with self.lock:
+            if path not in self.entries:
+                return None
+            self.entries[path] = self.entries.pop(path) # most recently used
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.utime(path, None)
+        except (IOError, OSError): # evicted meanwhile
+            return None
+        return data
+
+    def put(self, rel_path, data):
+        path = os.path.join(self.root, rel_path)
+        make_dirs(path)
+        temp_path = '%s.%d.tmp' % (path, threading.current_thread().ident)
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+        os.rename(temp_path, path)
+        with self.lock:
+            self.size -= self.entries.pop(path, 0)
+            self.entries[path] = len(data)
+            self.size += len(data)
+            self.evict()
+
+    def evict(self):
+        while self.size > self.max_bytes and self.entries:
+            path, size = self.entries.popitem(last=False)
+            self.size -= size
+            try:
+                os.remove(path)
+            except os.error: pass
+# TileCache
+
+#############################
+
+class TileRenderer(object):
+    '''Renders tiles of a source on demand from a warped raster per zoom level'''
+#############################
+    max_rasters = 4 # zoom level rasters kept open
+
+    def __init__(self, src, dest, options):
+        options.metatile = 1 # a request warps its own tile only, metatiles would be re-warped for each one
+        self.pyramid = prm = Pyramid.profile_class(options.profile)(src, dest, options)
+        prm.dry_run = True # tiles go to the cache, not to a pyramid
+        prm.work_dir = tempfile.mkdtemp(prefix='tiles_server.')
+        if not prm.init_map(options.zoom):
+            raise Exception('Invalid source: %s' % src)
+        prm.index_tiles()
+        if options.overviews:
+            build_overviews(prm.src_path, prm.base_resampling, abs(prm.tile_dim[0]))
+        self.rasters = collections.OrderedDict() # zoom: BaseImg, least recently used first
+        self.lock = threading.Lock() # GDAL datasets are not thread safe
+        prm.make_global_palette(self.base_img(prm.max_zoom))
+
+    def base_img(self, zoom):
+        img = self.rasters.pop(zoom, None)
+        if img is None:
+            base_ds, ul_pix = self.pyramid.warp_raster(zoom)
+            img = BaseImg(base_ds, ul_pix, self.pyramid.transparency)
+            while len(self.rasters) >= self.max_rasters:
+                self.rasters.popitem(last=False)
+        self.rasters[zoom] = img
+        return img
+
+    def render(self, tile):
+        'encoded tile, None if it is out of the source or transparent'
+        prm = self.pyramid
+        src_tile = prm.tile_index.physical(tile)
+        if src_tile is None:
+            return None
+        with self.lock:
+            tile_img, opacity = self.base_img(tile[0]).get_tile(prm.tile_pixbounds(src_tile))
+        if tile_img is None or opacity == 0:
+            return None
+        if prm.palette:
+            tile_img.putpalette(prm.palette)
+        tile_format, tile_img, save_opt = prm.tile_encoding(tile_img, opacity)
+        buf = StringIO.StringIO()
+        tile_img.save(buf, tile_format, **save_opt)
+        return buf.getvalue()
+# TileRenderer
+
+def build_overviews(src_path, resampling, tile_size):
+    'external overviews for a source without them, the warper reads lower zooms from them'
+    ds = gdal.Open(src_path, GA_ReadOnly)
+    if ds.GetRasterBand(1).GetOverviewCount() > 0:
+        return
+    levels = []
+    factor = 2
+    while min(ds.RasterXSize, ds.RasterYSize) // factor >= tile_size:
+        levels.append(factor)
+        factor *= 2
+    if levels:
+        pf('building overviews', levels)
+        ds.BuildOverviews('NEAREST' if resampling == 'NearestNeighbour' else 'AVERAGE', levels)
+
+#############################
+
+class TileService(object):
+    '''Pre-rendered tiles first, then the cache, then rendering'''
+#############################
+    tile_exts = ('.png', '.jpg', '.jpeg', '.webp', '.gif')
+
+    def __init__(self, renderer, cache, tiles_dir=None):
+        self.renderer = renderer
+        self.cache = cache
+        self.tiles_dir = tiles_dir
+
+    def get(self, tile):
+        prm = self.renderer.pyramid
+        if tile[0] not in prm.zoom_range:
+            return None
+        rel_path = prm.tile_path(tile)
+
+        if self.tiles_dir:
+            base = os.path.splitext(os.path.join(self.tiles_dir, rel_path))[0]
+            for ext in self.tile_exts: # mixed-format pyramids
+                if os.path.exists(base + ext):
+                    with open(base + ext, 'rb') as f:
+                        return f.read()
+
+        data = self.cache.get(rel_path)
+        if data is None:
+            data = self.renderer.render(tile)
+            if data is not None:
+                self.cache.put(rel_path, data)
+        return data
+# TileService
+
+#############################
+
+class TileRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    '''GET /z/x/y[.ext], tile numbers as per the tiling profile'''
+#############################
+    tile_re = re.compile(r'^/(\d+)/(\d+)/(\d+)(\.\w+)?$')
+
+    def do_GET(self):
+        match = self.tile_re.match(urlparse.urlparse(self.path).path)
+        if not match:
+            self.send_error(404, 'Not a tile')
+            return
+        tile = tuple(map(int, match.groups()[:3]))
+        try:
+            data = self.server.tiles.get(tile)
+        except Exception as exc:
+            logging.error('%s: %s' % (tile, exc))
+            self.send_error(500, str(exc))
+            return
+        if data is None:
+            self.send_error(404, 'No tile')
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', type_ext_from_buffer(data)[0])
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        ld(format % args)
+
+class TileServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+#----------------------------
+
+def parse_args(arg_lst):
+
+#----------------------------
+    parser = gdal_tiler.option_parser()
+    parser.set_usage('usage: %prog <options>... source')
+    parser.description = 'Serve tiles of a GDAL-compatible raster, rendered on demand'
+    parser.set_defaults(profile='tms') # as the TMS service of the Tiler XML
+    parser.get_option('--profile').help = 'tiles profile, /z/x/y are its tile numbers (default: tms)'
+    parser.add_option("--host", default='localhost',
+        help='address to listen at (default: localhost)')
+    parser.add_option("--port", type="int", default=8080,
+        help='port to listen at (default: 8080)')
+    parser.add_option("--cache-dir", default=None, metavar="DIR",
+        help='rendered tiles cache (default: <source>.cache in a destination directory)')
+    parser.add_option("--cache-size", type="float", default=1024, metavar="MB",
+        help='cache size limit, least recently used tiles are evicted (default: 1024)')
+    parser.add_option("--tiles", default=None, metavar="DIR",
+        help='pre-rendered pyramid of the same profile to serve tiles from first')
+    parser.add_option("--overviews", action="store_true",
+        help='build external overviews for a source without them')
+    return parser.parse_args(arg_lst)
+
+#----------------------------
+
+def main(argv):
+
+#----------------------------
+    (options, args) = parse_args(argv[1:])
+
+    logging.basicConfig(level=logging.DEBUG if options.verbose == 2 else
+        (logging.ERROR if options.verbose == 0 else logging.INFO))
+    ld(options)
+
+    if len(args) != 1:
+        logging.error('A single source is expected')
+        sys.exit(1)
+    src = args[0]
+
+    opt = gdal_tiler.tiling_options(options)
+    cache_dir = opt.cache_dir or dest_path(src, opt.dest_dir, '.cache')
+
+    renderer = TileRenderer(src, cache_dir, opt)
+    cache = TileCache(cache_dir, int(opt.cache_size * 1024 * 1024))
+    server = TileServer((opt.host, opt.port), TileRequestHandler)
+    server.tiles = TileService(renderer, cache, opt.tiles)
+
+    prm = renderer.pyramid
+    pf('serving %s zooms %s at http://%s:%d/{z}/{x}/{y}%s' % (
+        src, sorted(prm.zoom_range), opt.host, opt.port, prm.tile_ext))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+# main()
+
+if __name__ == '__main__':
+
+    main(sys.argv)
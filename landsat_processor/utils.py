@@ -69,3 +69,28 @@ class Util:
             ok = False
 
         return ok
+
+    @staticmethod
+    def _subprocess_lines(command, callback):
+        """
+        Function to run subprocess passing each output line to callback
+        """
+        ok = True
+
+        try:
+            proc = subprocess.Popen(
+                command, shell=True, stdout=subprocess.PIPE,
+                universal_newlines=True)
+            for line in iter(proc.stdout.readline, ''):
+                callback(line.rstrip('\n'))
+            proc.stdout.close()
+            if proc.wait() != 0:
+                raise subprocess.CalledProcessError(proc.returncode, command)
+        except subprocess.CalledProcessError as exc:
+            print(exc)
+            ok = False
+        except OSError as exc:
+            print(exc)
+            ok = False
+
+        return ok
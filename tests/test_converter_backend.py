@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for tilers-tools `converter_backend.py` shared memory tiles."""
+import io
+import os
+import pickle
+import sqlite3
+import sys
+
+import pytest
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, 'landsat_processor', 'tilers-tools'))
+tiles_convert = pytest.importorskip('tiles_convert')  # Python 2 and GDAL
+import converter_backend  # noqa: E402
+import converter_mbtiles  # noqa: E402
+
+TILES = [(1, x, y) for x in (0, 1) for y in (0, 1)]
+
+
+def tile_data(color):
+    """ PNG tile of a single color """
+    buf = io.BytesIO()
+    Image.new('RGB', (256, 256), (color * 40, 0, 0)).save(buf, 'PNG')
+    return buf.getvalue()
+
+
+@pytest.fixture
+def arena_globals(monkeypatch):
+    """ Module globals set by a conversion, restored afterwards """
+    monkeypatch.setattr(converter_backend, 'tile_arena', None)
+    monkeypatch.setattr(converter_backend, 'tile_converter', None)
+    return monkeypatch
+
+
+def test_arena_share(arena_globals):
+    """ Tests if a tile is passed by its slot and read back in place until released """
+
+    arena = converter_backend.TileArena(1)
+    arena_globals.setattr(converter_backend, 'tile_arena', arena)
+    data = tile_data(1)
+    tile = converter_backend.PixBufTile((1, 0, 1), data, dataType='image/png')
+
+    shared = arena.share(tile)
+    assert(isinstance(shared, converter_backend.ArenaTile))
+    assert(len(pickle.dumps(shared, 2)) < 300)  # no tile data
+    assert(arena.share(tile) is tile)  # no free slot
+
+    assert(not isinstance(shared.data(), bytes))  # not a copy
+    assert(bytes(shared.data()) == data)
+    assert(shared.get_ext() == '.png')
+
+    shared.close_file()
+    assert(shared.slot is None and shared.pixbuf is None)
+    assert(arena.free.get(timeout=5) == 0)
+
+
+def test_arena_share_too_big(arena_globals):
+    """ Tests if tiles larger than a slot are pickled as they are """
+
+    arena = converter_backend.TileArena(1)
+    tile = converter_backend.PixBufTile((1, 0, 1), b'\x00' * (arena.slot_size + 1))
+
+    assert(arena.share(tile) is tile)
+    assert(arena.free.get(timeout=5) == 0)  # the slot is still free
+
+
+def test_convert_through_arena(tmpdir, arena_globals):
+    """ Tests if converted tiles come back through the arena and their slots are released """
+
+    src = tmpdir.join('pyramid.xyz')
+    for i, (z, x, y) in enumerate(TILES):
+        src.join(str(z), str(x), '%d.png' % y).write_binary(tile_data(i), ensure=True)
+
+    stored = []
+    store_tile = converter_mbtiles.MBTilesSet.store_tile
+
+    def recording_store_tile(self, tile):
+        stored.append((tile.coord(), type(tile)))
+        return store_tile(self, tile)
+
+    arena_globals.setattr(converter_mbtiles.MBTilesSet, 'store_tile', recording_store_tile)
+    tiles_convert.main(['tiles_convert.py', '--quiet', '--from', 'xyz', '--to', 'mbtiles',
+                        '-f', 'pngnq', '-t', str(tmpdir), str(src)])
+
+    assert(sorted(stored) == [(tile, converter_backend.ArenaTile) for tile in TILES])
+    arena = converter_backend.tile_arena
+    assert(arena.free.qsize() == len(arena.mem) // arena.slot_size)
+
+    db = sqlite3.connect(str(tmpdir.join('pyramid.mbtiles')))
+    rows = db.execute('SELECT tile_data FROM tiles').fetchall()
+    db.close()
+    assert(len(rows) == len(TILES))
+    for (data,) in rows:
+        assert(Image.open(io.BytesIO(bytes(data))).format == 'PNG')
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for tilers-tools `converter_sasplanet.py` SASBerkeley keys."""
+import os
+import random
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, 'landsat_processor', 'tilers-tools'))
+converter_sasplanet = pytest.importorskip('converter_sasplanet')  # Python 2 and GDAL
+
+
+def decode_bits(kxy):
+    """ Key to [x, y] bit by bit, as keys were decoded before the tables """
+    xy = [0, 0]
+    for bit_n in range(64):  # bits for x and y are interleaved in the key
+        x0y1 = bit_n % 2  # x, y
+        xy[x0y1] += (kxy >> bit_n & 1) << (bit_n - x0y1) // 2
+    return xy
+
+
+def test_morton_decode():
+    """ Tests if keys are decoded by table as by the 64 bit loop """
+
+    rnd = random.Random(47)
+    keys = [0, 1, 2, 3, 0x5555555555555555, 0xAAAAAAAAAAAAAAAA, 0xFFFFFFFFFFFFFFFF]
+    keys += [rnd.getrandbits(64) for i in range(1000)]
+
+    for key in keys:
+        assert(converter_sasplanet.morton_decode(key) == decode_bits(key))
+
+
+def test_morton_encode():
+    """ Tests if tile coordinates are encoded back to their keys """
+
+    rnd = random.Random(47)
+    for i in range(1000):
+        x, y = rnd.getrandbits(32), rnd.getrandbits(32)
+        key = converter_sasplanet.morton_encode(x, y)
+        assert(decode_bits(key) == [x, y])
+
+
+def range_keys(ranges):
+    return set(k for k_min, k_max in ranges for k in range(k_min, k_max + 1))
+
+
+@pytest.mark.parametrize('rect', [
+    (0, 255, 0, 255),  # the whole block
+    (3, 200, 17, 90),
+    (128, 128, 5, 5),  # a single tile
+    (0, 127, 128, 255),  # a quadrant
+    (250, 255, 0, 3),
+])
+def test_morton_ranges(rect):
+    """ Tests if key ranges cover the tiles of a rectangle in a block, and these only """
+
+    xmin, xmax, ymin, ymax = rect
+    x0, y0 = 0x3400, 0x1200  # upper left tile of a block
+    ranges = converter_sasplanet.morton_ranges(x0 + xmin, x0 + xmax, y0 + ymin, y0 + ymax, x0, y0, 0x100)
+
+    expected = set(converter_sasplanet.morton_encode(x0 + x, y0 + y)
+                   for x in range(xmin, xmax + 1) for y in range(ymin, ymax + 1))
+    assert(range_keys(ranges) == expected)
+    assert(ranges == sorted(ranges))
+    for (lo, hi), (next_lo, next_hi) in zip(ranges, ranges[1:]):
+        assert(hi + 1 < next_lo)  # adjacent ranges are merged
+
+
+def test_morton_ranges_aligned():
+    """ Tests if a whole aligned square is a single key range """
+
+    x0, y0 = 0x3400, 0x1200
+
+    assert(converter_sasplanet.morton_ranges(x0, x0 + 255, y0, y0 + 255, x0, y0, 0x100) ==
+           [[converter_sasplanet.morton_encode(x0, y0), converter_sasplanet.morton_encode(x0, y0) + 0xFFFF]])
+    assert(converter_sasplanet.morton_ranges(x0 + 256, x0 + 300, y0, y0 + 10, x0, y0, 0x100) == [])
@@ -143,6 +143,111 @@ def test_tiler_make_tiles(create_data):
     assert(not os.path.exists(zoom_9))
 
 
+def test_tiler_make_tiles_tile_server(create_data):
+    """ Tests if the XML points at a tile server """
+
+    data = Tiler.make_tiles(
+        image_path=create_data['tiffile'],
+        link_base=create_data['out_path'],
+        output_folder=create_data['out_path'],
+        zoom=[7, 7],
+        nodata=[0],
+        tile_server='http://localhost:8080/',
+    )
+
+    with open(data[1]) as f:
+        xml = f.read()
+
+    assert('<ServerUrl>http://localhost:8080/${z}/${x}/${y}.png' in xml)
+
+    shutil.rmtree(data[0])
+
+
+def test_tiler_make_tiles_progress(create_data):
+    """ Tests if Tiler.make_tiles reports progress events """
+
+    events = []
+    data = Tiler.make_tiles(
+        image_path=create_data['tiffile'],
+        link_base=create_data['out_path'],
+        output_folder=create_data['out_path'],
+        zoom=[7, 8],
+        nodata=[0],
+        progress=events.append,
+    )
+
+    assert(os.path.exists(data[0]))
+
+    names = [e['event'] for e in events]
+    assert(names[0] == 'start')
+    assert(names[-1] == 'finish')
+    assert(names.count('zoom_start') == 2)
+    assert(names.count('zoom_end') == 2)
+
+    for event in events:
+        if event['event'] == 'zoom_end':
+            assert(event['done'] == event['expected'])
+            assert(event['rendered'] + event['skipped'] == event['done'])
+
+    finish = events[-1]
+    assert(finish['written'] > 0)
+    assert(finish['bytes'] > 0)
+
+    shutil.rmtree(data[0])
+
+
+def test_tiler_make_tiles_shards(create_data):
+    """ Tests if sharded Tiler.make_tiles runs build a whole pyramid """
+
+    remove_path(create_data['out_path_check'])
+
+    params = dict(
+        image_path=create_data['tiffile'],
+        link_base=create_data['out_path'],
+        output_folder=create_data['out_path'],
+        zoom=[7, 9],
+        nodata=[0],
+    )
+    for shard in ('1/2', '2/2'):
+        data = Tiler.make_tiles(shard=shard, **params)
+
+    tms = data[0]
+    assert(os.path.isfile(os.path.join(tms, 'shard.1-2.json')))
+    assert(os.path.isfile(os.path.join(tms, 'shard.2-2.json')))
+    assert(not os.path.isfile(os.path.join(tms, 'tilemap.json')))
+
+    data = Tiler.make_tiles(finalize=True, **params)
+
+    assert(data[0] == tms)
+    assert(os.path.isfile(os.path.join(tms, 'tilemap.json')))
+    assert(not os.path.isfile(os.path.join(tms, 'shard.1-2.json')))
+    for zoom in ('7', '8', '9'):
+        assert(os.path.exists(os.path.join(tms, zoom)))
+
+    shutil.rmtree(tms)
+
+
+def test_tiler_plan_tiles(create_data):
+    """ Tests if Tiler.plan_tiles estimates a pyramid without writing it """
+
+    remove_path(create_data['out_path_check'])
+
+    plan = Tiler.plan_tiles(
+        image_path=create_data['tiffile'],
+        output_folder=create_data['out_path'],
+        zoom=[7, 8],
+        nodata=[0],
+    )
+
+    assert(not os.path.exists(create_data['out_path_check']))
+    assert(sorted(plan['zooms']) == ['7', '8'])
+    assert(plan['zooms']['8']['indexed'] >= plan['zooms']['7']['indexed'])
+    assert(plan['tiles'] > 0)
+    assert(plan['bytes'] > 0)
+    assert(plan['disk'] >= plan['bytes'])
+    assert(plan['seconds'] > 0)
+
+
 def test_tiler_make_tiles_exception(create_data):
 
     """ When nodata is different of datasource bands count"""
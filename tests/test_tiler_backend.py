@@ -0,0 +1,291 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for tilers-tools `tiler_backend.py` tile grid math."""
+import os
+import random
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, 'landsat_processor', 'tilers-tools'))
+tiler_backend = pytest.importorskip('tiler_backend')  # Python 2 and GDAL
+from tiler_footprint import TileCoverage  # noqa: E402
+
+MAX_X = 20037508.342789244  # Equator's half length, web mercator
+REGION = ((-1234567.8, 4567890.1), (2345678.9, -987654.3))
+
+
+def profile(dest, name='xyz', **options):
+    """ Pyramid of a profile, not initialized by a source """
+    pytest.importorskip('gdal_tiler')  # registers the profiles
+    return tiler_backend.Pyramid.profile_class(name)('src.tif', dest, options)
+
+
+def grid(tile_dim, bounds=REGION):
+    """ Pyramid tile grid of a web mercator world, set up without a source """
+    prm = tiler_backend.Pyramid.__new__(tiler_backend.Pyramid)
+    res0 = MAX_X * 2 / abs(tile_dim[0])
+    prm.tile_dim = tile_dim
+    prm.zoom0_res = [res0, -res0]
+    prm.pix_origin = (-MAX_X, MAX_X)
+    prm.tile_origin = (-MAX_X, MAX_X if tile_dim[1] < 0 else -MAX_X)
+    prm.bounds = bounds
+    return prm
+
+
+@pytest.mark.parametrize('tile_dim', [(256, -256), (256, 256)])
+def test_batch_grid_math(tile_dim):
+    """ Tests if the batch grid math gives the same results as the per tile one """
+    pytest.importorskip('numpy')
+
+    prm = grid(tile_dim)
+    rnd = random.Random(tile_dim[1])
+    tiles = [(z, rnd.randrange(2**z), rnd.randrange(2**z)) for z in range(21) for i in range(20)]
+    coords = [(rnd.uniform(-MAX_X, MAX_X), rnd.uniform(-MAX_X, MAX_X)) for t in tiles]
+    zooms = [t[0] for t in tiles]
+
+    assert(prm.tile_bounds_batch(tiles).tolist() ==
+           [[list(c) for c in prm.tile_bounds(t)] for t in tiles])
+    assert(prm.tile_pixbounds_batch(tiles).tolist() == [prm.tile_pixbounds(t) for t in tiles])
+    pix = prm.coord2pix_batch(zooms, coords)
+    assert(pix.tolist() == [prm.coord2pix(z, c) for z, c in zip(zooms, coords)])
+    assert(prm.pix2tile_batch(zooms, pix).tolist() ==
+           [prm.pix2tile(z, p) for z, p in zip(zooms, pix.tolist())])
+    assert(prm.corner_tiles_batch(range(21)).tolist() ==
+           [[list(t) for t in prm.corner_tiles(z)] for z in range(21)])
+
+
+def test_batch_grid_rounding():
+    """ Tests if pixel coordinates are rounded half away from zero as by round() """
+    pytest.importorskip('numpy')
+
+    prm = grid((256, -256))
+    res = prm.zoom2res(1)
+    coords = [(-MAX_X + (i + 0.5) * res[0], MAX_X + (i + 0.5) * res[1]) for i in (-3, -1, 0, 2)]
+
+    assert(prm.coord2pix_batch(1, coords).tolist() == [prm.coord2pix(1, c) for c in coords])
+
+
+@pytest.mark.parametrize('batch', [True, False])
+def test_tile_lists(batch, monkeypatch):
+    """ Tests if lists of tiles are handled with and without numpy """
+    if batch:
+        pytest.importorskip('numpy')
+    else:
+        monkeypatch.setattr(tiler_backend, 'numpy', None)
+
+    prm = grid((256, -256))
+    tiles = [(3, 1, 2), (5, 30, 0)]
+
+    assert(prm.tile_bounds_lst([]) == [])
+    assert([[list(c) for c in b] for b in prm.tile_bounds_lst(tiles)] ==
+           [[list(c) for c in prm.tile_bounds(t)] for t in tiles])
+    assert(prm.tile_pixbounds_lst(tiles) == [prm.tile_pixbounds(t) for t in tiles])
+    assert([[list(t) for t in c] for c in prm.corner_tiles_lst([2, 4])] ==
+           [[list(t) for t in prm.corner_tiles(z)] for z in (2, 4)])
+
+
+def test_shard_work_dirs(tmpdir):
+    """ Tests if shards writing into a shared destination keep auxiliary files apart """
+
+    dest = str(tmpdir.join('pyramid.xyz'))
+    work_dirs = [profile(dest, shard='1/2').work_dir,
+                 profile(dest, shard='2/2').work_dir,
+                 profile(dest, finalize=True).work_dir]
+
+    assert(len(set(work_dirs)) == 3)
+    assert(all(os.path.dirname(d) == dest for d in work_dirs))
+    assert(profile(dest).work_dir == dest)
+
+
+def test_shard_work_dir_removed(tmpdir):
+    """ Tests if the auxiliary files of a shard are removed with its pyramid """
+
+    prm = profile(str(tmpdir.join('pyramid.xyz')), shard='1/2')
+    work_dir = prm.work_dir
+    os.makedirs(work_dir)
+    with open(os.path.join(work_dir, 'src.tmp.vrt'), 'w') as f:
+        f.write('<VRTDataset/>')
+    prm.temp_files.append(os.path.join(work_dir, 'src.tmp.vrt'))
+
+    del prm
+
+    assert(not os.path.exists(work_dir))
+    assert(tmpdir.join('pyramid.xyz').check(dir=1))
+
+
+def wrapped_index(coverage=False):
+    """ Tile index of a map crossing longitude 180: "physical" x goes beyond the last tile """
+    index = tiler_backend.TileIndex()
+    for z in (1, 2, 3, 4):
+        n = 2**z
+        tile_ul, tile_lr = (z, int(0.8 * n), int(0.3 * n)), (z, int(1.1 * n), int(0.6 * n))
+        cov = None
+        if coverage and z == 4:  # a checkerboard of 6x6 tiles from (12, 4)
+            bitmap = bytearray((x + y + 1) % 2 for y in range(6) for x in range(6))
+            cov = TileCoverage(z, 12, 4, 6, 6, bytes(bitmap), False)
+        index.add_zoom(z, tile_ul, tile_lr, n, cov)
+    return index
+
+
+@pytest.mark.parametrize('coverage', [False, True])
+def test_count_under_wrap(coverage):
+    """ Tests if descendants of "logical" tiles are counted across longitude 180 """
+
+    index = wrapped_index(coverage)
+
+    assert(index.physical((2, 0, 1)) == (2, 4, 1))
+    assert(index.count_under((2, 0, 1), 4) == (4 if coverage else 8))
+    for z in (1, 2, 3):
+        for tile in index.tiles(z):
+            for ch_zoom in range(z + 1, 5):
+                assert(index.count_under(tile, ch_zoom) == len(index.children(tile, ch_zoom)))
+
+
+def test_shard_roots_wrap():
+    """ Tests if shards of a map crossing longitude 180 share out all the base tiles """
+
+    prm = tiler_backend.Pyramid.__new__(tiler_backend.Pyramid)
+    prm.tile_index = wrapped_index()
+    prm.zoom_range = [4, 3, 2, 1]
+    prm.max_zoom = 4
+
+    shards = [prm.shard_roots(i, 2) for i in (1, 2)]
+    split = shards[0][0]
+    roots = shards[0][1] + shards[1][1]
+
+    assert(split == 3)
+    assert(sorted(roots) == sorted(prm.tile_index.tiles(split)))
+    counts = [sum(prm.tile_index.count_under(r, 4) for r in own) for z, own in shards]
+    assert(sum(counts) == prm.tile_index.count(4))
+    assert(abs(counts[0] - counts[1]) <= 4)
+
+
+def old_tile_map(z, tile_ul, tile_lr, ntiles_x, cov=None):
+    """ "logical" tile: "physical" one, as the pyramid mapped tiles before the index """
+    xx = (tile_ul[1], tile_lr[1])
+    yy = (tile_ul[2], tile_lr[2])
+    zoom_tiles = [(z, x, y) for y in range(min(yy), max(yy) + 1) for x in range(min(xx), max(xx) + 1)]
+    if cov is not None:
+        zoom_tiles = [t for t in zoom_tiles if t in cov]
+    return dict([((z, x % ntiles_x, y), (z, x, y)) for z, x, y in zoom_tiles])
+
+
+def checkerboard(z, x0, y0, nx, ny):
+    bitmap = bytearray((x + y + 1) % 2 for y in range(ny) for x in range(nx))
+    return TileCoverage(z, x0, y0, nx, ny, bytes(bitmap), False)
+
+
+INDEX_ZOOMS = {
+    'plain': [(z, (z, 2**z // 4, 2**z // 8), (z, 2**z // 2, 2**z // 3), 2**z, None) for z in (2, 3, 4)],
+    'wrap': [(z, (z, int(0.8 * 2**z), 1), (z, int(1.1 * 2**z), 2**z // 2), 2**z, None) for z in (2, 3, 4)],
+    'over 360': [(z, (z, 2**z // 2, 0), (z, 2**z // 2 + 2**z + 2, 1), 2**z, None) for z in (2, 3)],
+    'coverage': [(2, (2, 3, 1), (2, 4, 2), 4, None),
+                 (3, (3, 6, 2), (3, 9, 5), 8, checkerboard(3, 6, 2, 4, 4)),
+                 (4, (4, 12, 4), (4, 17, 9), 16, checkerboard(4, 12, 4, 6, 6))],
+}
+
+
+@pytest.mark.parametrize('case', sorted(INDEX_ZOOMS))
+def test_tile_index_as_tile_map(case):
+    """ Tests if the tile index maps, lists and counts tiles as the tile map did """
+
+    index = tiler_backend.TileIndex()
+    tile_map = {}
+    for zoom_args in INDEX_ZOOMS[case]:
+        index.add_zoom(*zoom_args)
+        tile_map.update(old_tile_map(*zoom_args))
+
+    for z, tile_ul, tile_lr, n, cov in INDEX_ZOOMS[case]:
+        zoom_map = dict((t, p) for t, p in tile_map.items() if t[0] == z)
+        assert(sorted(index.tiles(z)) == sorted(zoom_map))
+        assert(index.count(z) == len(zoom_map))
+        for x in range(-1, n + 1):
+            for y in range(-1, 2**z + 1):
+                assert(index.physical((z, x, y)) == tile_map.get((z, x, y)))
+                assert(((z, x, y) in index) == ((z, x, y) in tile_map))
+
+        for ch_zoom in range(z + 1, 5):
+            dz = 2**(ch_zoom - z)
+            for tile in zoom_map:
+                ch_mozaic = dict(((ch_zoom, tile[1] * dz + dx, tile[2] * dz + dy), (dx, dy))
+                                 for dx in range(dz) for dy in range(dz))
+                expected = sorted((t, ofs) for t, ofs in ch_mozaic.items() if t in tile_map)
+                assert(sorted(index.children(tile, ch_zoom)) == expected)
+
+
+class FakeDataset(object):
+    RasterCount = 3
+
+
+WARP = {'warp_memory': 256 * 2**20, 'gdal_cache': 512 * 2**20}
+RASTER = 64 * 256  # base raster side of 64x64 tiles
+
+
+def warp_grid(tmpdir, metatile=1, resampling='Lanczos', upsampled=4, **options):
+    """ Tile grid of a base zoom 10 warped from a source of 3 bands """
+    prm = grid((256, -256))
+    prm.options = tiler_backend.LooseDict(options)
+    prm.metrics = {}
+    prm.work_dir = str(tmpdir)
+    prm.metatile = metatile
+    prm.base_resampling = resampling
+    prm.src_res = [r * upsampled for r in prm.zoom2res(10)]
+    prm.src_ds = FakeDataset()
+    return prm
+
+
+def test_warp_cache_auto(tmpdir):
+    """ Tests if the warp cache is used when base tiles are warped one by one with wide margins """
+
+    prm = warp_grid(tmpdir)
+
+    assert(prm.use_warp_cache(10, WARP, RASTER, RASTER, 4))
+    estimate = prm.metrics['warp_cache_estimate']
+    assert(estimate['tiles'] == estimate['reads'] == 64 * 64)
+    assert(estimate['margin'] == 12)
+    assert(prm.metrics['warp_cache'])
+
+
+def test_warp_cache_auto_metatiles(tmpdir):
+    """ Tests if the warp cache is not used when metatiles share the margins already """
+
+    for resampling, upsampled in (('Lanczos', 4), ('NearestNeighbour', 0.5)):
+        prm = warp_grid(tmpdir, metatile=8, resampling=resampling, upsampled=upsampled)
+        assert(not prm.use_warp_cache(10, WARP, RASTER, RASTER, 4))
+
+
+def test_warp_cache_auto_reads(tmpdir):
+    """ Tests if the warp cache is not used when a part of the base tiles is read """
+
+    prm = warp_grid(tmpdir)
+    prm.base_reads = 64 * 64 // 4  # a footprint or a shard
+
+    assert(not prm.use_warp_cache(10, WARP, RASTER, RASTER, 4))
+    assert(prm.metrics['warp_cache_estimate']['reads'] == 64 * 64 // 4)
+
+
+def test_warp_cache_modes(tmpdir):
+    """ Tests if the warp cache option and dry runs take precedence over the estimate """
+
+    assert(warp_grid(tmpdir, metatile=8, warp_cache='yes').use_warp_cache(10, WARP, RASTER, RASTER, 4))
+    assert(not warp_grid(tmpdir, warp_cache='no').use_warp_cache(10, WARP, RASTER, RASTER, 4))
+
+    prm = warp_grid(tmpdir, warp_cache='yes')
+    prm.dry_run = True
+    assert(not prm.use_warp_cache(10, WARP, RASTER, RASTER, 4))
+
+
+def test_warp_cache_disk_space(tmpdir, monkeypatch):
+    """ Tests if the warp cache is not used without disk space for it """
+
+    class Stat(object):
+        f_bavail = 1000
+        f_frsize = 4096
+
+    monkeypatch.setattr(os, 'statvfs', lambda path: Stat())
+
+    assert(not warp_grid(tmpdir, warp_cache='yes').use_warp_cache(10, WARP, RASTER, RASTER, 4))
+    assert(warp_grid(tmpdir, warp_cache='yes').use_warp_cache(10, WARP, 256, 256, 4))
@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for tilers-tools `tiler_footprint.py` coverage and footprints."""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, 'landsat_processor', 'tilers-tools'))
+tiler_footprint = pytest.importorskip('tiler_footprint')  # Python 2 and GDAL
+from osgeo import gdal  # noqa: E402
+
+SCENE = "LC08_L1TP_221071_20170521_20170526_01_T1"
+MTL = """GROUP = L1_METADATA_FILE
+  GROUP = PRODUCT_METADATA
+    CORNER_UL_LAT_PRODUCT = -15.37627
+    CORNER_UL_LON_PRODUCT = -45.83045
+    CORNER_UR_LAT_PRODUCT = -15.35745
+    CORNER_UR_LON_PRODUCT = -43.69286
+    CORNER_LL_LAT_PRODUCT = -17.48062
+    CORNER_LL_LON_PRODUCT = -45.84683
+    CORNER_LR_LAT_PRODUCT = -17.45929
+    CORNER_LR_LON_PRODUCT = -43.68771
+  END_GROUP = PRODUCT_METADATA
+END_GROUP = L1_METADATA_FILE
+"""
+
+
+class LooseOptions(object):
+    """ Options as in tilers-tools, None if not set """
+    def __init__(self, **options):
+        self.__dict__.update(options)
+
+    def __getattr__(self, name):
+        return None
+
+
+class PixelTransformer(object):
+    def transform(self, points):
+        return points
+
+
+class PixelGeometry(object):
+    """ Source geometry leaving footprints in source pixels """
+    def transformer(self, srs):
+        return PixelTransformer()
+
+
+class FakePyramid(object):
+    def __init__(self, src_ds, **options):
+        self.src_ds = src_ds
+        self.options = LooseOptions(**options)
+        self.geometry = PixelGeometry()
+        self.proj_srs = None
+
+
+def coverage(flip_y=False):
+    """ 3x2 tiles from (2, 4) at zoom 3, rows from the top """
+    return tiler_footprint.TileCoverage(
+        3, 2, 4, 3, 2, b'\x01\x00\x01' b'\x00\x01\x01', flip_y)
+
+
+def test_coverage_contains():
+    """ Tests if tiles are looked up by row and column """
+
+    cov = coverage()
+
+    assert((3, 2, 4) in cov)
+    assert((3, 3, 4) not in cov)
+    assert((3, 4, 5) in cov)
+    assert((4, 2, 4) not in cov)  # another zoom
+    assert((3, 5, 4) not in cov)  # out of the bitmap
+    assert((3, 2, 6) not in cov)
+
+
+def test_coverage_contains_flip_y():
+    """ Tests if TMS rows are counted from the bottom """
+
+    cov = coverage(flip_y=True)
+
+    assert((3, 2, 4) not in cov)
+    assert((3, 2, 5) in cov)
+    assert((3, 3, 4) in cov)
+
+
+def test_coverage_count():
+    """ Tests if covered tiles are counted in tile ranges """
+
+    cov = coverage()
+
+    assert(cov.count() == 4)
+    assert(cov.count_in(2, 4, 4, 5) == 4)
+    assert(cov.count_in(3, 3, 4, 5) == 1)
+    assert(cov.count_in(0, 10, 0, 10) == 4)  # clipped to the bitmap
+    assert(cov.count_in(2, 2, 4, 4) == 1)
+    assert(coverage(flip_y=True).count_in(2, 2, 4, 4) == 0)
+
+
+def test_mtl_corners(tmpdir):
+    """ Tests if the MTL of a scene band is found and its corners read """
+
+    tmpdir.join(SCENE + '_MTL.txt').write(MTL)
+    band = str(tmpdir.join(SCENE + '_B4.TIF'))
+
+    mtl_path = tiler_footprint.find_mtl(band)
+    assert(mtl_path == str(tmpdir.join(SCENE + '_MTL.txt')))
+
+    corners = tiler_footprint.read_mtl_corners(mtl_path)
+    assert(corners['UL'] == (-45.83045, -15.37627))
+    assert(corners['LR'] == (-43.68771, -17.45929))
+
+
+def test_mtl_corners_missing(tmpdir):
+    """ Tests if incomplete MTL files give no corners """
+
+    mtl = tmpdir.join(SCENE + '_MTL.txt')
+    mtl.write(MTL.replace('CORNER_LR_LAT_PRODUCT', 'X'))
+
+    assert(tiler_footprint.read_mtl_corners(str(mtl)) is None)
+    assert(tiler_footprint.find_mtl(str(tmpdir.join('other.TIF'))) == str(mtl))
+
+
+def test_nodata_rings():
+    """ Tests if the valid data block of a raster is polygonized """
+
+    src_ds = gdal.GetDriverByName('MEM').Create('', 64, 64, 1, gdal.GDT_Byte)
+    src_ds.GetRasterBand(1).WriteRaster(16, 16, 32, 32, b'\x01' * 32 * 32)
+
+    rings = tiler_footprint.Footprint.nodata_rings(FakePyramid(src_ds, src_nodata='0'))
+
+    assert(len(rings) == 1)
+    xs = [p[0] for p in rings[0]]
+    ys = [p[1] for p in rings[0]]
+    for low, high in ((min(xs), max(xs)), (min(ys), max(ys))):
+        assert(14 <= low <= 16)  # grown by a sample
+        assert(48 <= high <= 50)
+
+
+def test_nodata_rings_all_valid():
+    """ Tests if a raster without nodata has no nodata footprint """
+
+    src_ds = gdal.GetDriverByName('MEM').Create('', 16, 16, 1, gdal.GDT_Byte)
+
+    assert(tiler_footprint.Footprint.nodata_rings(FakePyramid(src_ds)) is None)
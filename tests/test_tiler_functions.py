@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for tilers-tools `tiler_functions.py` transparency index."""
+import os
+import pickle
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, 'landsat_processor', 'tilers-tools'))
+tiler_functions = pytest.importorskip('tiler_functions')  # Python 2 and GDAL
+
+# opacity: 1 - opaque, 0 - transparent, -1 - partially transparent
+TRANSPARENCY = {
+    (3, 2, 5): 1, (3, 4, 5): 0, (3, 3, 7): -1,  # a sparse 3x3 block
+    (5, 17, 9): 1,  # a single tile
+    (6, 40, 20): 0, (6, 41, 20): 1, (6, 42, 20): -1, (6, 43, 20): 1, (6, 44, 20): 0,  # over a byte
+}
+
+
+def write_index(tmpdir, transparency=TRANSPARENCY):
+    path = str(tmpdir.join(tiler_functions.TransparencyIndex.file_name))
+    tiler_functions.TransparencyIndex.write(path, transparency.items())
+    return tiler_functions.TransparencyIndex(path)
+
+
+def test_transparency_get(tmpdir):
+    """ Tests if tile opacities are looked up as written """
+
+    idx = write_index(tmpdir)
+
+    for tile, opacity in TRANSPARENCY.items():
+        assert(idx.get(tile) == opacity)
+    assert(idx.get((3, 3, 5)) is None)  # inside the bitmap, unknown
+    assert(idx.get((3, 3, 6), 'unknown') == 'unknown')
+    assert(idx.get((3, 1, 5)) is None)  # out of the bitmap
+    assert(idx.get((3, 2, 8)) is None)
+    assert(idx.get((4, 2, 5)) is None)  # another zoom
+    idx.close()
+
+
+def test_transparency_items(tmpdir):
+    """ Tests if all the known tiles are listed, and these only """
+
+    idx = write_index(tmpdir)
+
+    assert(sorted(idx.items()) == sorted(TRANSPARENCY.items()))
+    idx.close()
+
+
+def test_transparency_pickle(tmpdir):
+    """ Tests if an index is re-opened from its path, as in a child process """
+
+    idx = write_index(tmpdir)
+
+    data = pickle.dumps(idx, 2)
+    assert(len(data) < 500)  # no mapped data
+    copy = pickle.loads(data)
+    assert(copy.path == idx.path)
+    assert(sorted(copy.items()) == sorted(TRANSPARENCY.items()))
+    assert(copy.get((6, 42, 20)) == -1)
+    copy.close()
+    idx.close()
+
+
+def test_transparency_rewrite(tmpdir):
+    """ Tests if an index is replaced while an old one is still mapped """
+
+    old = write_index(tmpdir)
+    new = write_index(tmpdir, {(2, 1, 1): -1})
+
+    assert(list(new.items()) == [((2, 1, 1), -1)])
+    assert(old.get((5, 17, 9)) == 1)
+    old.close()
+    new.close()
+
+
+def test_read_transparency(tmpdir):
+    """ Tests if indices are read from a directory, None if missing or invalid """
+
+    assert(tiler_functions.read_transparency(str(tmpdir)) is None)
+
+    tiler_functions.write_transparency(str(tmpdir), TRANSPARENCY.items())
+    idx = tiler_functions.read_transparency(str(tmpdir))
+    assert(sorted(idx.items()) == sorted(TRANSPARENCY.items()))
+    idx.close()
+
+    tmpdir.join(tiler_functions.TransparencyIndex.file_name).write_binary(b'XXXX\x01\x00\x00\x00')
+    assert(tiler_functions.read_transparency(str(tmpdir)) is None)
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for tilers-tools `tiler_store.py` PMTiles archives."""
+import json
+import os
+import random
+import sys
+import zlib
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, 'landsat_processor', 'tilers-tools'))
+tiler_store = pytest.importorskip('tiler_store')  # Python 2 and GDAL
+
+METADATA = {'format': 'png', 'bounds': '-10.5,20,30,45.25', 'name': 'test'}
+
+
+def gunzip(data):
+    return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+
+
+def read_varint(buf, pos):
+    value = shift = 0
+    while True:
+        byte = buf[pos]
+        pos += 1
+        value |= (byte & 0x7F) << shift
+        shift += 7
+        if byte < 0x80:
+            return value, pos
+
+
+def parse_directory(data):
+    """ [tile id, offset, length, run length] entries of a gzip-ed directory """
+    buf = bytearray(gunzip(data))
+    count, pos = read_varint(buf, 0)
+    columns = []
+    for column in range(4):
+        values = []
+        for i in range(count):
+            value, pos = read_varint(buf, pos)
+            values.append(value)
+        columns.append(values)
+    deltas, run_lengths, lengths, offsets = columns
+
+    entries = []
+    tile_id = 0
+    for i in range(count):
+        tile_id += deltas[i]
+        if offsets[i] == 0:  # contiguous to the previous entry
+            offset = entries[-1][1] + entries[-1][2]
+        else:
+            offset = offsets[i] - 1
+        entries.append([tile_id, offset, lengths[i], run_lengths[i]])
+    return entries
+
+
+class Archive(object):
+    """ PMTiles v3 reader, as a client of a static archive """
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.raw = f.read()
+        self.header = tiler_store.PMTiles.header.unpack_from(self.raw)
+        (self.magic, self.version, root_offset, root_length, meta_offset, meta_length,
+         self.leaf_offset, leaf_length, self.data_offset, data_length,
+         self.addressed, self.entries, self.contents, clustered, dir_compression,
+         tile_compression, self.tile_type, self.min_zoom, self.max_zoom) = self.header[:19]
+        self.bounds = [c / 1e7 for c in self.header[19:23]]
+        self.root = parse_directory(self.raw[root_offset:root_offset + root_length])
+        self.metadata = json.loads(gunzip(self.raw[meta_offset:meta_offset + meta_length]).decode())
+        self.leaves = []
+
+    def tile(self, z, x, y):
+        return self.find(self.root, tiler_store.zxy_to_tileid(z, x, y))
+
+    def find(self, entries, tile_id):
+        found = [e for e in entries if e[0] <= tile_id]
+        if not found:
+            return None
+        entry_id, offset, length, run_length = found[-1]
+        if run_length == 0:  # a leaf directory
+            start = self.leaf_offset + offset
+            self.leaves.append(entry_id)
+            return self.find(parse_directory(self.raw[start:start + length]), tile_id)
+        if tile_id >= entry_id + run_length:
+            return None
+        start = self.data_offset + offset
+        return self.raw[start:start + length]
+
+
+def write_archive(path, tiles, **attrs):
+    archive = tiler_store.PMTiles(path)
+    archive.__dict__.update(attrs)
+    for tile, data in tiles:
+        archive.put_tile(tile, data)
+    archive.set_metadata(METADATA)
+    archive.close()
+    return Archive(path)
+
+
+def test_tileid():
+    """ Tests if tiles are numbered along the Hilbert curves as in the specification """
+
+    assert(tiler_store.zxy_to_tileid(0, 0, 0) == 0)
+    assert([tiler_store.zxy_to_tileid(1, x, y) for x, y in ((0, 0), (0, 1), (1, 1), (1, 0))] ==
+           [1, 2, 3, 4])
+    assert(tiler_store.zxy_to_tileid(2, 0, 0) == 5)
+    ids = set(tiler_store.zxy_to_tileid(3, x, y) for x in range(8) for y in range(8))
+    assert(ids == set(range(21, 21 + 64)))
+
+
+def test_pmtiles_round_trip(tmpdir):
+    """ Tests if the header, the root directory and the tiles read back as written """
+
+    blank = b'blank tile'
+    tiles = [((2, 3, 1), b'tile 2/3/1'), ((1, 0, 0), b'tile 1/0/0'), ((2, 0, 0), blank)]
+    tiles += [((2, x, y), blank) for x, y in ((0, 1), (1, 1), (1, 0))]  # a Hilbert run from 2/0/0
+    path = str(tmpdir.join('test.pmtiles'))
+
+    archive = write_archive(path, tiles)
+
+    assert(tiler_store.PMTiles.header.size == 127)
+    assert((archive.magic, archive.version) == (b'PMTiles', 3))
+    assert((archive.min_zoom, archive.max_zoom) == (1, 2))
+    assert(archive.bounds == [-10.5, 20, 30, 45.25])
+    assert(archive.tile_type == 2)  # png
+    assert((archive.addressed, archive.entries, archive.contents) == (6, 3, 3))
+    assert(archive.root == [[1, 0, 10, 1], [5, 10, 10, 4], [17, 20, 10, 1]])
+    assert(archive.metadata == METADATA)
+    for tile, data in tiles:
+        assert(archive.tile(*tile) == data)
+    assert(archive.tile(2, 2, 2) is None)
+    assert(archive.tile(0, 0, 0) is None)
+    assert(not os.path.exists(path + '.data.tmp'))
+
+
+def test_pmtiles_leaf_directories(tmpdir):
+    """ Tests if tiles are found through leaf directories when the root would be too big """
+
+    rnd = random.Random(3)  # lengths vary, the directories do not compress away
+    tiles = [((3, x, y), ('tile 3/%d/%d ' % (x, y)).encode() * rnd.randrange(1, 100))
+             for x in range(8) for y in range(8)]
+    max_root = tiler_store.PMTiles.header.size + 100
+
+    archive = write_archive(str(tmpdir.join('test.pmtiles')), tiles, max_root=max_root, leaf_size=4)
+
+    assert(archive.entries == 64)
+    assert(archive.header[2] + archive.header[3] <= max_root)
+    assert(all(e[3] == 0 for e in archive.root))
+    for tile, data in tiles:
+        assert(archive.tile(*tile) == data)
+    assert(len(set(archive.leaves)) == len(archive.root))
@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for tilers-tools `tiles_convert.py`."""
+import io
+import os
+import shutil
+import sqlite3
+import subprocess
+
+import pytest
+from PIL import Image
+
+TOOLS = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                     os.pardir, 'landsat_processor', 'tilers-tools')
+PATH = "test_media/convert/"
+TILES = [(1, x, y) for x in (0, 1) for y in (0, 1)]
+
+
+@pytest.fixture
+def tile_dir():
+    """ Fixture data (SetUp): a XYZ pyramid of a single zoom level """
+    remove_path()
+    src = os.path.join(PATH, 'pyramid.xyz')
+    for i, tile in enumerate(TILES):
+        write_tile(src, tile, tile_data(i))
+
+    yield src
+
+    remove_path()
+
+
+def remove_path(path=PATH):
+    """
+    Check if path exists, then remove tree of tiles_convert tests path
+    """
+    if os.path.exists(path):
+        shutil.rmtree(path)
+
+
+def tile_data(color):
+    """ PNG tile of a single color """
+    buf = io.BytesIO()
+    Image.new('RGB', (256, 256), (color * 40, 0, 0)).save(buf, 'PNG')
+    return buf.getvalue()
+
+
+def tile_path(root, tile, ext='.png'):
+    z, x, y = tile
+    return os.path.join(root, str(z), str(x), str(y) + ext)
+
+
+def write_tile(root, tile, data):
+    path = tile_path(root, tile)
+    if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+def read_tile(root, tile):
+    with open(tile_path(root, tile), 'rb') as f:
+        return f.read()
+
+
+def write_mapper_db(path, tiles):
+    """ maemo-mapper database of (z, x, y): data tiles """
+    db = sqlite3.connect(path)
+    db.execute('CREATE TABLE maps (zoom INTEGER, tilex INTEGER, tiley INTEGER, '
+               'pixbuf BLOB, PRIMARY KEY (zoom, tilex, tiley))')
+    db.executemany('INSERT INTO maps VALUES (?, ?, ?, ?)',
+                   [(20 + 1 - z, x, y, sqlite3.Binary(data))
+                    for (z, x, y), data in tiles.items()])
+    db.commit()
+    db.close()
+
+
+def tiles_convert(args):
+    return subprocess.call('{} --quiet {}'.format(
+        os.path.join(TOOLS, 'tiles_convert.py'), args), shell=True)
+
+
+def test_convert_to_mapper(tile_dir):
+    """ Tests if a directory pyramid is written to a maemo-mapper database """
+
+    assert(tiles_convert('--from xyz --to mapper -t {} {}'.format(PATH, tile_dir)) == 0)
+
+    db = sqlite3.connect(os.path.join(PATH, 'pyramid.db'))
+    rows = dict(((z, x, y), bytes(data)) for z, x, y, data in
+                db.execute('SELECT zoom, tilex, tiley, pixbuf FROM maps'))
+    db.close()
+
+    assert(len(rows) == len(TILES))
+    for i, (z, x, y) in enumerate(TILES):
+        assert(rows[(20 + 1 - z, x, y)] == tile_data(i))
+
+
+def test_convert_from_mapper(tile_dir):
+    """ Tests if a SQLite source is converted to a directory in parallel """
+
+    src = os.path.join(PATH, 'cache.db')
+    write_mapper_db(src, dict((tile, tile_data(i)) for i, tile in enumerate(TILES)))
+
+    assert(tiles_convert('--from mapper --to xyz -t {} {}'.format(PATH, src)) == 0)
+
+    dst = os.path.join(PATH, 'cache.xyz')
+    for i, tile in enumerate(TILES):
+        assert(read_tile(dst, tile) == tile_data(i))
+    assert(os.path.isfile(os.path.join(dst, 'tilemap.json')))
+
+
+def test_convert_mbtiles_round_trip(tile_dir):
+    """ Tests if tiles come back unchanged from a MBTiles file """
+
+    assert(tiles_convert('--from xyz --to mbtiles -t {} {}'.format(PATH, tile_dir)) == 0)
+    mbtiles = os.path.join(PATH, 'pyramid.mbtiles')
+    assert(os.path.isfile(mbtiles))
+
+    assert(tiles_convert('--from mbtiles --to tms -t {} {}'.format(PATH, mbtiles)) == 0)
+
+    dst = os.path.join(PATH, 'pyramid.tms')
+    for i, (z, x, y) in enumerate(TILES):
+        assert(read_tile(dst, (z, x, 2**z - 1 - y)) == tile_data(i))
+
+
+def test_convert_mbtiles_tile_format(tile_dir):
+    """ Tests if MBTiles tiles are converted by the worker pool """
+
+    assert(tiles_convert('--from xyz --to mbtiles -t {} {}'.format(PATH, tile_dir)) == 0)
+    mbtiles = os.path.join(PATH, 'pyramid.mbtiles')
+
+    assert(tiles_convert('--from mbtiles --to mapper -f pngnq -t {} {}'.format(PATH, mbtiles)) == 0)
+
+    db = sqlite3.connect(os.path.join(PATH, 'pyramid.db'))
+    rows = db.execute('SELECT pixbuf FROM maps').fetchall()
+    db.close()
+
+    assert(len(rows) == len(TILES))
+    for (data,) in rows:
+        assert(Image.open(io.BytesIO(bytes(data))).format == 'PNG')
+
+
+def test_convert_sync(tile_dir):
+    """ Tests if a second --sync run only writes changed tiles and deletes removed ones """
+
+    sync = '--from xyz --to tms --sync -t {} {}'.format(PATH, tile_dir)
+    assert(tiles_convert(sync) == 0)
+
+    dst = os.path.join(PATH, 'pyramid.tms')
+    manifest = dst + '.manifest.db'
+    assert(os.path.isfile(manifest))
+
+    def dst_path(tile):
+        z, x, y = tile
+        return tile_path(dst, (z, x, 2**z - 1 - y))
+
+    for tile in TILES: # rewritten tiles get a new mtime
+        os.utime(dst_path(tile), (1000, 1000))
+
+    changed, removed, touched, unchanged = TILES
+    write_tile(tile_dir, changed, tile_data(9))
+    os.remove(tile_path(tile_dir, removed))
+    os.utime(tile_path(tile_dir, touched), (2000, 2000)) # same content
+
+    assert(tiles_convert(sync) == 0)
+
+    with open(dst_path(changed), 'rb') as f:
+        assert(f.read() == tile_data(9))
+    assert(os.stat(dst_path(changed)).st_mtime != 1000)
+    assert(not os.path.exists(dst_path(removed)))
+    assert(os.stat(dst_path(touched)).st_mtime == 1000)
+    assert(os.stat(dst_path(unchanged)).st_mtime == 1000)
+
+    db = sqlite3.connect(manifest)
+    synced = set(db.execute('SELECT zoom, x, y FROM tiles'))
+    db.close()
+    assert(synced == set([changed, touched, unchanged]))
+
+
+def test_convert_sync_mapper(tile_dir):
+    """ Tests if --sync removes tiles from a maemo-mapper database """
+
+    sync = '--from xyz --to mapper --sync -t {} {}'.format(PATH, tile_dir)
+    assert(tiles_convert(sync) == 0)
+
+    changed, removed = TILES[:2]
+    write_tile(tile_dir, changed, tile_data(9))
+    os.remove(tile_path(tile_dir, removed))
+
+    assert(tiles_convert(sync) == 0)
+
+    db = sqlite3.connect(os.path.join(PATH, 'pyramid.db'))
+    rows = dict(((z, x, y), bytes(data)) for z, x, y, data in
+                db.execute('SELECT zoom, tilex, tiley, pixbuf FROM maps'))
+    db.close()
+
+    assert(len(rows) == len(TILES) - 1)
+    z, x, y = changed
+    assert(rows[(20 + 1 - z, x, y)] == tile_data(9))
+    z, x, y = removed
+    assert((20 + 1 - z, x, y) not in rows)
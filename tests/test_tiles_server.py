@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for tilers-tools `tiles_server.py` cache and lookup order."""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, 'landsat_processor', 'tilers-tools'))
+tiles_server = pytest.importorskip('tiles_server')  # Python 2 and GDAL
+
+
+class FakePyramid(object):
+    """ Tile paths and zoom levels of a pyramid """
+    zoom_range = [2, 3]
+
+    def tile_path(self, tile):
+        return '%d/%d/%d.png' % tile
+
+
+class FakeRenderer(object):
+    """ Counts rendered tiles """
+    def __init__(self, data=b'rendered'):
+        self.pyramid = FakePyramid()
+        self.data = data
+        self.rendered = []
+
+    def render(self, tile):
+        self.rendered.append(tile)
+        return self.data
+
+
+def cache_files(cache):
+    return sorted(os.path.relpath(p, cache.root) for p in cache.entries)
+
+
+def test_cache_evicts_least_recently_used(tmpdir):
+    """ Tests if the cache keeps its size limit, least recently used out first """
+
+    cache = tiles_server.TileCache(str(tmpdir), 25)
+    cache.put('a.png', b'a' * 10)
+    cache.put('b.png', b'b' * 10)
+
+    assert(cache.get('a.png') == b'a' * 10)  # b is the least recently used now
+    cache.put('c.png', b'c' * 10)
+
+    assert(cache_files(cache) == ['a.png', 'c.png'])
+    assert(cache.size == 20)
+    assert(cache.get('b.png') is None)
+    assert(not tmpdir.join('b.png').exists())
+
+
+def test_cache_replaces_entry(tmpdir):
+    """ Tests if a tile put again is counted once """
+
+    cache = tiles_server.TileCache(str(tmpdir), 100)
+    cache.put('2/1/1.png', b'a' * 10)
+    cache.put('2/1/1.png', b'b' * 20)
+
+    assert(cache.size == 20)
+    assert(cache.get('2/1/1.png') == b'b' * 20)
+
+
+def test_cache_reindexed_on_restart(tmpdir):
+    """ Tests if a restarted cache keeps the order by modification time """
+
+    cache = tiles_server.TileCache(str(tmpdir), 100)
+    cache.put('2/0/0.png', b'a' * 10)
+    cache.put('2/0/1.png', b'b' * 10)
+    cache.put('2/1/0.png', b'c' * 10)
+    for name, mtime in (('2/0/0.png', 3000), ('2/0/1.png', 1000), ('2/1/0.png', 2000)):
+        os.utime(str(tmpdir.join(name)), (mtime, mtime))
+
+    cache = tiles_server.TileCache(str(tmpdir), 20)
+
+    assert(cache.size == 20)
+    assert(cache_files(cache) == ['2/0/0.png', '2/1/0.png'])
+    assert(not tmpdir.join('2/0/1.png').exists())
+
+    cache.put('3/0/0.png', b'd' * 10)  # the oldest one goes first
+    assert(cache_files(cache) == ['2/0/0.png', '3/0/0.png'])
+
+
+def test_service_order(tmpdir):
+    """ Tests if tiles come pre-rendered first, then from the cache, then rendered """
+
+    tiles_dir = tmpdir.mkdir('tiles')
+    tiles_dir.mkdir('2').mkdir('0').join('0.jpg').write_binary(b'pre-rendered')
+    renderer = FakeRenderer()
+    cache = tiles_server.TileCache(str(tmpdir.mkdir('cache')), 1000)
+    service = tiles_server.TileService(renderer, cache, str(tiles_dir))
+
+    assert(service.get((2, 0, 0)) == b'pre-rendered')
+    assert(renderer.rendered == [])
+    assert(cache.get('2/0/0.png') is None)
+
+    assert(service.get((2, 1, 0)) == b'rendered')
+    assert(renderer.rendered == [(2, 1, 0)])
+    assert(cache.get('2/1/0.png') == b'rendered')
+
+    renderer.data = b'rendered again'
+    assert(service.get((2, 1, 0)) == b'rendered')
+    assert(renderer.rendered == [(2, 1, 0)])
+
+
+def test_service_missing_tiles(tmpdir):
+    """ Tests if tiles out of the zoom range or source are not cached """
+
+    renderer = FakeRenderer(data=None)
+    cache = tiles_server.TileCache(str(tmpdir), 1000)
+    service = tiles_server.TileService(renderer, cache)
+
+    assert(service.get((5, 0, 0)) is None)
+    assert(renderer.rendered == [])
+
+    assert(service.get((3, 0, 0)) is None)
+    assert(renderer.rendered == [(3, 0, 0)])
+    assert(cache.entries == {})